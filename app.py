@@ -1,13 +1,31 @@
+import asyncio
+import hmac
+import json
 import os
+import threading
+import time
 import uuid
-from typing import Dict, Optional
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Literal, Optional, Tuple, Union
 
-from fastapi import FastAPI, HTTPException
+import anyio
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
 
 
-from inference import TechSupportChatbot
+from inference import GENERATION_FLIGHT, RETRIEVAL_CACHE, TechSupportChatbot
+from auth import APIKey, APIKeyAuth
+from hot_reload import HotReloader
+from pipeline import ChatPipeline, PipelineFull
+from profiling import SamplingProfiler, SlowRequestLog
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled
+from scheduler import set_job
+from degradation import DegradationPolicy, LoadMonitor
+from generation import GenerationOverrides
+from session_store import SessionStore
+from usage import start_usage
 
 
 app = FastAPI(title="Tech Support Chatbot API", version="1.0.0")
@@ -27,37 +45,242 @@ HF_TOKEN = os.getenv("HF_TOKEN")
 BACKEND = os.getenv("BACKEND", "vllm").lower()
 TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
 
+# Load-adaptive degradation: shrink max tokens / context / history as the
+# queue grows or latency exceeds the SLO, down to retrieval-only answers.
+LOAD = LoadMonitor()
+POLICY = DegradationPolicy(
+    LOAD,
+    slo_ms=float(os.getenv("LATENCY_SLO_MS", "10000")),
+    queue_thresholds=[int(x) for x in os.getenv("DEGRADE_QUEUE_DEPTHS", "4,8,16,32").split(",")],
+    max_level=int(os.getenv("DEGRADE_MAX_LEVEL", "4")),
+    enabled=os.getenv("DEGRADE", "1") == "1",
+)
+
+
+# API keys (API_KEYS / API_KEYS_FILE) with request and generated-token rate
+# limits; usage is metered per key. No keys configured = open access.
+AUTH = APIKeyAuth.from_env()
+
 
 _sessions: Dict[str, TechSupportChatbot] = {}
+# updated_at of the stored snapshot each session was last loaded from
+_session_seen: Dict[str, float] = {}
+
+# Sessions survive restarts and can be picked up by any worker: snapshots are
+# written behind the reply and rehydrated on first access. SESSION_DB="" disables.
+SESSION_DB = os.getenv("SESSION_DB", "knowledge_base/sessions.db")
+SESSION_STORE = SessionStore(SESSION_DB) if SESSION_DB else None
+
+# Retriever + engine are loaded once and shared by every session
+_base_bot: Optional[TechSupportChatbot] = None
+_base_lock = threading.Lock()
+
+# Chat turns run as search -> prompt -> generate -> postprocess stages with their
+# own workers, so retrieval overlaps generation (PIPELINE=0: one thread per request)
+PIPELINE = ChatPipeline.from_env() if os.getenv("PIPELINE", "1") == "1" else None
+
+# Requests slower than SLOW_REQUEST_MS keep their stage timings and prompt sizes
+# (GET /admin/slow_requests); PROFILING=1 enables GET /admin/profile
+SLOW_LOG = SlowRequestLog(
+    threshold_ms=float(os.getenv("SLOW_REQUEST_MS", "0")),
+    keep=int(os.getenv("SLOW_REQUEST_KEEP", "100")),
+)
+PROFILER = None
+if os.getenv("PROFILING", "0") == "1":
+    PROFILER = SamplingProfiler(max_seconds=float(os.getenv("PROFILE_MAX_S", "60")))
+
+# Blue/green engine + index swaps via POST /admin/reload (needs ADMIN_KEY)
+ADMIN_KEY = os.getenv("ADMIN_KEY", "")
+RELOAD_DRAIN_TIMEOUT_S = float(os.getenv("RELOAD_DRAIN_TIMEOUT_S", "120"))
+# After the drain timeout, leftover requests are cancelled and get this long to end
+RELOAD_CANCEL_GRACE_S = float(os.getenv("RELOAD_CANCEL_GRACE_S", "10"))
+_reloader: Optional[HotReloader] = None
+
+
+def get_base_bot() -> TechSupportChatbot:
+    global _base_bot, _reloader
+    if _base_bot is None:
+        with _base_lock:
+            if _base_bot is None:
+                bot = TechSupportChatbot(
+                    model_id=DEFAULT_MODEL_ID,
+                    hf_token=HF_TOKEN,
+                    top_k=TOP_K,
+                )
+                _reloader = HotReloader(
+                    bot.deployments, bot.build_deployment,
+                    drain_timeout=RELOAD_DRAIN_TIMEOUT_S, cancel_grace=RELOAD_CANCEL_GRACE_S,
+                )
+                _base_bot = bot
+    return _base_bot
 
 
 def get_or_create_bot(session_id: Optional[str]):
     """
     Returns (session_id, bot). If session_id is None/unknown, It create new session.
+    A known session is reloaded when another worker has stored a newer snapshot.
     """
-    if not session_id or session_id not in _sessions:
-        # Create a new session
-        sid = session_id or str(uuid.uuid4())
-        _sessions[sid] = TechSupportChatbot(
-            model_id=DEFAULT_MODEL_ID,
-            hf_token=HF_TOKEN,
-            top_k=TOP_K,
-        )
-        return sid, _sessions[sid]
-    return session_id, _sessions[session_id]
+    if session_id and session_id in _sessions:
+        bot = _sessions[session_id]
+        if SESSION_STORE is not None:
+            newer = SESSION_STORE.load_if_newer(session_id, _session_seen.get(session_id, 0.0))
+            if newer is not None:
+                snapshot, _session_seen[session_id] = newer
+                bot.memory.restore(*snapshot)
+        return session_id, bot
+    # Create a new session, rehydrating it if a previous process stored it
+    sid = session_id or str(uuid.uuid4())
+    bot = get_base_bot().new_session()
+    if session_id and SESSION_STORE is not None:
+        stored = SESSION_STORE.load_if_newer(session_id, 0.0)
+        if stored is not None:
+            snapshot, _session_seen[sid] = stored
+            bot.memory.restore(*snapshot)
+    # Background summaries change the snapshot after the reply was persisted
+    bot.memory.on_summary = lambda: persist_session(sid, bot)
+    _sessions[sid] = bot
+    return sid, bot
+
+
+def persist_session(sid: str, bot: TechSupportChatbot) -> None:
+    # Only queues the snapshot; the store's writer thread does the I/O
+    if SESSION_STORE is not None:
+        SESSION_STORE.put(sid, *bot.memory.snapshot())
+
+
+# ---------------------------
+# Client disconnect -> cancel in-flight generation
+# ---------------------------
+
+# How often a running request checks that its client is still connected
+DISCONNECT_POLL_S = float(os.getenv("DISCONNECT_POLL_MS", "250")) / 1000.0
+
+# Non-standard "client closed request" status; nobody is left to read it
+CLIENT_CLOSED = 499
+
+
+async def _watch_disconnect(request: Request, cancel: CancelToken) -> None:
+    while not cancel.cancelled:
+        if await request.is_disconnected():
+            cancel.cancel()
+            return
+        await asyncio.sleep(DISCONNECT_POLL_S)
+
+
+async def await_cancellable(request: Request, cancel: CancelToken, awaitable):
+    """
+    Await `awaitable`; if the client disconnects meanwhile, `cancel` fires and
+    the engine aborts (or never starts) the generation.
+    """
+    watcher = asyncio.create_task(_watch_disconnect(request, cancel))
+    try:
+        return await awaitable
+    finally:
+        watcher.cancel()
+
+
+async def run_cancellable(request: Request, cancel: CancelToken, fn, /, *args, **kwargs):
+    """Run blocking `fn` in the threadpool, cancellable as above."""
+    return await await_cancellable(request, cancel, run_in_threadpool(fn, *args, **kwargs))
+
+
+def bad_request(key: Optional[APIKey], detail: str) -> HTTPException:
+    """400 for a request that already spent a rate-limit token: still metered for its key."""
+    AUTH.record(key)
+    return HTTPException(status_code=400, detail=detail)
+
+
+def pipeline_full() -> HTTPException:
+    return HTTPException(status_code=503, detail="server busy, retry shortly", headers={"Retry-After": "1"})
+
+
+async def stream_cancellable(
+    request: Request,
+    cancel: CancelToken,
+    events: Iterator[str],
+    on_close: Optional[Callable[[], None]] = None,
+) -> AsyncIterator[str]:
+    """
+    Async wrapper for a blocking event generator. A disconnect fires `cancel`
+    even while the request is still queued, and the generator is closed here
+    (aborting the engine request) instead of whenever it gets collected.
+    `on_close` runs after that (e.g. unpinning the request's deployment).
+    """
+    watcher = asyncio.create_task(_watch_disconnect(request, cancel))
+    try:
+        async for chunk in iterate_in_threadpool(events):
+            yield chunk
+    finally:
+        watcher.cancel()
+        cancel.cancel()  # no-op for engines if the stream already finished
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(events.close)
+        if on_close is not None:
+            on_close()
+
 
 
+MAX_TOKENS_LIMIT = int(os.getenv("MAX_TOKENS_LIMIT", "2048"))
 
-class ChatRequest(BaseModel):
+
+class GenerationParams(BaseModel):
+    """Optional per-request sampling overrides; unset fields keep the server defaults."""
+    max_tokens: Optional[int] = Field(None, ge=1, le=MAX_TOKENS_LIMIT)
+    temperature: Optional[float] = Field(None, ge=0.0, le=2.0)
+    top_p: Optional[float] = Field(None, gt=0.0, le=1.0)
+    stop: Optional[Union[str, List[str]]] = Field(None, description="Extra stop strings (max 4).")
+
+    @field_validator("stop")
+    @classmethod
+    def validate_stop(cls, stop):
+        if stop is None:
+            return None
+        if isinstance(stop, str):
+            stop = [stop]
+        if len(stop) > 4 or any(not s or len(s) > 32 for s in stop):
+            raise ValueError("stop: at most 4 non-empty strings of up to 32 characters")
+        return stop
+
+    def overrides(self) -> GenerationOverrides:
+        return GenerationOverrides.from_request(self.max_tokens, self.temperature, self.top_p, self.stop)
+
+
+# Clients may only ask for the lower class; "interactive" is the default
+Priority = Literal["interactive", "bulk"]
+
+
+class ChatRequest(GenerationParams):
     message: str = Field(..., description="User message to the assistant.")
     session_id: Optional[str] = Field(
         None, description="Use the same session_id to continue a conversation."
     )
+    priority: Priority = Field("interactive", description="Scheduling class; 'bulk' yields to interactive traffic.")
 
 
 class ChatResponse(BaseModel):
     session_id: str
     reply: str
+    degradation_level: int = 0
+    degradation: str = "full"
+
+
+class OpenAIMessage(BaseModel):
+    role: str
+    content: str
+
+
+class ChatCompletionRequest(GenerationParams):
+    model: Optional[str] = None
+    messages: Union[List[OpenAIMessage], List[List[OpenAIMessage]]] = Field(
+        ...,
+        description="A conversation, or (extension) a list of independent conversations to answer in one batch.",
+    )
+    n: int = Field(1, ge=1, le=8)
+    stream: bool = False
+    user: Optional[str] = Field(None, description="End-user id; requests are fair-queued per user.")
+    priority: Optional[Priority] = Field(
+        None, description="Scheduling class; defaults to 'bulk' for batched conversations, else 'interactive'."
+    )
 
 
 class ResetRequest(BaseModel):
@@ -75,38 +298,359 @@ def health():
     return {
         "status": "ok",
         "backend": BACKEND,
-        "model_id": DEFAULT_MODEL_ID,
+        "model_id": _base_bot.deployments.active.model_id if _base_bot is not None else DEFAULT_MODEL_ID,
+        "deployment": _base_bot.deployments.active.label if _base_bot is not None else None,
         "sessions": len(_sessions),
     }
 
 
+@app.get("/metrics")
+def metrics():
+    plan_info = getattr(_base_bot.model, "plan_info", None) if _base_bot is not None else None
+    return {
+        "retrieval_cache": RETRIEVAL_CACHE.stats() if RETRIEVAL_CACHE is not None else None,
+        "retrieval_gate": _base_bot.gate.stats() if _base_bot is not None and _base_bot.gate is not None else None,
+        "reranker": _base_bot.reranker.stats() if _base_bot is not None and _base_bot.reranker is not None else None,
+        "degradation": POLICY.stats(),
+        "session_store": SESSION_STORE.stats() if SESSION_STORE is not None else None,
+        "cancellation": CANCEL_STATS.stats(),
+        "scheduler": _base_bot.scheduler.stats() if _base_bot is not None else None,
+        "engine_plan": plan_info() if plan_info is not None else None,
+        "api_keys": AUTH.stats(),
+        "pipeline": PIPELINE.stats() if PIPELINE is not None else None,
+        "slow_requests": SLOW_LOG.stats(),
+        "single_flight": {
+            "generation": GENERATION_FLIGHT.stats() if GENERATION_FLIGHT is not None else None,
+            "retrieval": _base_bot.retriever.flight.stats() if _base_bot is not None else None,
+        },
+    }
+
+
 @app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request, key: Optional[APIKey] = Depends(AUTH)):
     # Create or retrieve session
-    sid, bot = get_or_create_bot(req.session_id)
+    sid, bot = await run_in_threadpool(get_or_create_bot, req.session_id)
 
     # Basic guard
     msg = (req.message or "").strip()
     if not msg:
-        raise HTTPException(status_code=400, detail="message cannot be empty")
-
-    # Chat
+        raise bad_request(key, "message cannot be empty")
+
+    # Chat (fair-queued per API key, else per session; the job context lives for this request's task)
+    set_job(req.priority, key.name if key is not None else sid)
+    usage = start_usage()
+    trace = SLOW_LOG.start("/chat")
+    level = POLICY.current()
+    cancel = CancelToken()
+    # The whole request runs on the deployment that is active now, even if a reload swaps it
+    deployment = bot.deployments.pin(cancel)
     try:
-        reply = bot.chat(msg)
+        with LOAD.track():
+            if PIPELINE is not None:
+                turn = PIPELINE.submit(bot, msg, level=level, overrides=req.overrides(), cancel=cancel)
+                reply = await await_cancellable(request, cancel, asyncio.wrap_future(turn))
+            else:
+                reply = await run_cancellable(
+                    request, cancel, bot.chat, msg, level=level, overrides=req.overrides(), cancel=cancel
+                )
+    except PipelineFull:
+        raise pipeline_full()
+    except GenerationCancelled:
+        raise HTTPException(status_code=CLIENT_CLOSED, detail="client disconnected")
     except Exception as e:
         # Surface a clean error while keeping logs server-side
         raise HTTPException(status_code=500, detail=f"generation_error: {e}")
+    finally:
+        bot.deployments.unpin(deployment, cancel)
+        AUTH.record(key, usage)
+        SLOW_LOG.finish(trace, session_id=sid, degradation_level=level.level,
+                        completion_tokens=usage.completion_tokens)
+    persist_session(sid, bot)
+
+    return ChatResponse(session_id=sid, reply=reply, degradation_level=level.level, degradation=level.name)
+
+
+@app.post("/chat/stream")
+async def chat_stream(req: ChatRequest, request: Request, key: Optional[APIKey] = Depends(AUTH)):
+    """
+    Same as /chat but streams NDJSON lines: {"session_id": ..., "degradation_level": ...}
+    first, then {"delta": "..."} per chunk, then {"done": true} (or {"error": "..."}).
+    """
+    sid, bot = await run_in_threadpool(get_or_create_bot, req.session_id)
+
+    msg = (req.message or "").strip()
+    if not msg:
+        raise bad_request(key, "message cannot be empty")
+
+    # Set on this request's task, so it is still current while the response streams
+    set_job(req.priority, key.name if key is not None else sid)
+    usage = start_usage()
+    trace = SLOW_LOG.start("/chat/stream")
+    level = POLICY.current()
+    cancel = CancelToken()
+    deployment = bot.deployments.pin(cancel)
+    search = None
+    if PIPELINE is not None:
+        # Batched with other turns' searches; the stream itself generates on its own thread
+        try:
+            search = PIPELINE.search(bot, msg, level=level, cancel=cancel)
+        except PipelineFull:
+            # Needs this request's job and trace, so it runs after they are set: close them like /chat does
+            bot.deployments.unpin(deployment, cancel)
+            AUTH.record(key, usage)
+            SLOW_LOG.finish(trace, session_id=sid, degradation_level=level.level, completion_tokens=0)
+            raise pipeline_full()
+
+    def events() -> Iterator[str]:
+        yield json.dumps({"session_id": sid, "degradation_level": level.level, "degradation": level.name}) + "\n"
+        with LOAD.track():
+            try:
+                hits = search.result() if search is not None else None
+                for delta in bot.chat_stream(msg, level=level, overrides=req.overrides(), cancel=cancel, hits=hits):
+                    if trace is not None:
+                        trace.mark("first_token_ms")
+                    yield json.dumps({"delta": delta}) + "\n"
+            except GenerationCancelled:
+                return
+            except Exception as e:
+                yield json.dumps({"error": f"generation_error: {e}"}) + "\n"
+                return
+            finally:
+                AUTH.record(key, usage)
+                SLOW_LOG.finish(trace, session_id=sid, degradation_level=level.level,
+                                completion_tokens=usage.completion_tokens)
+        persist_session(sid, bot)
+        yield json.dumps({"done": True}) + "\n"
+
+    return StreamingResponse(
+        stream_cancellable(request, cancel, events(), on_close=lambda: bot.deployments.unpin(deployment, cancel)),
+        media_type="application/x-ndjson",
+    )
+
+
+def _split_conversation(messages: List[OpenAIMessage]) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    OpenAI message list -> (last user message, [(user, assistant), ...]).
+    System messages are ignored; the RAG system prompt is fixed server-side.
+    Consecutive messages from the same role (a question sent in several
+    parts) are joined into one.
+    """
+    turns = [m for m in messages if m.role in ("user", "assistant")]
+    if not turns or turns[-1].role != "user" or not turns[-1].content.strip():
+        raise HTTPException(status_code=400, detail="each conversation must end with a non-empty user message")
+    merged: List[List[str]] = []  # [role, content]
+    for m in turns:
+        if merged and merged[-1][0] == m.role:
+            merged[-1][1] += "\n" + m.content
+        else:
+            merged.append([m.role, m.content])
+    # A leading assistant message has no question to pair with
+    if merged[0][0] == "assistant":
+        merged = merged[1:]
+    history = [(merged[i][1], merged[i + 1][1]) for i in range(0, len(merged) - 1, 2)]
+    return merged[-1][1].strip(), history
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(
+    req: ChatCompletionRequest, request: Request, key: Optional[APIKey] = Depends(AUTH)
+):
+    """
+    Stateless, OpenAI-compatible chat completions over the RAG pipeline. Passing
+    a list of conversations answers all of them in one batched engine call;
+    choice `index` is conversation_index * n + sample_index.
+    """
+    batched = bool(req.messages) and isinstance(req.messages[0], list)
+    conversations = req.messages if batched else [req.messages]
+    if not conversations:
+        raise bad_request(key, "messages cannot be empty")
+    try:
+        requests = [_split_conversation(conv) for conv in conversations]
+    except HTTPException:
+        AUTH.record(key)
+        raise
+    if req.stream and (len(requests) != 1 or req.n != 1):
+        raise bad_request(key, "stream=true supports a single conversation with n=1")
+
+    bot = await run_in_threadpool(get_base_bot)
+    if key is not None:
+        tenant = f"{key.name}/{req.user}" if req.user else key.name
+    else:
+        tenant = req.user or (request.client.host if request.client else "")
+    set_job(req.priority or ("bulk" if batched else "interactive"), tenant)
+    usage = start_usage()
+    trace = SLOW_LOG.start("/v1/chat/completions")
+    level = POLICY.current()
+    cancel = CancelToken()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    deployment = bot.deployments.pin(cancel)
+
+    if req.stream:
+        msg, history = requests[0]
+
+        def chunk(delta: dict, finish_reason: Optional[str] = None) -> str:
+            body = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": deployment.model_id,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                "degradation_level": level.level,
+            }
+            return f"data: {json.dumps(body)}\n\n"
+
+        def events() -> Iterator[str]:
+            yield chunk({"role": "assistant"})
+            with LOAD.track():
+                try:
+                    for delta in bot.answer_stream(msg, history, level=level, overrides=req.overrides(), cancel=cancel):
+                        if trace is not None:
+                            trace.mark("first_token_ms")
+                        yield chunk({"content": delta})
+                except GenerationCancelled:
+                    return
+                except Exception as e:
+                    yield f"data: {json.dumps({'error': {'message': f'generation_error: {e}'}})}\n\n"
+                    return
+                finally:
+                    AUTH.record(key, usage)
+                    SLOW_LOG.finish(trace, degradation_level=level.level, completion_tokens=usage.completion_tokens)
+            yield chunk({}, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(
+            stream_cancellable(request, cancel, events(), on_close=lambda: bot.deployments.unpin(deployment, cancel)),
+            media_type="text/event-stream",
+        )
+
+    try:
+        with LOAD.track():
+            outputs = await run_cancellable(
+                request, cancel, bot.answer_batch, requests,
+                n=req.n, level=level, overrides=req.overrides(), cancel=cancel,
+            )
+    except GenerationCancelled:
+        raise HTTPException(status_code=CLIENT_CLOSED, detail="client disconnected")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"generation_error: {e}")
+    finally:
+        bot.deployments.unpin(deployment, cancel)
+        AUTH.record(key, usage)
+        SLOW_LOG.finish(trace, degradation_level=level.level, completion_tokens=usage.completion_tokens)
+
+    choices = [
+        {
+            "index": i * req.n + j,
+            "message": {"role": "assistant", "content": text},
+            "finish_reason": "stop",
+        }
+        for i, candidates in enumerate(outputs)
+        for j, text in enumerate(candidates)
+    ]
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": deployment.model_id,
+        "choices": choices,
+        "usage": {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "total_tokens": usage.prompt_tokens + usage.completion_tokens,
+        },
+        "degradation_level": level.level,
+    }
+
+
+@app.get("/v1/usage")
+def get_usage(key: Optional[APIKey] = Depends(AUTH)):
+    """Request and token totals for the calling API key."""
+    if key is None:
+        raise HTTPException(status_code=404, detail="API keys are not enabled")
+    AUTH.record(key)
+    return {"key": key.name, **AUTH.meter.totals(key.name)}
+
+
+class ReloadRequest(BaseModel):
+    model_id: Optional[str] = Field(None, description="Load this model as the new engine (unset keeps the current).")
+    index_path: Optional[str] = Field(None, description="Load a prebuilt index directory (build_index.py).")
+    rebuild_index: bool = Field(False, description="Re-embed the knowledge base file into a new index.")
+
+
+async def require_admin(request: Request) -> None:
+    if not ADMIN_KEY:
+        raise HTTPException(status_code=403, detail="admin endpoints are disabled; set ADMIN_KEY")
+    header = request.headers.get("authorization", "")
+    secret = header[7:].strip() if header[:7].lower() == "bearer " else request.headers.get("x-admin-key", "")
+    if not hmac.compare_digest(secret.encode("utf-8"), ADMIN_KEY.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="invalid admin key", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.post("/admin/reload", status_code=202, dependencies=[Depends(require_admin)])
+async def admin_reload(req: ReloadRequest):
+    """
+    Blue/green swap: load + warm up the new engine and/or index in the background,
+    switch new requests to it, drain requests still on the old one, then free it.
+    Poll GET /admin/reload for progress.
+    """
+    if not (req.model_id or req.index_path or req.rebuild_index):
+        raise HTTPException(status_code=400, detail="nothing to reload: set model_id, index_path or rebuild_index")
+    await run_in_threadpool(get_base_bot)
+    if not _reloader.start(model_id=req.model_id, index_path=req.index_path, rebuild_index=req.rebuild_index):
+        raise HTTPException(status_code=409, detail="a reload is already in progress")
+    return _reloader.status()
+
+
+@app.get("/admin/reload", dependencies=[Depends(require_admin)])
+async def admin_reload_status():
+    if _reloader is None:
+        raise HTTPException(status_code=404, detail="engine not loaded yet")
+    return _reloader.status()
+
+
+@app.get("/admin/profile", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def admin_profile(seconds: float = 10.0, interval_ms: float = 5.0, idle: bool = False):
+    """
+    Sample every thread's stack for `seconds` and return collapsed stacks
+    ("frame;frame;... count"), e.g. `flamegraph.pl profile.txt > profile.svg`
+    or open in speedscope. `idle=true` keeps threads parked on locks/queues.
+    """
+    if PROFILER is None:
+        raise HTTPException(status_code=404, detail="profiling is disabled; set PROFILING=1")
+    if seconds <= 0:
+        raise HTTPException(status_code=400, detail="seconds must be positive")
+    stacks = await run_in_threadpool(PROFILER.capture, seconds, interval_ms, idle)
+    if stacks is None:
+        raise HTTPException(status_code=409, detail="a profile capture is already running")
+    return PlainTextResponse(stacks, headers={"X-Profile-Samples": str(PROFILER.last_samples)})
+
 
-    return ChatResponse(session_id=sid, reply=reply)
+@app.get("/admin/slow_requests", dependencies=[Depends(require_admin)])
+async def admin_slow_requests(limit: int = 50):
+    """The most recent requests over SLOW_REQUEST_MS, with stage timings (ms) and prompt sizes."""
+    return {**SLOW_LOG.stats(), "requests": SLOW_LOG.recent(limit)}
 
 
 @app.post("/reset", response_model=ResetResponse)
-def reset(req: ResetRequest):
+def reset(req: ResetRequest, key: Optional[APIKey] = Depends(AUTH)):
     sid, bot = get_or_create_bot(req.session_id)
     bot.reset()
+    if SESSION_STORE is not None:
+        SESSION_STORE.delete(sid)
+    AUTH.record(key)
     return ResetResponse(session_id=sid, status="cleared")
 
 
+@app.on_event("shutdown")
+def flush_sessions():
+    if PIPELINE is not None:
+        PIPELINE.close()
+    if SESSION_STORE is not None:
+        SESSION_STORE.close()
+    AUTH.close()
+
+
 # Optional: if you want to run `python app.py`
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,156 @@
+"""
+API keys with token-bucket rate limits on requests and generated tokens.
+
+Keys come from API_KEYS ("name:key,name2:key2", default limits) and/or
+API_KEYS_FILE (JSON list of {"name", "key", "rpm", "tpm"}). With no keys
+configured the API stays open and nothing is limited.
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from fastapi import HTTPException, Request
+
+from usage import RequestUsage, UsageMeter
+
+
+class TokenBucket:
+    """
+    `per_minute` refill with a burst of `burst` (default: one minute's worth).
+    take() admits or rejects up front; charge() debits after the fact and may
+    go negative, so a request that generated more than was left simply delays
+    the key's next ones.
+    """
+
+    __slots__ = ("rate", "capacity", "level", "stamp")
+
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or per_minute
+        self.level = self.capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, n: float, now: float) -> float:
+        """Take `n` if available; otherwise return seconds until it would be (0.0 = admitted)."""
+        self._refill(now)
+        if self.level >= n:
+            self.level -= n
+            return 0.0
+        return (n - self.level) / self.rate
+
+    def ready(self, now: float) -> float:
+        """0.0 if the bucket is not in debt, else seconds until it is."""
+        self._refill(now)
+        return 0.0 if self.level > 0 else (1e-3 - self.level) / self.rate
+
+    def charge(self, n: float, now: float) -> None:
+        self._refill(now)
+        self.level -= n
+
+
+@dataclass
+class APIKey:
+    name: str
+    requests: Optional[TokenBucket]
+    tokens: Optional[TokenBucket]
+
+
+class APIKeyAuth:
+    """
+    Enforcement is one dict lookup plus two bucket updates under a lock, done
+    on the event loop (no threadpool hop, no I/O); usage goes to the meter,
+    which writes behind.
+    """
+
+    def __init__(self, keys: Dict[str, APIKey], meter: Optional[UsageMeter] = None):
+        self.keys = keys
+        self.meter = meter
+        self._lock = threading.Lock()
+        self.rejected = {"unauthorized": 0, "requests": 0, "tokens": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.keys)
+
+    @classmethod
+    def from_env(cls) -> "APIKeyAuth":
+        rpm = float(os.getenv("API_RATE_RPM", "60"))
+        tpm = float(os.getenv("API_RATE_TPM", "20000"))
+        entries: List[dict] = []
+        for i, item in enumerate(x.strip() for x in os.getenv("API_KEYS", "").split(",")):
+            if item:
+                name, sep, key = item.partition(":")
+                entries.append({"name": name, "key": key} if sep else {"name": f"key{i}", "key": item})
+        keys_file = os.getenv("API_KEYS_FILE")
+        if keys_file:
+            with open(keys_file, "r", encoding="utf-8") as f:
+                entries.extend(json.load(f))
+
+        keys = {}
+        for e in entries:
+            # 0 disables a limit for that key
+            r, t = float(e.get("rpm", rpm)), float(e.get("tpm", tpm))
+            keys[e["key"]] = APIKey(e["name"], TokenBucket(r) if r > 0 else None, TokenBucket(t) if t > 0 else None)
+        meter = UsageMeter(os.getenv("USAGE_DB", "knowledge_base/usage.db"),
+                           flush_interval=float(os.getenv("USAGE_FLUSH_S", "5"))) if keys else None
+        return cls(keys, meter)
+
+    async def __call__(self, request: Request) -> Optional[APIKey]:
+        """FastAPI dependency: the caller's APIKey, or None when auth is off."""
+        if not self.keys:
+            return None
+        header = request.headers.get("authorization", "")
+        secret = header[7:].strip() if header[:7].lower() == "bearer " else request.headers.get("x-api-key", "")
+        key = self.keys.get(secret)
+        if key is None:
+            self.rejected["unauthorized"] += 1
+            raise HTTPException(status_code=401, detail="invalid or missing API key",
+                                headers={"WWW-Authenticate": "Bearer"})
+        now = time.monotonic()
+        with self._lock:
+            wait = key.tokens.ready(now) if key.tokens is not None else 0.0
+            limit = "tokens"
+            if not wait and key.requests is not None:
+                wait, limit = key.requests.take(1, now), "requests"
+        if wait:
+            self.rejected[limit] += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"rate limit exceeded ({limit} per minute)",
+                headers={"Retry-After": str(max(1, int(wait + 0.999)))},
+            )
+        return key
+
+    def record(self, key: Optional[APIKey], usage: Optional[RequestUsage] = None) -> None:
+        """
+        Charge the generated tokens to the key's bucket and meter the request.
+        Every request that passed the dependency is recorded, with `usage` None
+        when it ran no engine calls (rejected input, /reset).
+        """
+        if key is None:
+            return
+        usage = usage or RequestUsage()
+        if key.tokens is not None:
+            with self._lock:
+                key.tokens.charge(usage.completion_tokens, time.monotonic())
+        if self.meter is not None:
+            self.meter.record(key.name, usage.prompt_tokens, usage.completion_tokens)
+
+    def close(self) -> None:
+        if self.meter is not None:
+            self.meter.close()
+
+    def stats(self) -> Dict:
+        return {
+            "enabled": self.enabled,
+            "keys": len(self.keys),
+            "rejected": dict(self.rejected),
+            "usage_writer": self.meter.stats() if self.meter is not None else None,
+        }
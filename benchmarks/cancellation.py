@@ -0,0 +1,138 @@
+"""
+Cancellation end to end on the stub engine (BACKEND=stub, no GPU): the real
+ScheduledModel(StubModel) behind a one-slot Scheduler, driven through the
+app's disconnect handling (_watch_disconnect via stream_cancellable and
+run_cancellable) with requests whose client goes away.
+
+- A: a /chat/stream-style request, streaming when its client disconnects
+- B: a /chat-style request, still queued for the scheduler slot when its client disconnects
+- C: a request behind both, timed
+
+Run once with clients that stay and once with clients that leave. Exits
+non-zero if the engine keeps decoding for a client that left, if C still
+waits for A and B to finish, or if anything is left in the scheduler.
+
+    python -m benchmarks.cancellation --answer-words 200 --token-ms 5
+"""
+import argparse
+import asyncio
+import os
+import time
+
+# app builds no bot at import time; keep it from opening the session DB or pipeline threads
+os.environ.setdefault("SESSION_DB", "")
+os.environ.setdefault("PIPELINE", "0")
+os.environ["BACKEND"] = "stub"
+
+from starlette.concurrency import run_in_threadpool  # noqa: E402
+
+import app  # noqa: E402
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled  # noqa: E402
+from scheduler import ScheduledModel, Scheduler  # noqa: E402
+from stub_model import StubModel  # noqa: E402
+
+
+class DisconnectingRequest:
+    """Stands in for starlette's Request: the client is gone `after_s` seconds after it arrived."""
+
+    def __init__(self, after_s: float):
+        self.deadline = time.monotonic() + after_s
+
+    async def is_disconnected(self) -> bool:
+        return time.monotonic() >= self.deadline
+
+
+def prompt_for(words: int) -> str:
+    # StubModel answers with the first context chunk's words, one decode step each
+    return "Context:\n- " + " ".join(f"w{i}" for i in range(words)) + "\n\nUser: help\nAssistant:"
+
+
+async def stream_request(model, prompt: str, request) -> int:
+    """/chat/stream as the app runs it. Returns the number of deltas the client got."""
+    cancel = CancelToken()
+
+    def events():
+        try:
+            yield from model.stream(prompt, cancel=cancel)
+        except GenerationCancelled:
+            return
+
+    received = 0
+    async for _ in app.stream_cancellable(request, cancel, events()):
+        received += 1
+    return received
+
+
+async def chat_request(model, prompt: str, request) -> str:
+    """/chat as the app runs it (PIPELINE=0)."""
+    cancel = CancelToken()
+    try:
+        await app.run_cancellable(request, cancel, model.generate, prompt, cancel=cancel)
+        return "done"
+    except GenerationCancelled:
+        return "cancelled"
+
+
+async def scenario(words: int, token_ms: float, leave_after_s: float):
+    scheduler = Scheduler(slots=1)
+    engine = StubModel(answer_words=words, token_ms=token_ms, max_new_tokens=4 * words)
+    model = ScheduledModel(engine, scheduler)
+    prompt = prompt_for(words)
+    start = time.perf_counter()
+
+    async def timed_c():
+        await asyncio.sleep(0.02)  # arrives after A and B
+        await run_in_threadpool(model.generate, prompt)
+        return time.perf_counter() - start
+
+    # B leaves first, so it is certainly still queued behind A when it goes
+    leave_a = DisconnectingRequest(leave_after_s)
+    leave_b = DisconnectingRequest(leave_after_s / 2)
+
+    async def queued_b():
+        await asyncio.sleep(0.01)  # A holds the slot by now
+        return await chat_request(model, prompt, leave_b)
+
+    a, b, c = await asyncio.gather(stream_request(model, prompt, leave_a), queued_b(), timed_c())
+    return {"A_deltas": a, "B": b, "C_s": c, "steps": engine.steps, "scheduler": scheduler.stats()}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--answer-words", type=int, default=200)
+    ap.add_argument("--token-ms", type=float, default=5.0)
+    ap.add_argument("--leave-after-ms", type=float, default=150.0)
+    args = ap.parse_args()
+    app.DISCONNECT_POLL_S = 0.01
+
+    full = asyncio.run(scenario(args.answer_words, args.token_ms, leave_after_s=3600.0))
+    before = CANCEL_STATS.stats()
+    left = asyncio.run(scenario(args.answer_words, args.token_ms, args.leave_after_ms / 1000.0))
+    after = CANCEL_STATS.stats()
+
+    print(f"clients stay:  C done after {full['C_s'] * 1000:7.0f} ms, engine steps {full['steps']}, "
+          f"A got {full['A_deltas']} deltas")
+    print(f"clients leave: C done after {left['C_s'] * 1000:7.0f} ms, engine steps {left['steps']}, "
+          f"A got {left['A_deltas']} deltas, B {left['B']}")
+    print("cancellation:", {k: after[k] - before[k] for k in after})
+    sched = left["scheduler"]
+    queued = sum(c["queued"] for c in sched["classes"].values())
+    print(f"scheduler after: running={sched['running']} queued={queued}")
+
+    ok = (
+        full["A_deltas"] == args.answer_words and full["B"] == "done"
+        and left["A_deltas"] < args.answer_words
+        and left["B"] == "cancelled"
+        # A stopped early, B never decoded: well under the three full answers of the first run
+        and left["steps"] < full["steps"] - args.answer_words
+        and left["C_s"] < full["C_s"]
+        and after["aborted"] - before["aborted"] == 1
+        and after["dequeued"] - before["dequeued"] == 1
+        and sched["running"] == 0 and queued == 0
+    )
+    print("OK" if ok else "FAIL: engine or scheduler kept working for disconnected clients")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
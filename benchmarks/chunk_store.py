@@ -0,0 +1,73 @@
+"""
+Memory and lookup time of chunk texts held as a Python list of str vs. a
+ChunkStore (one UTF-8 buffer + spans, overlaps stored once), in memory and
+memory-mapped from disk. The KB is repeated to simulate a larger corpus.
+
+    python -m benchmarks.chunk_store --repeat 200 --chunk-sizes 400,150,60
+"""
+import argparse
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from chunk_store import ChunkStore
+from sample_text import KNOWLEDGE_BASE
+from search_hits import word_spans
+
+
+def chunks_for(raw: str, size: int, overlap: int):
+    return [" ".join(raw[s:e].split()) for s, e in word_spans(raw, size, overlap)]
+
+
+def measure(build):
+    """(object, bytes still allocated by build())"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    obj = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return obj, after - before
+
+
+def lookup_ns(texts, ids) -> float:
+    start = time.perf_counter()
+    for i in ids:
+        texts[i]
+    return (time.perf_counter() - start) / len(ids) * 1e9
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--repeat", type=int, default=200, help="copies of the sample KB")
+    ap.add_argument("--chunk-sizes", default="400,150,60")
+    ap.add_argument("--lookups", type=int, default=200000)
+    args = ap.parse_args()
+
+    raw = KNOWLEDGE_BASE * args.repeat
+    print(f"corpus {len(raw.encode('utf-8')) / 2**20:.1f} MiB")
+    print(
+        f"{'chunk':>5} {'overlap':>7} {'chunks':>7} {'list_MiB':>9} {'store_MiB':>9} "
+        f"{'list_ns':>8} {'store_ns':>8} {'mmap_ns':>8}"
+    )
+    tmp = Path(tempfile.mkdtemp())
+    for size in (int(s) for s in args.chunk_sizes.split(",")):
+        overlap = size // 4
+        # Built from bytes so the list's strings are fresh objects, as after encode/decode
+        encoded = [c.encode("utf-8") for c in chunks_for(raw, size, overlap)]
+        as_list, list_bytes = measure(lambda: [b.decode("utf-8") for b in encoded])
+        store, store_bytes = measure(lambda: ChunkStore.from_texts(as_list))
+        assert list(store) == as_list
+
+        store.save(tmp / "chunks.bin", tmp / "offsets.npy")
+        mapped = ChunkStore.open(tmp / "chunks.bin", tmp / "offsets.npy")
+        ids = [random.randrange(len(as_list)) for _ in range(args.lookups)]
+        print(
+            f"{size:>5} {overlap:>7} {len(as_list):>7} {list_bytes / 2**20:>9.1f} {store_bytes / 2**20:>9.1f} "
+            f"{lookup_ns(as_list, ids):>8.0f} {lookup_ns(store, ids):>8.0f} {lookup_ns(mapped, ids):>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
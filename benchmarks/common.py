@@ -0,0 +1,49 @@
+import re
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from sample_text import KNOWLEDGE_BASE
+
+
+_RECORD_RE = re.compile(r"Problem:\s*(.+?)\nSolution:\s*\n(.+?)(?=\n\s*\n|\Z)", re.S)
+
+
+def kb_records(text: str = KNOWLEDGE_BASE) -> List[Tuple[str, str]]:
+    """
+    (problem, solution) pairs from the Problem:/Solution: blocks of the KB.
+    """
+    return [(m.group(1).strip(), m.group(2).strip()) for m in _RECORD_RE.finditer(text)]
+
+
+def first_step(solution: str) -> str:
+    """
+    First numbered step of a solution with the '1.' prefix removed and
+    whitespace collapsed, so it can be matched against word-joined chunks.
+    """
+    line = solution.splitlines()[0]
+    line = re.sub(r"^\s*\d+\.\s*", "", line)
+    return " ".join(line.split())
+
+
+def contains(chunks: Sequence[str], snippet: str) -> bool:
+    return any(snippet in " ".join(c.split()) for c in chunks)
+
+
+def make_token_counter(tokenizer_id: Optional[str] = None) -> Callable[[str], int]:
+    """
+    Exact counts with a HF tokenizer when one is given, otherwise a
+    words * 1.3 estimate (close enough for Llama-style BPE on English text).
+    """
+    if tokenizer_id:
+        from transformers import AutoTokenizer
+
+        tok = AutoTokenizer.from_pretrained(tokenizer_id, use_fast=True)
+        return lambda text: len(tok.encode(text, add_special_tokens=False))
+    return lambda text: int(len(text.split()) * 1.3)
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    if not values:
+        return 0.0
+    xs = sorted(values)
+    idx = min(len(xs) - 1, max(0, int(round(p / 100.0 * (len(xs) - 1)))))
+    return xs[idx]
@@ -0,0 +1,86 @@
+"""
+Embedding throughput for sizing retrieval pods: ingestion texts/s (length-
+sorted macro batches vs. one unsorted pass) and single-query encode latency,
+across devices, precisions, CPU thread counts and batch sizes.
+
+    python -m benchmarks.embeddings --device cpu --threads 1,2,4,8 --batch-sizes 16,32,64
+    python -m benchmarks.embeddings --device cuda --precisions fp32,fp16
+"""
+import argparse
+import random
+import time
+
+import torch
+
+from embedding import EMBED_BACKENDS, EMBED_MODEL, EmbeddingService
+from inference import TechSupportChatbot
+from sample_text import KNOWLEDGE_BASE
+from benchmarks.common import kb_records, percentile
+
+
+def corpus(n: int, seed: int = 0):
+    """n chunks of mixed length (20-400 words), like a KB chunked at several sizes."""
+    rng = random.Random(seed)
+    pools = [TechSupportChatbot._split_text(KNOWLEDGE_BASE, size, size // 4) for size in (20, 60, 150, 400)]
+    return [rng.choice(rng.choice(pools)) for _ in range(n)]
+
+
+def ingest_rate(service: EmbeddingService, texts, batch_size: int, sort: bool) -> float:
+    start = time.perf_counter()
+    if sort:
+        service.encode_corpus(texts, batch_size=batch_size)
+    else:
+        # Baseline: fixed-size slices in arrival order, no global length sort
+        for i in range(0, len(texts), batch_size):
+            service.encode(texts[i: i + batch_size], batch_size=batch_size)
+    return len(texts) / (time.perf_counter() - start)
+
+
+def query_latency(service: EmbeddingService, queries, repeats: int):
+    times = []
+    for _ in range(repeats):
+        for q in queries:
+            t0 = time.perf_counter()
+            service.encode([q])
+            times.append((time.perf_counter() - t0) * 1000)
+    return times
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backend", default="torch", choices=EMBED_BACKENDS)
+    ap.add_argument("--device", default="auto")
+    ap.add_argument("--precisions", default="auto")
+    ap.add_argument("--threads", default="", help="comma-separated CPU thread counts (default: library default)")
+    ap.add_argument("--batch-sizes", default="32,64,128")
+    ap.add_argument("--texts", type=int, default=2000)
+    ap.add_argument("--repeats", type=int, default=3)
+    args = ap.parse_args()
+
+    texts = corpus(args.texts)
+    queries = [p for p, _ in kb_records()]
+    threads = [int(t) for t in args.threads.split(",") if t] or [None]
+
+    print(f"model={EMBED_MODEL} backend={args.backend} texts={len(texts)} queries={len(queries)}")
+    print(
+        f"{'device':>6} {'prec':>5} {'threads':>7} {'batch':>5} "
+        f"{'sorted/s':>9} {'unsorted/s':>10} {'q_p50_ms':>9} {'q_p99_ms':>9}"
+    )
+    for precision in args.precisions.split(","):
+        for n_threads in threads:
+            service = EmbeddingService(
+                EMBED_MODEL, args.backend, device=args.device, precision=precision, threads=n_threads
+            )
+            service.encode(texts[:32])  # warm-up
+            lat = query_latency(service, queries, args.repeats)
+            for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+                print(
+                    f"{service.device:>6} {service.precision:>5} {n_threads or torch.get_num_threads():>7} {batch_size:>5} "
+                    f"{ingest_rate(service, texts, batch_size, sort=True):>9.1f} "
+                    f"{ingest_rate(service, texts, batch_size, sort=False):>10.1f} "
+                    f"{percentile(lat, 50):>9.2f} {percentile(lat, 99):>9.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
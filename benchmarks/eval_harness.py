@@ -0,0 +1,213 @@
+"""
+Answer-quality and latency regression harness over the bundled KB.
+
+Every Problem/Solution record becomes a question ("How do I fix this: <problem>?")
+with the first solution step as the expected snippet. Each question runs
+through TechSupportChatbot.chat() in a fresh session, once per configuration
+(chunking x top_k), and reports:
+
+- retrieval hit rate: expected snippet inside the injected context
+- answer recall: share of the snippet's words found in the answer
+- prompt / completion tokens per question (as metered for API keys)
+- latency p50/p95 of search, rerank, generate, the rest, and the total
+
+Results are appended to a JSONL file tagged with the git commit, so runs can
+be compared across commits:
+
+    python -m benchmarks.eval_harness --backend stub --top-k 1,3,5 --chunking 400:100,150:40
+    python -m benchmarks.eval_harness --backend vllm --top-k 3
+    python -m benchmarks.eval_harness --backend stub --compare HEAD~1
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+
+# Measure retrieval itself, not the cross-request cache
+os.environ.setdefault("RETRIEVAL_CACHE_SIZE", "0")
+
+from hot_reload import Deployment  # noqa: E402
+from inference import TechSupportChatbot  # noqa: E402
+from usage import start_usage  # noqa: E402
+from benchmarks.common import contains, first_step, kb_records, percentile  # noqa: E402
+
+STAGES = ("search", "rerank", "generate", "other", "total")
+RESULTS_FILE = Path(__file__).parent / "results" / "eval.jsonl"
+
+
+class Stopwatch:
+    """Accumulates wall time per stage for the current question."""
+
+    def __init__(self):
+        self.times = {}
+
+    def reset(self):
+        self.times = {}
+
+    def add(self, stage: str, seconds: float):
+        self.times[stage] = self.times.get(stage, 0.0) + seconds
+
+
+class _Timed:
+    """Proxy that times the listed methods of a pipeline component into a Stopwatch."""
+
+    def __init__(self, target, stopwatch: Stopwatch, stage: str, methods):
+        self._target = target
+        self._stopwatch = stopwatch
+        self._stage = stage
+        self._methods = set(methods)
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if name not in self._methods:
+            return attr
+
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._stopwatch.add(self._stage, time.perf_counter() - t0)
+        return timed
+
+
+def _git(*args) -> str:
+    return subprocess.run(("git",) + args, capture_output=True, text=True, cwd=Path(__file__).parent).stdout.strip()
+
+
+def git_rev(ref: str = "HEAD") -> str:
+    return _git("rev-parse", "--short", ref) or ref
+
+
+def git_commit():
+    """(short commit, whether tracked files have uncommitted changes)."""
+    return git_rev(), bool(_git("status", "--porcelain", "-uno"))
+
+
+def answer_recall(answer: str, snippet: str) -> float:
+    words = set(re.findall(r"\w+", snippet.lower()))
+    found = set(re.findall(r"\w+", answer.lower()))
+    return len(words & found) / len(words) if words else 0.0
+
+
+def evaluate(bot: TechSupportChatbot, stopwatch: Stopwatch, records, top_k: int):
+    bot.top_k = top_k
+    rows = []
+    for problem, solution in records:
+        session = bot.new_session()
+        snippet = first_step(solution)
+        usage = start_usage()
+        stopwatch.reset()
+        t0 = time.perf_counter()
+        answer = session.chat(f"How do I fix this: {problem}?")
+        total = time.perf_counter() - t0
+        times = dict(stopwatch.times, total=total)
+        times["other"] = total - sum(stopwatch.times.values())
+        rows.append({
+            "hit": contains(session._last_ctx or [], snippet),
+            "recall": answer_recall(answer, snippet),
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "ms": {stage: times.get(stage, 0.0) * 1000 for stage in STAGES},
+        })
+    n = len(rows)
+    metrics = {
+        "questions": n,
+        "hit_rate": sum(r["hit"] for r in rows) / n,
+        "answer_recall": sum(r["recall"] for r in rows) / n,
+        "prompt_tokens": sum(r["prompt_tokens"] for r in rows) / n,
+        "completion_tokens": sum(r["completion_tokens"] for r in rows) / n,
+    }
+    for stage in STAGES:
+        values = [r["ms"][stage] for r in rows]
+        metrics[f"{stage}_p50_ms"] = percentile(values, 50)
+        metrics[f"{stage}_p95_ms"] = percentile(values, 95)
+    return metrics
+
+
+def load_results(path: Path):
+    if not path.exists():
+        return []
+    with path.open("r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+COLUMNS = [
+    ("hit_rate", "hit", ".3f"),
+    ("answer_recall", "recall", ".3f"),
+    ("prompt_tokens", "p_tok", ".0f"),
+    ("completion_tokens", "c_tok", ".0f"),
+    ("search_p50_ms", "search", ".1f"),
+    ("rerank_p50_ms", "rerank", ".1f"),
+    ("generate_p50_ms", "gen", ".1f"),
+    ("other_p50_ms", "other", ".1f"),
+    ("total_p50_ms", "total", ".1f"),
+    ("total_p95_ms", "tot_p95", ".1f"),
+]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--backend", default=os.getenv("BACKEND", "stub"), choices=("stub", "vllm", "hf", "remote"))
+    ap.add_argument("--model", default=os.getenv("HF_MODEL_ID", "meta-llama/Llama-3.1-8B-Instruct"))
+    ap.add_argument("--top-k", default="3", help="comma-separated top_k values")
+    ap.add_argument("--chunking", default="400:100", help="comma-separated chunk_size:overlap pairs (words)")
+    ap.add_argument("--limit", type=int, default=0, help="first N questions only")
+    ap.add_argument("--results", type=Path, default=RESULTS_FILE)
+    ap.add_argument("--no-save", action="store_true")
+    ap.add_argument("--compare", default=None, help="git ref whose stored results to diff against")
+    args = ap.parse_args()
+
+    os.environ["BACKEND"] = args.backend
+    records = kb_records()[: args.limit or None]
+    commit, dirty = git_commit()
+
+    bot = TechSupportChatbot(model_id=args.model)
+    engine = bot.deployments.active.model
+    stopwatch = Stopwatch()
+    if bot.reranker is not None:
+        bot.reranker = _Timed(bot.reranker, stopwatch, "rerank", ["rerank"])
+    model = _Timed(engine, stopwatch, "generate", ["generate", "generate_batch", "stream"])
+
+    results = []
+    for pair in args.chunking.split(","):
+        chunk_size, overlap = (int(x) for x in pair.split(":"))
+        store = TechSupportChatbot.build_store(chunk_size=chunk_size, overlap=overlap)
+        retriever = _Timed(store, stopwatch, "search", ["search_hits", "search_hits_batch"])
+        bot.deployments.swap(Deployment(retriever, model, args.model))
+        for top_k in (int(k) for k in args.top_k.split(",")):
+            config = {"backend": args.backend, "model": args.model, "chunk_size": chunk_size,
+                      "overlap": overlap, "top_k": top_k, "reranker": bot.reranker is not None}
+            results.append({"config": config, "metrics": evaluate(bot, stopwatch, records, top_k)})
+
+    baseline = {}
+    if args.compare:
+        ref = git_rev(args.compare)
+        for entry in load_results(args.results):
+            if entry["commit"] == ref:
+                baseline[json.dumps(entry["config"], sort_keys=True)] = entry["metrics"]  # latest run wins
+        print(f"comparing against {ref}: {len(baseline)} stored configurations")
+
+    print(f"commit {commit}{'+dirty' if dirty else ''}, {len(records)} questions, backend {args.backend}")
+    print(f"{'chunk':>9} {'k':>2} " + " ".join(f"{label:>8}" for _, label, _ in COLUMNS))
+    for r in results:
+        c, m = r["config"], r["metrics"]
+        print(f"{c['chunk_size']:>5}:{c['overlap']:<3} {c['top_k']:>2} "
+              + " ".join(f"{m[key]:>8{fmt}}" for key, _, fmt in COLUMNS))
+        base = baseline.get(json.dumps(c, sort_keys=True))
+        if base is not None:
+            print(f"{'delta':>12} " + " ".join(f"{m[key] - base[key]:>+8{fmt}}" for key, _, fmt in COLUMNS))
+
+    if not args.no_save:
+        args.results.parent.mkdir(parents=True, exist_ok=True)
+        with args.results.open("a", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps({"commit": commit, "dirty": dirty, "time": time.time(), **r}) + "\n")
+        print(f"appended {len(results)} results to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Prompt tokens per turn over a long troubleshooting session: raw history
+(last 6 turns verbatim) vs ConversationMemory (summary + clipped recent turns).
+Generation is stubbed with fixed-length answers/summaries, so this measures
+prompt size only.
+
+    python -m benchmarks.history_tokens --turns 40 --answer-words 700
+"""
+import argparse
+
+from inference import build_prompt
+from memory import ConversationMemory
+from benchmarks.common import kb_records, make_token_counter, percentile
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--turns", type=int, default=40)
+    ap.add_argument("--answer-words", type=int, default=700, help="~1024 tokens, the vLLM max_new_tokens")
+    ap.add_argument("--summary-words", type=int, default=120)
+    ap.add_argument("--keep-turns", type=int, default=4)
+    ap.add_argument("--answer-clip", type=int, default=120)
+    ap.add_argument("--tokenizer", default=None)
+    args = ap.parse_args()
+
+    count = make_token_counter(args.tokenizer)
+    questions = [p for p, _ in kb_records()]
+    answer = " ".join(["step"] * args.answer_words)
+    memory = ConversationMemory(
+        summarize=lambda prompt: " ".join(["note"] * args.summary_words),
+        keep_turns=args.keep_turns,
+        max_answer_words=args.answer_clip,
+    )
+    raw_history = []
+    context = ["(context chunk) " * 50] * 3
+
+    print(f"{'turn':>4} {'raw_tokens':>11} {'memory_tokens':>14}")
+    raw_sizes, mem_sizes = [], []
+    for turn in range(args.turns):
+        q = questions[turn % len(questions)]
+        raw_sizes.append(count(build_prompt(context, raw_history, q)))
+        memory.wait()  # summaries land between turns, as they would in a real session
+        summary, history = memory.prompt_view()
+        mem_sizes.append(count(build_prompt(context, history, q, summary=summary)))
+        raw_history.append((q, answer))
+        memory.add_turn(q, answer)
+        if turn % 5 == 0 or turn == args.turns - 1:
+            print(f"{turn + 1:>4} {raw_sizes[-1]:>11} {mem_sizes[-1]:>14}")
+
+    print(
+        f"\nraw: mean={sum(raw_sizes) / len(raw_sizes):.0f} max={max(raw_sizes)} p95={percentile(raw_sizes, 95):.0f}"
+        f"\nmemory: mean={sum(mem_sizes) / len(mem_sizes):.0f} max={max(mem_sizes)} p95={percentile(mem_sizes, 95):.0f}"
+        f"\nstored raw turns: baseline={len(raw_history)} memory={len(memory.history())}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Index memory, CPU query-encode latency and recall@k of lower-precision index
+storage and ONNX query embedders against the float32 / torch pipeline.
+
+    python -m benchmarks.index_quant --chunk-size 60 --overlap 20 --k 5
+"""
+import argparse
+import time
+
+from embedding import EMBED_BACKENDS, EMBED_MODEL, load_embedder
+from inference import INDEX_DTYPES, SimpleFaissStore, TechSupportChatbot
+from sample_text import KNOWLEDGE_BASE
+from benchmarks.common import kb_records, percentile
+
+
+def encode_latency(store: SimpleFaissStore, queries, repeats: int):
+    store.query_embedder.encode(queries[:1], show_progress_bar=False)  # warm-up
+    times = []
+    for _ in range(repeats):
+        for q in queries:
+            t0 = time.perf_counter()
+            store.query_embedder.encode([q], show_progress_bar=False, convert_to_numpy=True)
+            times.append((time.perf_counter() - t0) * 1000)
+    return times
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--chunk-size", type=int, default=60, help="small chunks give a bigger index to measure")
+    ap.add_argument("--overlap", type=int, default=20)
+    ap.add_argument("--k", type=int, default=5)
+    ap.add_argument("--repeats", type=int, default=3)
+    ap.add_argument("--backends", default=",".join(EMBED_BACKENDS))
+    args = ap.parse_args()
+
+    chunks = TechSupportChatbot._split_text(KNOWLEDGE_BASE, args.chunk_size, args.overlap)
+    queries = [p for p, _ in kb_records()]
+
+    # Reference: float32 index, torch query encoder
+    stores = {}
+    for dtype in INDEX_DTYPES:
+        store = SimpleFaissStore(EMBED_MODEL, index_dtype=dtype)
+        store.add_texts(chunks)
+        stores[dtype] = store
+    reference = {q: set(stores["float32"].search(q, k=args.k)) for q in queries}
+
+    print(f"chunks={len(chunks)} queries={len(queries)} k={args.k}")
+    print(f"{'index':>8} {'backend':>10} {'index_kb':>9} {'enc_p50_ms':>11} {'enc_p95_ms':>11} {'recall@k':>9}")
+    for backend in args.backends.split(","):
+        encoder = load_embedder(EMBED_MODEL, backend)
+        times = None
+        for dtype, store in stores.items():
+            store.query_embedder = encoder
+            if times is None:
+                times = encode_latency(store, queries, args.repeats)
+            recall = sum(len(reference[q] & set(store.search(q, k=args.k))) for q in queries) / (len(queries) * args.k)
+            print(
+                f"{dtype:>8} {backend:>10} {store.index_nbytes() / 1024:>9.1f} "
+                f"{percentile(times, 50):>11.2f} {percentile(times, 95):>11.2f} {recall:>9.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Throughput of chat turns on the stub engine (BACKEND=stub, no GPU), three ways:
+
+- sequential: one thread, retrieval then generation per turn
+- threads:    one thread per in-flight request (PIPELINE=0)
+- pipeline:   ChatPipeline stages (search -> prompt -> generate -> postprocess)
+
+Retrieval is the real index; --embed-call-ms / --embed-query-ms add a simulated
+query-encoder cost per encode call and per query, holding one device like a GPU
+embedder does, so batching shows up as it would on hardware. The stub engine
+serves one call at a time with --prefill-ms per prompt token and --token-ms
+per generated token. Each client is its own session.
+
+    python -m benchmarks.pipeline --clients 16 --turns 200 --embed-call-ms 20 --token-ms 0.3
+"""
+import argparse
+import os
+import threading
+import time
+from typing import Callable, List
+
+# Every turn reaches the encoder; the gate would skip some KB-derived questions
+os.environ.setdefault("RETRIEVAL_CACHE_SIZE", "0")
+os.environ.setdefault("RETRIEVAL_GATE", "0")
+os.environ.setdefault("HISTORY_SUMMARY", "0")
+os.environ["BACKEND"] = "stub"
+
+from hot_reload import Deployment  # noqa: E402
+from inference import TechSupportChatbot  # noqa: E402
+from pipeline import ChatPipeline  # noqa: E402
+from benchmarks.common import kb_records, percentile  # noqa: E402
+
+
+class SimulatedEncoderStore:
+    """The real store, plus `call_ms + query_ms * n` per encode call on one shared device."""
+
+    def __init__(self, store, call_ms: float, query_ms: float):
+        self._store = store
+        self._call_s = call_ms / 1000.0
+        self._query_s = query_ms / 1000.0
+        self._device = threading.Lock()
+        self.calls = 0
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
+
+    def _encode(self, n: int) -> None:
+        with self._device:
+            self.calls += 1
+            time.sleep(self._call_s + self._query_s * n)
+
+    def search_hits(self, query, **kwargs):
+        self._encode(1)
+        return self._store.search_hits(query, **kwargs)
+
+    def search_hits_batch(self, queries, **kwargs):
+        self._encode(len(queries))
+        return self._store.search_hits_batch(queries, **kwargs)
+
+
+def run_clients(clients: int, turns: int, questions: List[str], turn: Callable[[object, str], str], bot):
+    """`clients` closed-loop clients share `turns` turns. (wall seconds, per-turn latencies)"""
+    latencies: List[float] = []
+    lock = threading.Lock()
+    counter = iter(range(turns))
+
+    def client():
+        session = bot.new_session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            t0 = time.perf_counter()
+            turn(session, questions[i % len(questions)])
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--clients", type=int, default=16)
+    ap.add_argument("--turns", type=int, default=200)
+    ap.add_argument("--embed-call-ms", type=float, default=20.0)
+    ap.add_argument("--embed-query-ms", type=float, default=0.5)
+    ap.add_argument("--prefill-ms", type=float, default=0.01)
+    ap.add_argument("--token-ms", type=float, default=0.3)
+    ap.add_argument("--answer-words", type=int, default=48)
+    ap.add_argument("--search-batch", type=int, default=16)
+    ap.add_argument("--generate-workers", type=int, default=16)
+    args = ap.parse_args()
+
+    os.environ["STUB_PREFILL_MS"] = str(args.prefill_ms)
+    os.environ["STUB_TOKEN_MS"] = str(args.token_ms)
+    os.environ["STUB_ANSWER_WORDS"] = str(args.answer_words)
+    bot = TechSupportChatbot()
+    store = SimulatedEncoderStore(bot.deployments.active.retriever, args.embed_call_ms, args.embed_query_ms)
+    bot.deployments.swap(Deployment(store, bot.deployments.active.model, bot.deployments.active.model_id))
+    questions = [f"How do I fix this: {problem}?" for problem, _ in kb_records()]
+
+    pipeline = ChatPipeline(search_batch=args.search_batch, generate_workers=args.generate_workers,
+                            queue_size=max(64, args.clients))
+    modes = [
+        ("sequential", 1, lambda session, q: session.chat(q)),
+        ("threads", args.clients, lambda session, q: session.chat(q)),
+        ("pipeline", args.clients, lambda session, q: pipeline.submit(session, q).result()),
+    ]
+    print(f"{args.turns} turns, {args.clients} clients, encoder {args.embed_call_ms}+{args.embed_query_ms}/query ms, "
+          f"stub engine {args.prefill_ms} ms/prompt token + {args.token_ms} ms/token")
+    print(f"{'mode':<11} {'turns/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'encodes':>8}")
+    baseline = None
+    for name, clients, turn in modes:
+        calls = store.calls
+        wall, lat = run_clients(clients, args.turns, questions, turn, bot)
+        rate = len(lat) / wall
+        baseline = baseline or rate
+        print(f"{name:<11} {rate:>8.1f} {percentile(lat, 50) * 1000:>8.1f} {percentile(lat, 95) * 1000:>8.1f} "
+              f"{store.calls - calls:>8}   x{rate / baseline:.2f}")
+    print("pipeline stages:", pipeline.stats()["stages"])
+    pipeline.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Overhead of the profiling hooks (profiling.py), no GPU or model needed:
+
+- timed() / annotate() per call with tracing off (the production default) and on
+- SlowRequestLog start() + finish() per request
+- throughput of a CPU-bound workload while SamplingProfiler captures
+
+    python -m benchmarks.profiling --calls 1000000 --seconds 3
+"""
+import argparse
+import threading
+import time
+
+from profiling import SamplingProfiler, SlowRequestLog, annotate, timed
+
+# Hook calls on one /chat turn: search, embed, faiss, rerank, prompt, generate,
+# sched_wait, plus annotate() and the pipeline's queue/trace lookups
+HOOKS_PER_TURN = 12
+
+
+def per_call_ns(fn, calls: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - t0) / calls * 1e9
+
+
+def hook_costs(calls: int):
+    def bare():
+        pass
+
+    def hook():
+        with timed("stage"):
+            pass
+
+    def note():
+        annotate(prompt_tokens=1)
+
+    base = per_call_ns(bare, calls)
+    off = per_call_ns(hook, calls) - base
+    off_note = per_call_ns(note, calls) - base
+    log = SlowRequestLog(threshold_ms=1e9)
+    log.start("bench")
+    on = per_call_ns(hook, calls) - base
+    on_note = per_call_ns(note, calls) - base
+
+    def request():
+        log.finish(log.start("bench"))
+
+    request_ns = per_call_ns(request, calls // 10)
+    return off, off_note, on, on_note, request_ns
+
+
+def spin(stop: threading.Event, counts: list, i: int) -> None:
+    n = 0
+    while not stop.is_set():
+        sum(range(200))
+        n += 1
+    counts[i] = n
+
+
+def workload_rate(seconds: float, threads: int, profiler=None, interval_ms: float = 5.0) -> float:
+    """Loop iterations per second across `threads` spinning threads, optionally under a capture."""
+    stop = threading.Event()
+    counts = [0] * threads
+    workers = [threading.Thread(target=spin, args=(stop, counts, i), name=f"spin-{i}") for i in range(threads)]
+    for t in workers:
+        t.start()
+    t0 = time.perf_counter()
+    if profiler is not None:
+        profiler.capture(seconds, interval_ms)
+    else:
+        time.sleep(seconds)
+    stop.set()
+    for t in workers:
+        t.join()
+    return sum(counts) / (time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--calls", type=int, default=1_000_000)
+    ap.add_argument("--seconds", type=float, default=3.0)
+    ap.add_argument("--threads", type=int, default=4)
+    args = ap.parse_args()
+
+    off, off_note, on, on_note, request_ns = hook_costs(args.calls)
+    print("per call (ns)      tracing off   tracing on")
+    print(f"timed()            {off:>11.0f}   {on:>10.0f}")
+    print(f"annotate()         {off_note:>11.0f}   {on_note:>10.0f}")
+    print(f"~{HOOKS_PER_TURN} hooks per turn, tracing off: {HOOKS_PER_TURN * max(off, off_note) / 1000:.2f} us")
+    print(f"slow log start+finish per traced request: {request_ns / 1000:.2f} us")
+
+    base = workload_rate(args.seconds, args.threads)
+    print(f"\nCPU-bound workload, {args.threads} threads: {base:,.0f} it/s without capture")
+    for interval in (10.0, 5.0, 1.0):
+        profiler = SamplingProfiler()
+        rate = workload_rate(args.seconds, args.threads, profiler, interval)
+        # Sampling holds the GIL while it walks stacks: its busy share is the cost to the service
+        per_sample = profiler.last_busy_s / max(1, profiler.last_samples) * 1e6
+        share = 100 * profiler.last_busy_s / args.seconds
+        print(f"  capturing every {interval:>4.0f} ms: {rate:,.0f} it/s ({100 * (rate / base - 1):+.1f}%), "
+              f"{profiler.last_samples} samples at {per_sample:.0f} us = {share:.1f}% of the capture")
+
+
+if __name__ == "__main__":
+    main()
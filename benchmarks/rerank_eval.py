@@ -0,0 +1,76 @@
+"""
+Prompt-token cost of dense retrieval vs dense + cross-encoder rerank at equal
+answer-context recall, over the Problem/Solution records of the bundled KB.
+
+    python -m benchmarks.rerank_eval --baseline-k 3 --candidates 10
+"""
+import argparse
+import time
+
+from inference import EMBED_MODEL, SimpleFaissStore, TechSupportChatbot, build_prompt
+from reranker import DEFAULT_RERANK_MODEL, CrossEncoderReranker
+from sample_text import KNOWLEDGE_BASE
+from benchmarks.common import contains, first_step, kb_records, make_token_counter, percentile
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rerank-model", default=DEFAULT_RERANK_MODEL)
+    ap.add_argument("--candidates", type=int, default=10)
+    ap.add_argument("--baseline-k", type=int, default=3)
+    ap.add_argument("--budget-ms", type=float, default=150.0)
+    ap.add_argument("--chunk-size", type=int, default=400)
+    ap.add_argument("--overlap", type=int, default=100)
+    ap.add_argument("--tokenizer", default=None, help="HF tokenizer id for exact token counts")
+    args = ap.parse_args()
+
+    count = make_token_counter(args.tokenizer)
+    store = SimpleFaissStore(EMBED_MODEL)
+    store.add_texts(TechSupportChatbot._split_text(KNOWLEDGE_BASE, args.chunk_size, args.overlap))
+    reranker = CrossEncoderReranker(args.rerank_model)
+
+    records = kb_records()
+    n = max(args.candidates, args.baseline_k)
+    dense_runs, rerank_runs, rerank_ms = [], [], []
+    for problem, solution in records:
+        query = f"How do I fix this: {problem}?"
+        dense = store.search(query, k=n)
+        t0 = time.perf_counter()
+        reranked = reranker.rerank(query, dense, top_k=n, budget_ms=float("inf"))
+        rerank_ms.append((time.perf_counter() - t0) * 1000)
+        snippet = first_step(solution)
+        dense_runs.append((query, dense, snippet))
+        rerank_runs.append((query, reranked, snippet))
+
+    def at_k(runs, k):
+        hits = sum(contains(ctx[:k], snip) for _, ctx, snip in runs)
+        tokens = sum(count(build_prompt(ctx[:k], [], q)) for q, ctx, _ in runs)
+        return hits / len(runs), tokens / len(runs)
+
+    print(f"queries={len(records)} chunks={len(store.texts)} candidates={n}")
+    print(f"{'k':>3} {'dense_recall':>13} {'dense_tokens':>13} {'rerank_recall':>14} {'rerank_tokens':>14}")
+    table = {}
+    for k in range(1, n + 1):
+        dr, dt = at_k(dense_runs, k)
+        rr, rt = at_k(rerank_runs, k)
+        table[k] = (dr, dt, rr, rt)
+        print(f"{k:>3} {dr:>13.3f} {dt:>13.1f} {rr:>14.3f} {rt:>14.1f}")
+
+    target, base_tokens = table[args.baseline_k][0], table[args.baseline_k][1]
+    match = next((k for k in range(1, n + 1) if table[k][2] >= target), None)
+    print(f"\nbaseline: dense top-{args.baseline_k} recall={target:.3f} prompt_tokens={base_tokens:.1f}")
+    if match is None:
+        print("rerank never reaches baseline recall within the candidate set")
+    else:
+        saved = 1.0 - table[match][3] / base_tokens
+        print(f"rerank top-{match} recall={table[match][2]:.3f} prompt_tokens={table[match][3]:.1f} ({saved:+.1%} saved)")
+
+    over = sum(ms > args.budget_ms for ms in rerank_ms)
+    print(
+        f"rerank latency p50={percentile(rerank_ms, 50):.1f}ms p95={percentile(rerank_ms, 95):.1f}ms "
+        f"over {args.budget_ms:.0f}ms budget: {over}/{len(rerank_ms)}"
+    )
+
+
+if __name__ == "__main__":
+    main()
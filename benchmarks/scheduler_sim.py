@@ -0,0 +1,100 @@
+"""
+Tail latency under mixed load on a fake engine (no GPU), FIFO vs. the
+priority / fair-queueing scheduler:
+
+- several interactive users ask short questions with think time in between;
+- one "hammer" tenant keeps many long interactive requests in flight;
+- a bulk job keeps submitting large batches.
+
+    python -m benchmarks.scheduler_sim --seconds 20 --users 8 --hammer 6
+"""
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+
+from generation import GenerationOverrides
+from scheduler import JobInfo, Scheduler, expected_cost
+from benchmarks.common import percentile
+
+
+class FakeEngine:
+    """One job at a time; runtime = prompt tokens * prefill_ms + output tokens * decode_ms."""
+
+    def __init__(self, prefill_ms: float, decode_ms: float):
+        self.prefill_s = prefill_ms / 1000.0
+        self.decode_s = decode_ms / 1000.0
+        self._lock = threading.Lock()
+
+    def run(self, prompt_chars: int, out_tokens: int) -> None:
+        with self._lock:
+            time.sleep(prompt_chars / 4 * self.prefill_s + out_tokens * self.decode_s)
+
+
+# (priority, prompt chars, max_tokens, typical output tokens)
+PROFILES = {
+    "user": ("interactive", 1500, 256, 120),
+    "hammer": ("interactive", 6000, 1024, 700),
+    "bulk": ("bulk", 24000, 512, 300),
+}
+
+
+def simulate(policy: str, args) -> dict:
+    engine = FakeEngine(args.prefill_ms, args.decode_ms)
+    sched = Scheduler(slots=1, policy=policy, max_wait_s=args.max_wait_s)
+    latencies = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.seconds
+
+    def client(group: str, tenant: str, think_s: float, seed: int):
+        rng = random.Random(seed)
+        priority, chars, max_tokens, typical = PROFILES[group]
+        info = JobInfo(priority, tenant)
+        while time.monotonic() < deadline:
+            prompt_chars = int(chars * rng.uniform(0.7, 1.3))
+            out = min(max_tokens, max(1, int(rng.expovariate(1.0 / typical))))
+            cost = expected_cost(["x" * prompt_chars], 1, GenerationOverrides(max_tokens=max_tokens), args.expected)
+            t0 = time.perf_counter()
+            with sched.slot(cost, info=info):
+                engine.run(prompt_chars, out)
+            with lock:
+                latencies[group].append((time.perf_counter() - t0) * 1000)
+            time.sleep(rng.uniform(0.5, 1.5) * think_s)
+
+    think_s = args.think_ms / 1000
+    threads = [threading.Thread(target=client, args=("user", f"user-{i}", think_s, i)) for i in range(args.users)]
+    threads += [threading.Thread(target=client, args=("hammer", "hammer", 0.0, 100 + i)) for i in range(args.hammer)]
+    threads += [threading.Thread(target=client, args=("bulk", "bulk", 0.0, 200))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seconds", type=float, default=20.0)
+    ap.add_argument("--users", type=int, default=8)
+    ap.add_argument("--hammer", type=int, default=6, help="concurrent requests kept in flight by one tenant")
+    ap.add_argument("--think-ms", type=float, default=300.0)
+    ap.add_argument("--prefill-ms", type=float, default=0.005, help="per prompt token")
+    ap.add_argument("--decode-ms", type=float, default=0.1, help="per output token")
+    ap.add_argument("--expected", type=int, default=256, help="expected output tokens when max_tokens is larger")
+    ap.add_argument("--max-wait-s", type=float, default=5.0)
+    args = ap.parse_args()
+
+    print(f"{'policy':>6} {'group':>7} {'done':>5} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8}")
+    for policy in ("fifo", "fair"):
+        latencies = simulate(policy, args)
+        for group in PROFILES:
+            lat = latencies[group]
+            print(
+                f"{policy:>6} {group:>7} {len(lat):>5} {percentile(lat, 50):>8.0f} "
+                f"{percentile(lat, 95):>8.0f} {percentile(lat, 99):>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
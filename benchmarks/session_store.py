@@ -0,0 +1,94 @@
+"""
+Write throughput and latency added to the reply path by session persistence:
+write-behind SessionStore.put() vs a synchronous encode + commit per turn.
+
+    python -m benchmarks.session_store --sessions 200 --turns 20 --threads 8
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from session_store import SessionStore, encode_session
+from benchmarks.common import kb_records, percentile
+
+
+def run(put, sessions: int, turns: int, threads: int, answer: str):
+    questions = [p for p, _ in kb_records()]
+    latencies = [[] for _ in range(threads)]
+
+    def worker(w: int):
+        for sid in range(w, sessions, threads):
+            history = []
+            for t in range(turns):
+                history.append((questions[(sid + t) % len(questions)], answer))
+                t0 = time.perf_counter()
+                put(f"session-{sid}", "summary of earlier turns " * 10, history[-8:])
+                latencies[w].append((time.perf_counter() - t0) * 1e6)
+
+    ts = [threading.Thread(target=worker, args=(w,)) for w in range(threads)]
+    start = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return [x for lat in latencies for x in lat], start
+
+
+def report(name, lat, elapsed, n):
+    print(
+        f"{name:>13}: put p50={percentile(lat, 50):8.1f}us p99={percentile(lat, 99):8.1f}us "
+        f"max={max(lat):9.1f}us | {n / elapsed:8.0f} snapshots/s"
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sessions", type=int, default=200)
+    ap.add_argument("--turns", type=int, default=20)
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--answer-words", type=int, default=250)
+    args = ap.parse_args()
+
+    answer = " ".join(["restart the service and check the event log"] * (args.answer_words // 8))
+    n = args.sessions * args.turns
+    tmp = tempfile.mkdtemp()
+
+    store = SessionStore(os.path.join(tmp, "behind.db"))
+    lat, start = run(store.put, args.sessions, args.turns, args.threads, answer)
+    store.flush()
+    report("write-behind", lat, time.perf_counter() - start, n)
+    stats = store.stats()
+    print(
+        f"{'':>13}  {stats['batches']} transactions for {n} updates "
+        f"({stats['writes']} rows after coalescing), {stats['bytes_written'] / max(stats['writes'], 1):.0f} B/row"
+    )
+    store.close()
+
+    # Baseline: encode and commit inline on the request thread
+    sync_path = os.path.join(tmp, "sync.db")
+    SessionStore(sync_path).close()  # creates the schema
+    local = threading.local()
+    lock = threading.Lock()
+
+    def sync_put(sid, summary, turns):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = sqlite3.connect(sync_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+        blob = encode_session(summary, turns)
+        with lock, conn:
+            conn.execute(
+                "INSERT INTO sessions (id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (sid, blob, time.time()),
+            )
+
+    lat, start = run(sync_put, args.sessions, args.turns, args.threads, answer)
+    report("synchronous", lat, time.perf_counter() - start, n)
+
+
+if __name__ == "__main__":
+    main()
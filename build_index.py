@@ -0,0 +1,31 @@
+"""
+Build the retrieval index once and write it to disk, so uvicorn workers can
+memory-map a single shared copy instead of each embedding the KB at startup.
+
+    python build_index.py --output knowledge_base/index
+    INDEX_PATH=knowledge_base/index uvicorn app:app --workers 4
+"""
+import argparse
+import os
+from pathlib import Path
+
+from embedding import RemoteEmbedder
+from inference import TechSupportChatbot
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--output", default=os.getenv("INDEX_PATH", "knowledge_base/index"))
+    args = ap.parse_args()
+
+    embed_server = os.getenv("EMBED_SERVER")
+    store = TechSupportChatbot.build_store(embedder=RemoteEmbedder(embed_server) if embed_server else None)
+    store.save(Path(args.output))
+    print(
+        f"wrote {len(store.texts)} chunks ({store.index_dtype}, {store.index_nbytes() / 1024:.0f} KiB vectors, "
+        f"{store.texts.nbytes() / 1024:.0f} KiB text, version {store.version}) to {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
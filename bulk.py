@@ -0,0 +1,114 @@
+"""
+Offline bulk drafting of replies for queued support tickets.
+
+    python bulk.py --input tickets.jsonl --output drafts.jsonl --batch-size 64
+
+Input is JSONL with an id and a text field per ticket. Retrieval for all
+pending tickets runs as one batched embed/search pass, prompts are sorted by
+length and sent to the engine in large batches, and every finished batch is
+appended to the output JSONL. Re-running with the same output skips tickets
+that already have a draft, so an interrupted job resumes where it stopped.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Set
+
+from inference import DEFAULT_MODEL_ID, TechSupportChatbot, build_prompt
+from scheduler import set_job
+
+
+def load_done_ids(path: Path, id_field: str) -> Set[str]:
+    done: Set[str] = set()
+    if not path.exists():
+        return done
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)[id_field]))
+            except (ValueError, KeyError):
+                continue  # torn line from an interrupted write
+    return done
+
+
+def load_pending(path: Path, id_field: str, text_field: str, done: Set[str]) -> List[Dict]:
+    pending = []
+    with path.open("r", encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            ticket = json.loads(line)
+            if id_field not in ticket or not str(ticket.get(text_field, "")).strip():
+                print(f"skipping line {lineno}: missing {id_field!r} or {text_field!r}", file=sys.stderr)
+                continue
+            if str(ticket[id_field]) not in done:
+                pending.append(ticket)
+    return pending
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--input", required=True, type=Path)
+    ap.add_argument("--output", required=True, type=Path)
+    ap.add_argument("--id-field", default="id")
+    ap.add_argument("--text-field", default="text")
+    ap.add_argument("--batch-size", type=int, default=64, help="prompts per engine call")
+    ap.add_argument("--top-k", type=int, default=int(os.getenv("RETRIEVAL_TOP_K", "3")))
+    args = ap.parse_args()
+
+    done = load_done_ids(args.output, args.id_field)
+    pending = load_pending(args.input, args.id_field, args.text_field, done)
+    print(f"{len(done)} already drafted, {len(pending)} pending", file=sys.stderr)
+    if not pending:
+        return
+
+    bot = TechSupportChatbot(model_id=os.getenv("HF_MODEL_ID", DEFAULT_MODEL_ID), top_k=args.top_k)
+    set_job("bulk", "bulk.py")
+
+    t0 = time.perf_counter()
+    queries = [str(t[args.text_field]).strip() for t in pending]
+    contexts = bot.retrieve_batch(queries)
+    prompts = [build_prompt(ctx, [], q) for ctx, q in zip(contexts, queries)]
+    print(f"retrieval: {len(queries)} tickets in {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+
+    # Similar-length prompts together: less padding (HF) and more even batches (vLLM)
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+
+    # A torn last line from a killed run must not swallow the next record
+    if args.output.exists() and args.output.stat().st_size > 0:
+        with args.output.open("rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+    else:
+        needs_newline = False
+
+    written, words = 0, 0
+    gen_start = time.perf_counter()
+    with args.output.open("a", encoding="utf-8") as out:
+        if needs_newline:
+            out.write("\n")
+        for start in range(0, len(order), args.batch_size):
+            batch = order[start: start + args.batch_size]
+            replies = bot.model.generate_batch([prompts[i] for i in batch])
+            for i, candidates in zip(batch, replies):
+                reply = bot.clip_turn(candidates[0])
+                out.write(json.dumps({args.id_field: pending[i][args.id_field], "reply": reply}) + "\n")
+                words += len(reply.split())
+            out.flush()
+            written += len(batch)
+
+            elapsed = time.perf_counter() - gen_start
+            print(
+                f"[{written}/{len(order)}] {written / elapsed:.2f} tickets/s, "
+                f"{words / elapsed:.1f} words/s, elapsed {elapsed:.0f}s",
+                file=sys.stderr,
+            )
+
+    print(f"done: {written} drafts in {time.perf_counter() - t0:.1f}s -> {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import threading
+from typing import Dict, Optional
+
+
+class GenerationCancelled(Exception):
+    """Raised by an engine when the request's CancelToken fired (client went away)."""
+
+
+class CancelToken:
+    """
+    Set by the API layer when the client disconnects; engines poll it between
+    decode steps (vLLM abort, HF stopping criterion) and while queued for the
+    engine lock.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def cancel(self) -> None:
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set()
+
+
+class CancellationStats:
+    """
+    Work avoided by cancellation. `tokens_saved` is the unspent max_tokens
+    budget of cancelled requests, so it is an upper bound: some would have hit
+    EOS earlier anyway.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.dequeued = 0
+        self.aborted = 0
+        self.tokens_generated = 0
+        self.tokens_saved = 0
+
+    def record(self, generated: int, budget: int, started: bool) -> None:
+        with self._lock:
+            if started:
+                self.aborted += 1
+            else:
+                self.dequeued += 1
+            self.tokens_generated += generated
+            self.tokens_saved += max(0, budget - generated)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "dequeued": self.dequeued,
+                "aborted": self.aborted,
+                "tokens_generated_before_abort": self.tokens_generated,
+                "tokens_saved_upper_bound": self.tokens_saved,
+            }
+
+
+CANCEL_STATS = CancellationStats()
+
+
+def acquire_or_cancel(
+    lock: threading.Lock,
+    cancel: Optional[CancelToken],
+    budget: int,
+    poll: float = 0.05,
+) -> None:
+    """
+    lock.acquire() for a request waiting its turn on the engine. If the request
+    is cancelled before it gets the lock it is dropped from the queue
+    (GenerationCancelled) without ever reaching the engine.
+    """
+    if cancel is None:
+        lock.acquire()
+        return
+    while not lock.acquire(timeout=poll):
+        if cancel.cancelled:
+            CANCEL_STATS.record(0, budget, started=False)
+            raise GenerationCancelled()
+    if cancel.cancelled:
+        lock.release()
+        CANCEL_STATS.record(0, budget, started=False)
+        raise GenerationCancelled()
@@ -0,0 +1,122 @@
+import mmap
+from pathlib import Path
+from typing import Iterable, Optional, Sequence, Union
+
+import numpy as np
+
+
+# Bytes of a new chunk used to look for where it starts inside the previous
+# one; overlaps shorter than this are simply stored twice
+_PROBE = 32
+
+
+class ChunkStore(Sequence):
+    """
+    Chunk texts as (start, end) byte spans into one contiguous UTF-8 buffer,
+    instead of one Python str per chunk.
+
+    extend() stores only what the previous chunk doesn't already end with, so
+    sliding-window chunks (each starting inside the one before) rebuild the
+    source document once and their overlaps are not stored twice. Chunks that
+    don't overlap are simply concatenated.
+
+    open() memory-maps a buffer/offsets pair written by save() read-only, so
+    every worker shares the same page-cache pages.
+    """
+
+    def __init__(self):
+        self._buf: Union[bytearray, mmap.mmap, bytes] = bytearray()
+        self._set_spans(np.zeros((0, 2), dtype=np.int64))
+        self._read_only = False
+
+    def _set_spans(self, spans: np.ndarray) -> None:
+        # Flat int view: indexing it yields plain ints, far cheaper than numpy
+        # scalars. Set before _spans so a concurrent reader never indexes past it.
+        self._flat = memoryview(np.ascontiguousarray(spans, dtype=np.int64).reshape(-1)).cast("B").cast("q")
+        self._spans = spans
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str]) -> "ChunkStore":
+        store = cls()
+        store.extend(texts)
+        return store
+
+    @classmethod
+    def open(cls, data_path: Path, offsets_path: Path) -> "ChunkStore":
+        """
+        Map a save()d store. `offsets_path` holds (N, 2) start/end pairs; the
+        older (N + 1,) cumulative offsets of back-to-back chunks are accepted too.
+        """
+        store = cls()
+        offsets = np.load(offsets_path, mmap_mode="r")
+        if offsets.ndim == 1:
+            offsets = np.stack([offsets[:-1], offsets[1:]], axis=1)
+        store._set_spans(offsets)
+        store._buf = b""
+        if Path(data_path).stat().st_size > 0:
+            with open(data_path, "rb") as f:
+                store._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        store._read_only = True
+        return store
+
+    def __len__(self) -> int:
+        return len(self._spans)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        flat = self._flat
+        return self._buf[flat[2 * i]: flat[2 * i + 1]].decode("utf-8")
+
+    def extend(self, texts: Iterable[str]) -> None:
+        if self._read_only:
+            raise RuntimeError("chunk store is memory-mapped read-only")
+        buf = self._buf
+        prev_start = int(self._spans[-1, 0]) if len(self._spans) else len(buf)
+        spans = []
+        for text in texts:
+            data = text.encode("utf-8")
+            start = self._overlap_start(buf, prev_start, data)
+            if start is None:
+                start = len(buf)
+                buf += data
+            else:
+                buf += data[len(buf) - start:]
+            spans.append((start, start + len(data)))
+            prev_start = start
+        if spans:
+            self._set_spans(np.concatenate([self._spans, np.asarray(spans, dtype=np.int64)]))
+
+    @staticmethod
+    def _overlap_start(buf: bytearray, prev_start: int, data: bytes) -> Optional[int]:
+        """
+        Earliest offset in the last chunk where `data` starts: either the
+        buffer tail from there is a prefix of `data`, or `data` lies entirely
+        inside the chunk.
+        """
+        if not data:
+            return None
+        probe = data[:_PROBE]
+        pos = buf.find(probe, prev_start)
+        while pos != -1:
+            tail = len(buf) - pos
+            if buf[pos: pos + len(data)] == data[:tail]:
+                return pos
+            pos = buf.find(probe, pos + 1)
+        return None
+
+    def save(self, data_path: Path, offsets_path: Path) -> None:
+        Path(data_path).write_bytes(bytes(self._buf))
+        np.save(offsets_path, np.asarray(self._spans, dtype=np.int64))
+
+    def nbytes(self) -> int:
+        """Text buffer plus span array."""
+        return len(self._buf) + int(self._spans.nbytes)
+
+    def text_bytes(self) -> int:
+        """UTF-8 size of all chunks if each were stored separately."""
+        return int((self._spans[:, 1] - self._spans[:, 0]).sum()) if len(self._spans) else 0
@@ -0,0 +1,146 @@
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+
+@dataclass(frozen=True)
+class DegradationLevel:
+    """
+    What a request is allowed to cost. None means "use the normal setting".
+    """
+    level: int
+    name: str
+    max_tokens: Optional[int] = None
+    top_k: Optional[int] = None
+    history_turns: Optional[int] = None
+    rerank: bool = True
+    retrieval_only: bool = False
+    # Dense search may be served from a cached search of the same query with a
+    # larger k (its top hits) instead of encoding and searching again
+    reuse_cached: bool = False
+
+
+LEVELS = (
+    DegradationLevel(0, "full"),
+    DegradationLevel(1, "reduced", max_tokens=512, history_turns=4),
+    # From here on the rerank stage is skipped and dense results are taken from any
+    # cached search of the query, e.g. the over-fetched candidates of a full-level turn
+    DegradationLevel(2, "lean", max_tokens=256, top_k=2, history_turns=2, rerank=False, reuse_cached=True),
+    DegradationLevel(3, "minimal", max_tokens=128, top_k=1, history_turns=0, rerank=False, reuse_cached=True),
+    DegradationLevel(4, "retrieval_only", history_turns=0, rerank=False, retrieval_only=True, reuse_cached=True),
+)
+FULL = LEVELS[0]
+
+
+def retrieval_only_answer(chunks: Sequence[str], max_words: int = 80) -> str:
+    """Reply used at the last level: relevant KB excerpts, no generation."""
+    if not chunks:
+        return (
+            "We're handling a very high number of requests right now and couldn't find a "
+            "matching knowledge base article. Please try again in a few minutes."
+        )
+    lines = []
+    for c in chunks:
+        words = c.split()
+        excerpt = " ".join(words[:max_words]) + (" …" if len(words) > max_words else "")
+        lines.append(f"- {excerpt}")
+    return (
+        "We're handling a very high number of requests right now, so here are the most "
+        "relevant knowledge base articles for your question:\n\n" + "\n\n".join(lines)
+    )
+
+
+class LoadMonitor:
+    """
+    Live load signals: requests currently in flight (running or waiting for
+    the engine), an EWMA of end-to-end latency, and the mean age of the
+    requests still in flight. The EWMA only moves when a request completes,
+    so when the engine stalls, the in-flight age is what shows it.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.in_flight = 0
+        self.ewma_latency_ms = 0.0
+        self._start_sum = 0.0  # sum of in-flight start times: mean age in O(1)
+        self._lock = threading.Lock()
+
+    def in_flight_age_ms(self) -> float:
+        now = time.perf_counter()
+        with self._lock:
+            if not self.in_flight:
+                return 0.0
+            return (now - self._start_sum / self.in_flight) * 1000
+
+    def latency_ms(self) -> float:
+        """Latency signal: the EWMA of completed requests or, if worse, the in-flight mean age."""
+        return max(self.ewma_latency_ms, self.in_flight_age_ms())
+
+    @contextmanager
+    def track(self):
+        start = time.perf_counter()
+        with self._lock:
+            self.in_flight += 1
+            self._start_sum += start
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self.in_flight -= 1
+                self._start_sum = self._start_sum - start if self.in_flight else 0.0
+                if self.ewma_latency_ms == 0.0:
+                    self.ewma_latency_ms = elapsed
+                else:
+                    self.ewma_latency_ms += self.alpha * (elapsed - self.ewma_latency_ms)
+
+
+class DegradationPolicy:
+    """
+    Picks a level from the worse of two signals:
+      - queue depth: one level per threshold in `queue_thresholds` reached
+      - latency: EWMA (or in-flight mean age, if higher) over the SLO by
+        1x / 1.5x / 2x adds 1 / 2 / 3 levels
+    """
+
+    def __init__(
+        self,
+        monitor: LoadMonitor,
+        slo_ms: float = 10000.0,
+        queue_thresholds: Sequence[int] = (4, 8, 16, 32),
+        max_level: int = len(LEVELS) - 1,
+        enabled: bool = True,
+    ):
+        self.monitor = monitor
+        self.slo_ms = slo_ms
+        self.queue_thresholds = sorted(queue_thresholds)
+        self.max_level = min(max_level, len(LEVELS) - 1)
+        self.enabled = enabled
+        self.counts: List[int] = [0] * len(LEVELS)
+        self._lock = threading.Lock()
+
+    def current(self) -> DegradationLevel:
+        level = 0
+        if self.enabled:
+            depth = self.monitor.in_flight
+            queue_level = sum(depth >= t for t in self.queue_thresholds)
+            ratio = self.monitor.latency_ms() / self.slo_ms if self.slo_ms > 0 else 0.0
+            latency_level = 3 if ratio >= 2.0 else 2 if ratio >= 1.5 else 1 if ratio >= 1.0 else 0
+            level = min(max(queue_level, latency_level), self.max_level)
+        with self._lock:
+            self.counts[level] += 1
+        return LEVELS[level]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            served = {lvl.name: self.counts[lvl.level] for lvl in LEVELS}
+        return {
+            "enabled": self.enabled,
+            "in_flight": self.monitor.in_flight,
+            "ewma_latency_ms": round(self.monitor.ewma_latency_ms, 1),
+            "in_flight_age_ms": round(self.monitor.in_flight_age_ms(), 1),
+            "slo_ms": self.slo_ms,
+            "served_by_level": served,
+        }
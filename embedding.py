@@ -0,0 +1,289 @@
+"""
+Sentence embedders for retrieval, local or served by one shared process.
+
+Running several uvicorn workers would otherwise load one embedder per worker.
+Start a single embedding server and point the workers at it with EMBED_SERVER:
+
+    python embedding.py --address /tmp/embedder.sock
+    EMBED_SERVER=/tmp/embedder.sock uvicorn app:app --workers 4
+
+The server unpickles what clients send, so every connection must know the
+authkey. A host:port address requires EMBED_SERVER_KEY. A Unix socket without
+one gets a random key in "<socket>.key" (mode 0600, like the socket itself),
+so only the user running the server can connect.
+"""
+import argparse
+import os
+import secrets
+from multiprocessing.managers import BaseManager
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# Query-side embedder: "torch" (default), "onnx" (fp32 ONNX Runtime) or
+# "onnx-int8" (dynamically quantized ONNX export shipped on the HF hub).
+EMBED_BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_INT8_FILE = os.getenv("EMBED_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+
+EMBED_SERVER_KEY: Optional[bytes] = os.getenv("EMBED_SERVER_KEY", "").encode("utf-8") or None
+
+
+EMBED_DEVICES = ("auto", "cpu", "cuda", "mps")
+EMBED_PRECISIONS = ("auto", "fp32", "fp16", "bf16")
+
+
+def pick_device(preferred: str = "auto") -> str:
+    if preferred != "auto":
+        return preferred
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def pick_precision(device: str, preferred: str = "auto") -> str:
+    if preferred != "auto":
+        return preferred
+    # Half precision is a free ~2x on GPU; on CPU fp32 is usually fastest
+    return "fp16" if device in ("cuda", "mps") else "fp32"
+
+
+class EmbeddingService:
+    """
+    SentenceTransformer with the device, precision and CPU thread count chosen
+    for the hardware, plus length-sorted macro-batching for bulk ingestion.
+    encode() keeps the SentenceTransformer signature, so it drops in anywhere
+    an embedder is expected.
+    """
+
+    def __init__(
+        self,
+        emb_model: str = EMBED_MODEL,
+        backend: str = "torch",
+        device: str = "auto",
+        precision: str = "auto",
+        threads: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        macro_batch: int = 2048,
+    ):
+        if backend not in EMBED_BACKENDS:
+            raise ValueError(f"unknown embed backend {backend!r}, expected one of {EMBED_BACKENDS}")
+        if device not in EMBED_DEVICES:
+            raise ValueError(f"unknown embed device {device!r}, expected one of {EMBED_DEVICES}")
+        if precision not in EMBED_PRECISIONS:
+            raise ValueError(f"unknown embed precision {precision!r}, expected one of {EMBED_PRECISIONS}")
+        self.model_id = emb_model
+        self.backend = backend
+        self.device = pick_device(device)
+        # ONNX exports run at the precision they were exported/quantized with
+        self.precision = pick_precision(self.device, precision) if backend == "torch" else "fp32"
+        self.threads = threads
+        self.batch_size = batch_size or (128 if self.device != "cpu" else 32)
+        self.macro_batch = max(self.batch_size, macro_batch)
+
+        if threads and self.device == "cpu":
+            # Process-wide; with several workers on one pod use cores / workers
+            torch.set_num_threads(threads)
+        if backend == "torch":
+            self.model = SentenceTransformer(emb_model, device=self.device)
+            if self.precision == "fp16":
+                self.model.half()
+            elif self.precision == "bf16":
+                self.model.to(torch.bfloat16)
+        else:
+            model_kwargs = {"file_name": ONNX_INT8_FILE} if backend == "onnx-int8" else {}
+            if self.device == "cuda":
+                model_kwargs["provider"] = "CUDAExecutionProvider"
+            if threads:
+                import onnxruntime as ort
+                options = ort.SessionOptions()
+                options.intra_op_num_threads = threads
+                model_kwargs["session_options"] = options
+            self.model = SentenceTransformer(emb_model, backend="onnx", model_kwargs=model_kwargs or None)
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        show_progress_bar: Optional[bool] = None,
+        convert_to_numpy: bool = True,
+        **kwargs,
+    ) -> np.ndarray:
+        embs = self.model.encode(
+            sentences,
+            batch_size=batch_size or self.batch_size,
+            show_progress_bar=bool(show_progress_bar),
+            convert_to_numpy=True,
+            **kwargs,
+        )
+        # Callers (FAISS) expect fp32 whatever the compute precision
+        return embs.astype(np.float32, copy=False)
+
+    def encode_corpus(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        """
+        Bulk encode for ingestion. Texts are sorted by length across the whole
+        corpus (SentenceTransformer only sorts within a call) and fed in macro
+        batches, so padding stays low and peak memory is bounded by
+        `macro_batch` instead of the corpus size. Rows come back in input order.
+        """
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        order = np.argsort([len(t) for t in texts], kind="stable")[::-1]
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i in range(0, len(order), self.macro_batch):
+            idx = order[i: i + self.macro_batch]
+            out[idx] = self.encode([texts[j] for j in idx], batch_size=batch_size)
+        return out
+
+    @property
+    def dim(self) -> int:
+        return self.model.get_sentence_embedding_dimension()
+
+    def info(self) -> dict:
+        return {
+            "model_id": self.model_id,
+            "backend": self.backend,
+            "device": self.device,
+            "precision": self.precision,
+            "threads": self.threads or torch.get_num_threads(),
+            "batch_size": self.batch_size,
+            "dim": self.dim,
+        }
+
+
+def load_embedder(emb_model: str, backend: str = "torch") -> EmbeddingService:
+    """EmbeddingService configured from EMBED_DEVICE / EMBED_PRECISION / EMBED_THREADS / EMBED_BATCH_SIZE."""
+    threads = os.getenv("EMBED_THREADS")
+    batch_size = os.getenv("EMBED_BATCH_SIZE")
+    return EmbeddingService(
+        emb_model,
+        backend,
+        device=os.getenv("EMBED_DEVICE", "auto"),
+        precision=os.getenv("EMBED_PRECISION", "auto"),
+        threads=int(threads) if threads else None,
+        batch_size=int(batch_size) if batch_size else None,
+    )
+
+
+def _parse_address(address: str) -> Union[str, Tuple[str, int]]:
+    """'host:port' -> TCP tuple, anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+def _key_path(socket_path: str) -> str:
+    return socket_path + ".key"
+
+
+def _server_authkey(addr: Union[str, Tuple[str, int]], authkey: Optional[bytes]) -> bytes:
+    if authkey:
+        return authkey
+    if not isinstance(addr, str):
+        raise ValueError("EMBED_SERVER_KEY is required to serve embeddings on a TCP address")
+    key = secrets.token_bytes(32)
+    path = _key_path(addr)
+    if os.path.exists(path):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def _client_authkey(addr: Union[str, Tuple[str, int]], authkey: Optional[bytes]) -> bytes:
+    if authkey:
+        return authkey
+    if not isinstance(addr, str):
+        raise ValueError("EMBED_SERVER_KEY is required to connect to an embedding server on a TCP address")
+    try:
+        with open(_key_path(addr), "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        raise ValueError(f"no EMBED_SERVER_KEY and no key file {_key_path(addr)} next to the socket") from None
+
+
+class _EmbedderManager(BaseManager):
+    pass
+
+
+class _EmbedderService:
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    def encode(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        return self.service.encode(texts, batch_size=batch_size)
+
+    def encode_corpus(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        return self.service.encode_corpus(texts, batch_size=batch_size)
+
+    def info(self) -> dict:
+        return self.service.info()
+
+
+class RemoteEmbedder:
+    """
+    SentenceTransformer-compatible encode() backed by the shared embedding
+    server. Proxies keep one connection per calling thread.
+    """
+
+    def __init__(self, address: str, authkey: Optional[bytes] = EMBED_SERVER_KEY):
+        addr = _parse_address(address)
+        _EmbedderManager.register("embedder")
+        self._manager = _EmbedderManager(address=addr, authkey=_client_authkey(addr, authkey))
+        self._manager.connect()
+        self._service = self._manager.embedder()
+        self.model_id = self._service.info()["model_id"]
+
+    def encode(
+        self,
+        sentences: Union[str, List[str]],
+        batch_size: Optional[int] = None,
+        show_progress_bar: Optional[bool] = None,
+        convert_to_numpy: bool = True,
+        **kwargs,
+    ) -> np.ndarray:
+        single = isinstance(sentences, str)
+        embs = self._service.encode([sentences] if single else list(sentences), batch_size)
+        return embs[0] if single else embs
+
+    def encode_corpus(self, texts: List[str], batch_size: Optional[int] = None) -> np.ndarray:
+        return self._service.encode_corpus(list(texts), batch_size)
+
+
+def serve(
+    address: str,
+    emb_model: str = EMBED_MODEL,
+    backend: str = "torch",
+    authkey: Optional[bytes] = EMBED_SERVER_KEY,
+):
+    addr = _parse_address(address)
+    if isinstance(addr, str) and os.path.exists(addr):
+        os.unlink(addr)  # stale socket from a previous run
+    # Refuse before loading the model: no unauthenticated TCP listener
+    key = _server_authkey(addr, authkey)
+    service = _EmbedderService(load_embedder(emb_model, backend))
+    _EmbedderManager.register("embedder", callable=lambda: service)
+    manager = _EmbedderManager(address=addr, authkey=key)
+    server = manager.get_server()
+    if isinstance(addr, str):
+        os.chmod(addr, 0o600)
+    info = service.info()
+    print(f"embedding server ({emb_model}, {backend}, {info['device']}/{info['precision']}) listening on {address}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--address", default=os.getenv("EMBED_SERVER", "/tmp/embedder.sock"))
+    ap.add_argument("--model", default=EMBED_MODEL)
+    ap.add_argument("--backend", default=os.getenv("EMBED_QUERY_BACKEND", "torch"), choices=EMBED_BACKENDS)
+    args = ap.parse_args()
+    serve(args.address, args.model, args.backend)
@@ -1,36 +1,87 @@
+import json
 import os
-import requests
+import time
+import httpx
 import streamlit as st
-from typing import Optional
+from typing import Iterator, Optional
 
 # -----------------------------
 # Config
 # -----------------------------
 DEFAULT_API_BASE = os.getenv("CHATBOT_API_BASE", "http://34.30.57.33:8000")
+# Sent as a bearer token when the server has API_KEYS / API_KEYS_FILE set
+API_KEY = os.getenv("CHATBOT_API_KEY")
 TIMEOUT_SECS = 120
+RETRY_STATUSES = {429, 503}
+MAX_RETRIES = 3
 
 # -----------------------------
 # Helpers
 # -----------------------------
+@st.cache_resource
+def get_client() -> httpx.Client:
+    """
+    One pooled keep-alive client per Streamlit server process, reused across
+    reruns so each turn doesn't pay for a new TCP (and TLS) handshake.
+    """
+    return httpx.Client(
+        headers={"Authorization": f"Bearer {API_KEY}"} if API_KEY else None,
+        timeout=httpx.Timeout(TIMEOUT_SECS, connect=5.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+    )
+
+def _backoff(attempt: int, resp: httpx.Response) -> float:
+    retry_after = resp.headers.get("retry-after")
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), 10.0)
+    return 0.5 * (2 ** attempt)
+
+def _send(method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+    """Send with retry + exponential backoff on 429/503 (honours Retry-After)."""
+    client = get_client()
+    for attempt in range(MAX_RETRIES + 1):
+        req = client.build_request(method, url, **kwargs)
+        resp = client.send(req, stream=stream)
+        if resp.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            if stream and resp.is_error:
+                resp.read()
+            resp.raise_for_status()
+            return resp
+        resp.close()
+        time.sleep(_backoff(attempt, resp))
+
 def api_health(api_base: str):
     try:
-        r = requests.get(f"{api_base}/health", timeout=10)
-        r.raise_for_status()
-        return r.json()
+        return _send("GET", f"{api_base}/health", timeout=10).json()
     except Exception as e:
         return {"status": f"error: {e}"}
 
 def api_chat(api_base: str, message: str, session_id: Optional[str]):
     payload = {"message": message, "session_id": session_id}
-    r = requests.post(f"{api_base}/chat", json=payload, timeout=TIMEOUT_SECS)
-    r.raise_for_status()
-    return r.json()
+    return _send("POST", f"{api_base}/chat", json=payload).json()
+
+def api_chat_stream(api_base: str, message: str, session_id: Optional[str]) -> Iterator[dict]:
+    """
+    Yield the NDJSON events of /chat/stream as they arrive. A stream that ends
+    without {"done": true} was cut off (server restart, proxy timeout) and
+    raises instead of passing for a complete reply.
+    """
+    payload = {"message": message, "session_id": session_id}
+    resp = _send("POST", f"{api_base}/chat/stream", stream=True, json=payload)
+    try:
+        for line in resp.iter_lines():
+            if line:
+                event = json.loads(line)
+                yield event
+                if event.get("done") or "error" in event:
+                    return
+        raise RuntimeError("reply stream ended early; the answer may be incomplete")
+    finally:
+        resp.close()
 
 def api_reset(api_base: str, session_id: Optional[str]):
     payload = {"session_id": session_id}
-    r = requests.post(f"{api_base}/reset", json=payload, timeout=30)
-    r.raise_for_status()
-    return r.json()
+    return _send("POST", f"{api_base}/reset", json=payload, timeout=30).json()
 
 # -----------------------------
 # Streamlit UI
@@ -84,21 +135,35 @@ if prompt:
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Call backend
+    # Call backend, rendering the reply as it streams in
     with st.chat_message("assistant"):
         placeholder = st.empty()
+        reply = ""
+        t0 = time.perf_counter()
+        first_token = None
         try:
-            resp = api_chat(api_base, prompt.strip(), st.session_state.get("session_id"))
-            # Persist server-provided session id
-            st.session_state["session_id"] = resp.get("session_id", st.session_state.get("session_id"))
-            reply = resp.get("reply", "")
+            for event in api_chat_stream(api_base, prompt.strip(), st.session_state.get("session_id")):
+                if "session_id" in event:
+                    # Persist server-provided session id
+                    st.session_state["session_id"] = event["session_id"]
+                elif "delta" in event:
+                    if first_token is None:
+                        first_token = time.perf_counter() - t0
+                    reply += event["delta"]
+                    placeholder.markdown(reply + "▌")
+                elif "error" in event:
+                    raise RuntimeError(event["error"])
             placeholder.markdown(reply)
             st.session_state["messages"].append({"role": "assistant", "content": reply})
-        except requests.HTTPError as e:
+            total = time.perf_counter() - t0
+            st.caption(f"⏱️ first token {first_token or total:.2f}s · total {total:.2f}s")
+        except httpx.HTTPStatusError as e:
             try:
                 detail = e.response.json().get("detail")
             except Exception:
                 detail = str(e)
             placeholder.error(f"Server error: {detail}")
         except Exception as e:
-            placeholder.error(f"Request failed: {e}")
\ No newline at end of file
+            if reply:
+                placeholder.markdown(reply)
+            st.error(f"Request failed: {e}")
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Hashable, Iterable, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class GenerationOverrides:
+    """
+    Per-request changes to an engine's default sampling settings. None keeps
+    the engine default; `stop` adds to (never replaces) the built-in turn
+    markers. Hashable, so it doubles as the key for cached parameter objects.
+    """
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+    top_p: Optional[float] = None
+    stop: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_request(
+        cls,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        stop: Optional[Iterable[str]] = None,
+    ) -> "GenerationOverrides":
+        # Sorted/deduped so equivalent requests share one cached params object
+        return cls(max_tokens, temperature, top_p, tuple(sorted(set(stop or ()))))
+
+    def capped(self, max_tokens: Optional[int]) -> "GenerationOverrides":
+        """Apply an upper bound on max_tokens (e.g. from the degradation policy)."""
+        if max_tokens is None or (self.max_tokens is not None and self.max_tokens <= max_tokens):
+            return self
+        return replace(self, max_tokens=max_tokens)
+
+    @property
+    def is_default(self) -> bool:
+        return self == DEFAULT_OVERRIDES
+
+
+DEFAULT_OVERRIDES = GenerationOverrides()
+
+
+class ParamsCache:
+    """
+    Small thread-safe LRU of engine parameter objects (SamplingParams,
+    GenerationConfig) so repeated override combinations don't rebuild them.
+    """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[Hashable, object]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, build: Callable[[], object]):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+                return value
+        value = build()
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+        return value
+
+    def __len__(self) -> int:
+        return len(self._data)
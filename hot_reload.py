@@ -0,0 +1,203 @@
+"""
+Blue/green swaps of the generation engine and retrieval index inside a running
+service: the next deployment is loaded and warmed up in the background, new
+requests are switched to it in one step, requests already running finish on
+the old one, and the old engine's memory is released once it has drained.
+"""
+import contextvars
+import gc
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Set
+
+from cancellation import CancelToken
+
+
+class Deployment:
+    """One retriever + engine pair and the requests currently pinned to it."""
+
+    def __init__(self, retriever, model, model_id: str):
+        self.retriever = retriever
+        self.model = model
+        self.model_id = model_id
+        self.created = time.time()
+        self.in_flight = 0
+        # Cancel tokens of the pinned requests that have one (guarded by Deployments._cond)
+        self.pinned_tokens: Set[CancelToken] = set()
+
+    @property
+    def label(self) -> str:
+        return f"{self.model_id}@{self.retriever.version}"
+
+    def release(self, successor: "Deployment") -> None:
+        """Free what the successor doesn't reuse (the engine's GPU memory in particular)."""
+        if self.model is not successor.model:
+            close = getattr(self.model, "close", None)
+            if close is not None:
+                close()
+        retriever = self.retriever
+        # A rebuild with the same content and embedders has the same version: its entries stay valid
+        if (
+            retriever is not successor.retriever
+            and retriever.cache is not None
+            and retriever.version != successor.retriever.version
+        ):
+            retriever.cache.invalidate(retriever.version)
+        self.model = self.retriever = None
+        gc.collect()
+
+
+# The deployment a request was pinned to when it started; unset (background
+# history summaries) means the active one.
+_PINNED: contextvars.ContextVar = contextvars.ContextVar("pinned_deployment", default=None)
+
+
+class Deployments:
+    """
+    The active deployment plus pinning: pin() at the start of a request makes
+    every component lookup for that request (threadpool included, via the
+    contextvar) resolve to the same deployment even if a swap happens midway.
+    """
+
+    def __init__(self, initial: Deployment):
+        self._active = initial
+        self._cond = threading.Condition()
+
+    @property
+    def active(self) -> Deployment:
+        return self._active
+
+    def current(self) -> Deployment:
+        pinned = _PINNED.get()
+        if pinned is not None and pinned[0] is self:
+            return pinned[1]
+        return self._active
+
+    def pin(self, cancel: Optional[CancelToken] = None) -> Deployment:
+        """`cancel` lets a reload end this request cleanly if it outlives the drain timeout."""
+        with self._cond:
+            deployment = self._active
+            deployment.in_flight += 1
+            if cancel is not None:
+                deployment.pinned_tokens.add(cancel)
+        _PINNED.set((self, deployment))
+        return deployment
+
+    def unpin(self, deployment: Deployment, cancel: Optional[CancelToken] = None) -> None:
+        with self._cond:
+            deployment.in_flight -= 1
+            deployment.pinned_tokens.discard(cancel)
+            self._cond.notify_all()
+
+    def cancel_pinned(self, deployment: Deployment) -> int:
+        """Fire the cancel token of every request still pinned to `deployment`."""
+        with self._cond:
+            tokens = list(deployment.pinned_tokens)
+        for token in tokens:
+            token.cancel()
+        return len(tokens)
+
+    def swap(self, new: Deployment) -> Deployment:
+        with self._cond:
+            old, self._active = self._active, new
+        return old
+
+    def drain(self, deployment: Deployment, timeout: float) -> bool:
+        """Wait until nothing is pinned to `deployment`. False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: deployment.in_flight <= 0, timeout)
+
+
+class HotReloader:
+    """
+    Runs one reload at a time in a background thread:
+    loading (build + warm-up) -> swap -> draining -> releasing the old deployment.
+    A failed build leaves the active deployment untouched.
+
+    The old engine is never closed under a pinned request. Requests still
+    running after `drain_timeout` are cancelled (they end like a client
+    disconnect) and get `cancel_grace` more seconds. Anything pinned after that
+    (no cancel token, or stuck outside the engine) defers the release until it
+    unpins; the reloader goes idle meanwhile so later reloads aren't blocked.
+    """
+
+    def __init__(
+        self,
+        deployments: Deployments,
+        build: Callable[..., Deployment],
+        drain_timeout: float = 120.0,
+        cancel_grace: float = 10.0,
+    ):
+        self.deployments = deployments
+        self.build = build
+        self.drain_timeout = drain_timeout
+        self.cancel_grace = cancel_grace
+        self._lock = threading.Lock()
+        self.state = "idle"
+        self.error: Optional[str] = None
+        self.history: List[Dict] = []
+        self.pending_release: List[str] = []
+
+    def start(self, **spec) -> bool:
+        """Begin a reload with `spec` passed to build(). False if one is already running."""
+        with self._lock:
+            if self.state not in ("idle", "failed"):
+                return False
+            self.state, self.error = "loading", None
+        threading.Thread(target=self._run, args=(spec,), name="hot-reload", daemon=True).start()
+        return True
+
+    def _run(self, spec: Dict) -> None:
+        started = time.monotonic()
+        entry = {"spec": {k: v for k, v in spec.items() if v is not None}, "started": time.time()}
+        try:
+            new = self.build(**spec)
+            old = self.deployments.swap(new)
+            entry.update(old=old.label, new=new.label, load_s=round(time.monotonic() - started, 1))
+            self.state = "draining"
+            drain_started = time.monotonic()
+            drained = self.deployments.drain(old, self.drain_timeout)
+            if not drained:
+                entry["cancelled"] = self.deployments.cancel_pinned(old)
+                drained = self.deployments.drain(old, self.cancel_grace)
+            entry["drained"] = drained
+            entry["drain_s"] = round(time.monotonic() - drain_started, 1)
+            if drained:
+                self.state = "releasing"
+                old.release(new)
+                self.state = "idle"
+            else:
+                entry["release"] = "deferred"
+                self._defer_release(old, new)
+        except Exception as exc:
+            traceback.print_exc()
+            self.error = f"{type(exc).__name__}: {exc}"
+            entry["error"] = self.error
+            self.state = "failed"
+        self.history = (self.history + [entry])[-10:]
+
+    def _defer_release(self, old: Deployment, new: Deployment) -> None:
+        label = old.label
+        self.pending_release.append(label)
+        self.state = "idle"
+
+        def wait_and_release():
+            self.deployments.drain(old, None)
+            try:
+                old.release(new)
+            except Exception:
+                traceback.print_exc()
+            self.pending_release.remove(label)
+
+        threading.Thread(target=wait_and_release, name="hot-reload-release", daemon=True).start()
+
+    def status(self) -> Dict:
+        active = self.deployments.active
+        return {
+            "state": self.state,
+            "error": self.error,
+            "active": {"label": active.label, "model_id": active.model_id, "in_flight": active.in_flight},
+            "history": list(self.history),
+            "pending_release": list(self.pending_release),
+        }
@@ -1,7 +1,13 @@
 
+import copy
+import gc
+import hashlib
+import json
 import os
+import threading
+from dataclasses import replace
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -11,29 +17,65 @@ from transformers import (
     AutoModelForCausalLM,
     AutoModelForSeq2SeqLM,
     GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
 )
-from sentence_transformers import SentenceTransformer
 import faiss
 
 from vllm_model import VLLMModel
+from remote_model import RemoteModel
+from stub_model import StubModel
+from embedding import EMBED_MODEL, RemoteEmbedder, load_embedder
+from reranker import CrossEncoderReranker
+from memory import ConversationMemory
+from retrieval_cache import RetrievalCache, normalize_query
+from retrieval_gate import RETRIEVE, REUSE, SKIP, RetrievalGate, approx_tokens
+from search_hits import SearchHit, postprocess, section_titles, word_spans
+from chunk_store import ChunkStore
+from singleflight import SingleFlight
+from scheduler import ScheduledModel, Scheduler
+from usage import MeteredModel, charge, measure
+from profiling import annotate, timed
+from hot_reload import Deployment, Deployments
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled, acquire_or_cancel
+from degradation import FULL, DegradationLevel, retrieval_only_answer
+from generation import DEFAULT_OVERRIDES, GenerationOverrides, ParamsCache
 from sample_text import *
 
 
 DEFAULT_MODEL_ID = "meta-llama/Llama-3.1-8B-Instruct"
-EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 INDEX_DIR = Path("knowledge_base")
 KB_FILE = INDEX_DIR / "tech_support.txt"
 
+# Short, deterministic generations for the background history summarizer
+SUMMARY_OVERRIDES = GenerationOverrides(max_tokens=200, temperature=0.0)
+
+# Concurrent requests whose rendered prompt and generation settings match
+# (typically identical first questions during an incident) share one generation.
+GENERATION_FLIGHT = SingleFlight("generation") if os.getenv("SINGLE_FLIGHT", "1") == "1" else None
+
+# Shared across sessions: stores with identical content get the same version
+# stamp, so one session's search warms the cache for every other.
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "4096"))
+RETRIEVAL_CACHE = RetrievalCache(RETRIEVAL_CACHE_SIZE) if RETRIEVAL_CACHE_SIZE > 0 else None
+
 
 
 # ---------------------------
 # Utility: build prompt
 # ---------------------------
 
-def build_prompt(context_chunks: List[str], chat_history: List[Tuple[str, str]], user_msg: str) -> str:
+def build_prompt(
+    context_chunks: List[str],
+    chat_history: List[Tuple[str, str]],
+    user_msg: str,
+    summary: str = "",
+) -> str:
     """
     Simple instruction-style prompt. If your tokenizer exposes a chat_template,
-    you could switch to it later.
+    you could switch to it later. `summary` is the rolling summary of turns
+    that no longer fit in the raw history.
     """
     context = "\n\n".join(f"- {c}" for c in context_chunks)
     history_txt = ""
@@ -47,8 +89,11 @@ def build_prompt(context_chunks: List[str], chat_history: List[Tuple[str, str]],
         "Only provide ONE response, then stop."
     )
 
+    summary_txt = f"Conversation Summary:\n{summary}\n\n" if summary else ""
+
     prompt = (
         f"{system}\n\n"
+        f"{summary_txt}"
         f"Context:\n{context if context else '(no extra context)'}\n\n"
         f"Chat History:\n{history_txt if history_txt else '(none)'}\n"
         f"User: {user_msg}\n"
@@ -58,38 +103,309 @@ def build_prompt(context_chunks: List[str], chat_history: List[Tuple[str, str]],
 
 
 
+# Index storage: float32 is exact; float16 halves and int8 quarters the vectors
+# (scalar quantization, still brute-force inner product).
+INDEX_DTYPES = ("float32", "float16", "int8")
+
+
+def embedder_identity(embedder) -> str:
+    """What decides an embedder's vectors: model, plus backend/precision when known (remote ones report only the model)."""
+    parts = [type(embedder).__name__, getattr(embedder, "model_id", "?")]
+    parts += [str(getattr(embedder, attr)) for attr in ("backend", "precision") if hasattr(embedder, attr)]
+    return "/".join(parts)
+
+
 class SimpleFaissStore:
     
-    def __init__(self, emb_model: str = EMBED_MODEL):
-        self.embedder = SentenceTransformer(emb_model)
+    def __init__(
+        self,
+        emb_model: str = EMBED_MODEL,
+        index_dtype: str = "float32",
+        query_backend: str = "torch",
+        cache: Optional[RetrievalCache] = None,
+        embedder=None,
+    ):
+        if index_dtype not in INDEX_DTYPES:
+            raise ValueError(f"unknown index dtype {index_dtype!r}, expected one of {INDEX_DTYPES}")
+        self.emb_model = emb_model
+        if embedder is not None:
+            # e.g. RemoteEmbedder: one shared encoder for documents and queries
+            self.embedder = self.query_embedder = embedder
+        else:
+            self.embedder = load_embedder(emb_model, "torch")
+            # Documents are always embedded with torch; only the per-request query
+            # encode goes through the (optionally quantized) ONNX path.
+            self.query_embedder = self.embedder if query_backend == "torch" else load_embedder(emb_model, query_backend)
+        self.index_dtype = index_dtype
         self.index = None  # faiss.Index
-        self.texts: List[str] = []
+        # One UTF-8 buffer + spans; overlapping windows share their common text
+        self.texts = ChunkStore()
+        # Per-chunk metadata, parallel to texts: section id and character span in the KB
+        self.sections: List[str] = []
+        self._section_ids = np.zeros(0, dtype=np.int32)
+        self._spans = np.zeros((0, 2), dtype=np.int64)
+        self.cache = cache
+        self.flight = SingleFlight("retrieval")
+        # KB content hash (index settings + chunk texts); the version stamp adds the
+        # embedders actually in use, so everything that changes search results feeds it
+        self._digest = hashlib.sha1(f"{emb_model}|{index_dtype}".encode("utf-8"))
+        self.content = self._digest.hexdigest()
+        self.version = self._stamp()
+
+    def _stamp(self) -> str:
+        dim = self.index.d if self.index is not None else 0
+        ntotal = self.index.ntotal if self.index is not None else 0
+        identity = (
+            f"{self.content}|{embedder_identity(self.embedder)}|{embedder_identity(self.query_embedder)}"
+            f"|{self.index_dtype}|{dim}|{ntotal}"
+        )
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()[:16]
 
     @staticmethod
     def _normalize(x: np.ndarray) -> np.ndarray:
         norms = np.linalg.norm(x, axis=1, keepdims=True) + 1e-12
         return x / norms
 
-    def add_texts(self, texts: List[str]) -> None:
-        embs = self.embedder.encode(texts, batch_size=64, show_progress_bar=False, convert_to_numpy=True)
+    def _new_index(self, dim: int):
+        if self.index_dtype == "float32":
+            return faiss.IndexFlatIP(dim)
+        qtype = faiss.ScalarQuantizer.QT_fp16 if self.index_dtype == "float16" else faiss.ScalarQuantizer.QT_8bit
+        return faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+
+    def add_texts(
+        self,
+        texts: List[str],
+        sections: Optional[List[str]] = None,
+        spans: Optional[List[Tuple[int, int]]] = None,
+    ) -> None:
+        if self._digest is None:
+            raise RuntimeError("store was loaded read-only from disk; rebuild it with build_index.py")
+        encode_corpus = getattr(self.embedder, "encode_corpus", None)
+        if encode_corpus is not None:
+            embs = encode_corpus(texts)
+        else:
+            embs = self.embedder.encode(texts, batch_size=64, show_progress_bar=False, convert_to_numpy=True)
         embs = self._normalize(embs.astype("float32"))
         if self.index is None:
-            self.index = faiss.IndexFlatIP(embs.shape[1])
+            self.index = self._new_index(embs.shape[1])
+        if not self.index.is_trained:
+            # int8 SQ learns per-dimension ranges from the first batch
+            self.index.train(embs)
         self.index.add(embs)
         self.texts.extend(texts)
 
+        sections = sections or [""] * len(texts)
+        lookup = {name: i for i, name in enumerate(self.sections)}
+        ids = [lookup.setdefault(name, len(lookup)) for name in sections]
+        self.sections = list(lookup)
+        self._section_ids = np.concatenate([self._section_ids, np.asarray(ids, dtype=np.int32)])
+        new_spans = np.asarray(spans, dtype=np.int64).reshape(-1, 2) if spans else np.full((len(texts), 2), -1, np.int64)
+        self._spans = np.concatenate([self._spans, new_spans])
+
+        # An empty store had nothing cached; its stamp may be shared with other empty stores
+        old_version = self.version if len(self.texts) > len(texts) else None
+        for t in texts:
+            self._digest.update(t.encode("utf-8"))
+            self._digest.update(b"\0")
+        self.content = self._digest.hexdigest()
+        self.version = self._stamp()
+        if self.cache is not None and old_version is not None:
+            self.cache.invalidate(old_version)
+
+    def save(self, path: Path) -> None:
+        """
+        Write index + chunk texts to `path` for load(): index.faiss,
+        chunks.bin (UTF-8 buffer) with offsets.npy (per-chunk byte spans
+        into it), chunk metadata (section_ids.npy, spans.npy) and meta.json.
+        """
+        if self.index is None:
+            raise ValueError("nothing to save: index is empty")
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        faiss.write_index(self.index, str(path / "index.faiss"))
+        self.texts.save(path / "chunks.bin", path / "offsets.npy")
+        np.save(path / "section_ids.npy", self._section_ids)
+        np.save(path / "spans.npy", self._spans)
+        meta = {
+            "emb_model": self.emb_model,
+            "index_dtype": self.index_dtype,
+            "version": self.version,
+            "content": self.content,
+            "sections": self.sections,
+        }
+        (path / "meta.json").write_text(json.dumps(meta), encoding="utf-8")
+
+    @classmethod
+    def load(
+        cls,
+        path: Path,
+        query_backend: str = "torch",
+        cache: Optional[RetrievalCache] = None,
+        embedder=None,
+    ) -> "SimpleFaissStore":
+        """
+        Open a store written by save() read-only. The index and chunk texts are
+        memory-mapped, so N workers loading the same files share one copy.
+        """
+        path = Path(path)
+        meta = json.loads((path / "meta.json").read_text(encoding="utf-8"))
+        store = cls(meta["emb_model"], meta["index_dtype"], query_backend, cache=cache, embedder=embedder)
+        # IO_FLAG_MMAP_IFC (faiss >= 1.10) maps flat codes zero-copy; older
+        # releases only honour IO_FLAG_MMAP for IVF lists and read flat codes in.
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        store.index = faiss.read_index(str(path / "index.faiss"), flags)
+        store.texts = ChunkStore.open(path / "chunks.bin", path / "offsets.npy")
+        store.sections = meta["sections"]
+        store._section_ids = np.load(path / "section_ids.npy", mmap_mode="r")
+        store._spans = np.load(path / "spans.npy", mmap_mode="r")
+        # Re-stamped with this process's embedders; indexes saved without "content" keep theirs
+        store.content = meta.get("content")
+        store.version = store._stamp() if store.content else meta["version"]
+        store._digest = None
+        return store
+
+    def index_nbytes(self) -> int:
+        if self.index is None:
+            return 0
+        return int(faiss.serialize_index(self.index).nbytes)
+
     def search(self, query: str, k: int = 3) -> List[str]:
+        return [hit.text for hit in self._search_raw(query, k)]
+
+    def search_hits(
+        self,
+        query: str,
+        k: int = 3,
+        min_score: Optional[float] = None,
+        mmr_lambda: Optional[float] = None,
+        fetch_k: Optional[int] = None,
+        dedup_sim: float = 1.0,
+        reuse_cached: bool = False,
+    ) -> List[SearchHit]:
+        """
+        Structured results, best first. Hits below `min_score` (cosine) are
+        dropped; with `mmr_lambda` the top `fetch_k` (default 2k) candidates are
+        diversified with MMR over their stored vectors, so overlapping chunks
+        don't crowd the prompt. `reuse_cached` accepts the top hits of a cached
+        larger-k search of the same query.
+        """
+        fetch = k if mmr_lambda is None else max(k, fetch_k or 2 * k)
+        hits = self._search_raw(query, fetch, reuse_cached)
+        embs = self._vectors([h.id for h in hits]) if mmr_lambda is not None and len(hits) > 1 else None
+        return postprocess(hits, embs, k, min_score, mmr_lambda, dedup_sim)
+
+    def _vectors(self, ids: List[int]) -> np.ndarray:
+        # Decoded from the index itself (approximate for SQ storage), re-normalized
+        return self._normalize(self.index.reconstruct_batch(np.asarray(ids, dtype=np.int64)))
+
+    def _search_raw(self, query: str, k: int, reuse_cached: bool = False) -> List[SearchHit]:
         if self.index is None or len(self.texts) == 0:
             return []
-        q = self.embedder.encode([query], show_progress_bar=False, convert_to_numpy=True).astype("float32")
+        if self.cache is not None:
+            cached = self.cache.get(query, k, self.version, allow_larger=reuse_cached)
+            if cached is not None:
+                return cached
+        # Identical concurrent misses (e.g. an incident burst) share one encode + search
+        key = (normalize_query(query), k, self.version)
+        return list(self.flight.do(key, lambda: self._search_uncached(query, k)))
+
+    def _hits(self, scores: np.ndarray, ids: np.ndarray) -> List[SearchHit]:
+        valid = (ids >= 0) & (ids < len(self.texts))
+        ids, scores = ids[valid], scores[valid]
+        section_ids = self._section_ids[ids]
+        spans = self._spans[ids]
+        return [
+            SearchHit(int(i), float(sc), self.texts[i], self.sections[sec], int(span[0]), int(span[1]))
+            for i, sc, sec, span in zip(ids, scores, section_ids, spans)
+        ]
+
+    def _search_uncached(self, query: str, k: int) -> List[SearchHit]:
+        with timed("embed"):
+            q = self.query_embedder.encode([query], show_progress_bar=False, convert_to_numpy=True).astype("float32")
         q = self._normalize(q)
-        D, I = self.index.search(q, k)
-        hits = []
-        for idx in I[0]:
-            if 0 <= idx < len(self.texts):
-                hits.append(self.texts[idx])
+        with timed("faiss"):
+            D, I = self.index.search(q, k)
+        hits = self._hits(D[0], I[0])
+        if self.cache is not None:
+            self.cache.put(query, k, self.version, hits)
         return hits
 
+    def search_batch(self, queries: List[str], k: int = 3, batch_size: int = 64) -> List[List[str]]:
+        """
+        search() for many queries: cache misses are embedded together and looked
+        up with a single FAISS call.
+        """
+        return [[hit.text for hit in hits] for hits in self._search_raw_batch(queries, k, batch_size)]
+
+    def search_hits_batch(
+        self,
+        queries: List[str],
+        k: int = 3,
+        batch_size: int = 64,
+        min_score: Optional[float] = None,
+        mmr_lambda: Optional[float] = None,
+        fetch_k: Optional[int] = None,
+        dedup_sim: float = 1.0,
+        reuse_cached: bool = False,
+    ) -> List[List[SearchHit]]:
+        """search_hits() for many queries, sharing one encode + FAISS call."""
+        fetch = k if mmr_lambda is None else max(k, fetch_k or 2 * k)
+        out = []
+        for hits in self._search_raw_batch(queries, fetch, batch_size, reuse_cached):
+            embs = self._vectors([h.id for h in hits]) if mmr_lambda is not None and len(hits) > 1 else None
+            out.append(postprocess(hits, embs, k, min_score, mmr_lambda, dedup_sim))
+        return out
+
+    def _search_raw_batch(
+        self, queries: List[str], k: int, batch_size: int, reuse_cached: bool = False
+    ) -> List[List[SearchHit]]:
+        results: List[Optional[List[SearchHit]]] = [None] * len(queries)
+        if self.index is None or len(self.texts) == 0:
+            return [[] for _ in queries]
+        # Misses by normalized query: repeats within the batch are encoded once,
+        # and queries another request is already searching are waited on
+        misses: Dict[tuple, List[int]] = {}
+        for i, q in enumerate(queries):
+            cached = self.cache.get(q, k, self.version, reuse_cached) if self.cache is not None else None
+            if cached is None:
+                misses.setdefault((normalize_query(q), k, self.version), []).append(i)
+            else:
+                results[i] = cached
+        if misses:
+            keys = list(misses)
+            searched = self.flight.do_many(
+                keys, lambda led: self._search_uncached_batch([queries[misses[key][0]] for key in led], k, batch_size)
+            )
+            for key, hits in zip(keys, searched):
+                for i in misses[key]:
+                    results[i] = list(hits)
+        return results
+
+    def _search_uncached_batch(self, queries: List[str], k: int, batch_size: int) -> List[List[SearchHit]]:
+        with timed("embed"):
+            embs = self.query_embedder.encode(
+                queries, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True
+            )
+        with timed("faiss"):
+            D, I = self.index.search(self._normalize(embs.astype("float32")), k)
+        out = []
+        for row, query in enumerate(queries):
+            hits = self._hits(D[row], I[row])
+            if self.cache is not None:
+                self.cache.put(query, k, self.version, hits)
+            out.append(hits)
+        return out
+
+
+
+class _EventStoppingCriteria(StoppingCriteria):
+    """Stops HF generate() once `event` is set (stop sequence seen, consumer gone)."""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
 
 
 class DirectHFModel:
@@ -122,6 +438,9 @@ class DirectHFModel:
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_id, token=self.hf_token, use_fast=True)
         if self.tokenizer.pad_token is None and self.tokenizer.eos_token is not None:
             self.tokenizer.pad_token = self.tokenizer.eos_token
+        if not getattr(self.config, "is_encoder_decoder", False):
+            # Batched decoder-only generation needs prompts right-aligned
+            self.tokenizer.padding_side = "left"
 
         if getattr(self.config, "is_encoder_decoder", False):
             self.model = AutoModelForSeq2SeqLM.from_pretrained(
@@ -141,10 +460,14 @@ class DirectHFModel:
             pad_token_id=self.tokenizer.pad_token_id,
             eos_token_id=self.tokenizer.eos_token_id,
         )
+        # Per-request override variants of generation_config, built once each
+        self._config_cache = ParamsCache(max_entries=128)
+        # Background history summaries share the model with live requests
+        self._lock = threading.Lock()
 
-    def _apply_stops(self, text: str) -> str:
+    def _apply_stops(self, text: str, extra_stops: Tuple[str, ...] = ()) -> str:
         cut = len(text)
-        for s in self.stop_sequences:
+        for s in (*self.stop_sequences, *extra_stops):
             if not s:
                 continue
             idx = text.find(s)
@@ -152,20 +475,86 @@ class DirectHFModel:
                 cut = min(cut, idx)
         return text[:cut]
 
-    def generate(self, prompt: str) -> str:
+    def count_tokens(self, text: str) -> int:
+        """Engine tokenizer count, for usage metering."""
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def close(self) -> None:
+        """Free the weights' GPU memory once a hot reload has drained this engine."""
+        with self._lock:
+            self.model = None
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def _encode(self, prompt) -> dict:
         inputs = self.tokenizer(prompt, return_tensors="pt", padding=True, truncation=True)
         device = next(self.model.parameters()).device
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+        return {k: v.to(device) for k, v in inputs.items()}
 
+    def _build_config(self, overrides: GenerationOverrides) -> GenerationConfig:
+        config = copy.deepcopy(self.generation_config)
+        if overrides.max_tokens is not None:
+            config.max_new_tokens = overrides.max_tokens
+        if overrides.top_p is not None:
+            config.top_p = overrides.top_p
+        if overrides.temperature is not None:
+            # temperature 0 means greedy; HF expresses that with do_sample=False
+            config.do_sample = overrides.temperature > 0
+            if config.do_sample:
+                config.temperature = overrides.temperature
+        return config
+
+    def _config_for(self, overrides: Optional[GenerationOverrides] = None) -> GenerationConfig:
+        # Stop strings are applied to the decoded text, so they don't change the config
+        overrides = replace(overrides, stop=()) if overrides is not None else DEFAULT_OVERRIDES
+        if overrides.is_default:
+            return self.generation_config
+        return self._config_cache.get(overrides, lambda: self._build_config(overrides))
+
+    def _run_generate(
+        self,
+        inputs: dict,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+        **extra,
+    ):
         use_amp = self.use_autocast and torch.cuda.is_available()
         amp_dtype = torch.bfloat16 if torch.cuda.is_available() else None
+        config = self._config_for(overrides)
+        rows = inputs["input_ids"].shape[0] * extra.get("num_return_sequences", 1)
+        budget = config.max_new_tokens * rows
 
-        with torch.inference_mode():
-            if use_amp and amp_dtype is not None:
-                with torch.autocast(device_type="cuda", dtype=amp_dtype):
-                    out_ids = self.model.generate(**inputs, generation_config=self.generation_config, use_cache=True)
-            else:
-                out_ids = self.model.generate(**inputs, generation_config=self.generation_config, use_cache=True)
+        if cancel is not None:
+            # Checked by generate() after every decode step
+            criteria = StoppingCriteriaList(extra.pop("stopping_criteria", []))
+            criteria.append(_EventStoppingCriteria(cancel.event))
+            extra["stopping_criteria"] = criteria
+
+        acquire_or_cancel(self._lock, cancel, budget)
+        try:
+            with torch.inference_mode():
+                if use_amp and amp_dtype is not None:
+                    with torch.autocast(device_type="cuda", dtype=amp_dtype):
+                        out = self.model.generate(**inputs, generation_config=config, use_cache=True, **extra)
+                else:
+                    out = self.model.generate(**inputs, generation_config=config, use_cache=True, **extra)
+        finally:
+            self._lock.release()
+
+        if cancel is not None and cancel.cancelled:
+            prompt_len = 0 if getattr(self.config, "is_encoder_decoder", False) else inputs["input_ids"].shape[1]
+            CANCEL_STATS.record((out.shape[-1] - prompt_len) * rows, budget, started=True)
+            raise GenerationCancelled()
+        return out
+
+    def generate(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        inputs = self._encode(prompt)
+        out_ids = self._run_generate(inputs, overrides=overrides, cancel=cancel)
 
         if getattr(self.config, "is_encoder_decoder", False):
             text = self.tokenizer.decode(out_ids[0], skip_special_tokens=True)
@@ -173,7 +562,87 @@ class DirectHFModel:
             prompt_len = inputs["input_ids"].shape[1]
             text = self.tokenizer.decode(out_ids[0][prompt_len:], skip_special_tokens=True)
 
-        return self._apply_stops(text).strip()
+        return self._apply_stops(text, overrides.stop if overrides else ()).strip()
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        n: int = 1,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        """One padded generate() call for all prompts, n samples each."""
+        inputs = self._encode(prompts)
+        out_ids = self._run_generate(inputs, overrides=overrides, cancel=cancel, num_return_sequences=n)
+        if getattr(self.config, "is_encoder_decoder", False):
+            texts = self.tokenizer.batch_decode(out_ids, skip_special_tokens=True)
+        else:
+            # Left padding: every prompt ends at the same position
+            prompt_len = inputs["input_ids"].shape[1]
+            texts = self.tokenizer.batch_decode(out_ids[:, prompt_len:], skip_special_tokens=True)
+        extra_stops = overrides.stop if overrides else ()
+        texts = [self._apply_stops(t, extra_stops).strip() for t in texts]
+        return [texts[i * n:(i + 1) * n] for i in range(len(prompts))]
+
+    def stream(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        """
+        Yield text deltas as they are decoded. The tail that could still grow
+        into a stop sequence is held back until it can't; generation is stopped
+        as soon as a stop sequence appears, the consumer goes away or `cancel`
+        fires.
+        """
+        inputs = self._encode(prompt)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_event = threading.Event()
+        errors: List[BaseException] = []
+
+        def run():
+            try:
+                self._run_generate(
+                    inputs,
+                    overrides=overrides,
+                    cancel=cancel,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([_EventStoppingCriteria(stop_event)]),
+                )
+            except BaseException as e:  # surfaced to the consumer below
+                errors.append(e)
+                streamer.end()
+
+        worker = threading.Thread(target=run, name="hf-stream", daemon=True)
+        worker.start()
+
+        extra_stops = overrides.stop if overrides else ()
+        hold = max((len(s) for s in (*self.stop_sequences, *extra_stops) if s), default=1) - 1
+        text, sent = "", 0
+        try:
+            for piece in streamer:
+                text += piece
+                view = text.lstrip()
+                cut = self._apply_stops(view, extra_stops)
+                if len(cut) < len(view):
+                    stop_event.set()
+                    tail = cut[sent:].rstrip()
+                    if tail:
+                        yield tail
+                    return
+                safe = len(view) - hold
+                if safe > sent:
+                    yield view[sent:safe]
+                    sent = safe
+            if errors:
+                raise errors[0]
+            tail = text.lstrip()[sent:].rstrip()
+            if tail:
+                yield tail
+        finally:
+            stop_event.set()
+            worker.join()
 
 
 
@@ -183,24 +652,112 @@ class TechSupportChatbot:
         model_id: str = DEFAULT_MODEL_ID,
         hf_token: Optional[str] = None,
         top_k: int = 3,
+        shared: Optional["TechSupportChatbot"] = None,
     ):
-        # Ensure KB exists
-        INDEX_DIR.mkdir(exist_ok=True)
-        if not KB_FILE.exists():
-            KB_FILE.write_text(KNOWLEDGE_BASE, encoding="utf-8")
+        if shared is None:
+            self._init_components(model_id, hf_token)
+        else:
+            # Session bots share the retriever, reranker and engine; only memory is per session
+            self.deployments = shared.deployments
+            self.reranker = shared.reranker
+            self.rerank_candidates = shared.rerank_candidates
+            self.gate = shared.gate
+            self.mmr_lambda = shared.mmr_lambda
+            self.dedup_sim = shared.dedup_sim
+            self.scheduler = shared.scheduler
 
-        # Init retrieval
-        self.retriever = SimpleFaissStore(EMBED_MODEL)
-        raw = KB_FILE.read_text(encoding="utf-8")
-        chunks = self._split_text(raw, chunk_size=400, overlap=100)
-        self.retriever.add_texts(chunks)
+        # Rolling memory: last HISTORY_KEEP_TURNS raw turns, older ones summarized
+        # in the background (HISTORY_SUMMARY=0 just drops them instead)
+        summarize = None
+        if os.getenv("HISTORY_SUMMARY", "1") == "1":
+            summarize = lambda prompt: self.model.generate(prompt, overrides=SUMMARY_OVERRIDES)
+        self.memory = ConversationMemory(
+            summarize=summarize,
+            keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "4")),
+            max_answer_words=int(os.getenv("HISTORY_ANSWER_WORDS", "120")),
+        )
+        self.top_k = top_k
+        # Context injected on the previous turn, reused for short follow-ups
+        self._last_ctx: Optional[List[str]] = None
+
+    def _init_components(self, model_id: str, hf_token: Optional[str]) -> None:
+        self.hf_token = hf_token
+        # Priority classes + per-tenant fair queueing in front of the engine
+        # (SCHED_POLICY=fifo serves in arrival order). Outlives engine swaps.
+        # SCHED_SLOTS unset: sized to each engine as it is loaded (see _load_model())
+        self.scheduler = Scheduler(
+            slots=int(os.getenv("SCHED_SLOTS", "1")),
+            policy=os.getenv("SCHED_POLICY", "fair"),
+            max_wait_s=float(os.getenv("SCHED_MAX_WAIT_S", "30")),
+        )
+        # Retriever + engine live in a swappable deployment (see build_deployment())
+        self.deployments = Deployments(
+            Deployment(self._load_retriever(os.getenv("INDEX_PATH")), self._load_model(model_id), model_id)
+        )
+
+        # Optional cross-encoder rerank stage: RERANK_MODEL=<hf id> enables it
+        rerank_model = os.getenv("RERANK_MODEL")
+        self.reranker = None
+        if rerank_model:
+            self.reranker = CrossEncoderReranker(
+                model_id=rerank_model,
+                batch_size=int(os.getenv("RERANK_BATCH_SIZE", "16")),
+                budget_ms=float(os.getenv("RERANK_BUDGET_MS", "150")),
+            )
+        self.rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "10"))
+
+        # Diversify results with MMR over the stored vectors (RETRIEVAL_MMR_LAMBDA=1 disables)
+        # and drop near-duplicate chunks (overlapping windows) outright
+        mmr_lambda = float(os.getenv("RETRIEVAL_MMR_LAMBDA", "0.7"))
+        self.mmr_lambda = mmr_lambda if mmr_lambda < 1.0 else None
+        self.dedup_sim = float(os.getenv("RETRIEVAL_DEDUP_SIM", "0.95"))
+
+        # Adaptive retrieval: skip/reuse/shrink context per turn (RETRIEVAL_GATE=0 disables)
+        self.gate = None
+        if os.getenv("RETRIEVAL_GATE", "1") == "1":
+            self.gate = RetrievalGate(
+                min_score=float(os.getenv("RETRIEVAL_MIN_SCORE", "0.2")),
+                margin=float(os.getenv("RETRIEVAL_SCORE_MARGIN", "0.15")),
+                followup_max_words=int(os.getenv("RETRIEVAL_FOLLOWUP_WORDS", "8")),
+            )
+
+    @staticmethod
+    def _load_retriever(index_path: Optional[str], rebuild: bool = False) -> SimpleFaissStore:
+        # With several workers, point INDEX_PATH at a prebuilt index
+        # (build_index.py) so all of them mmap one copy, and EMBED_SERVER at a
+        # shared embedding process (python embedding.py).
+        embed_server = os.getenv("EMBED_SERVER")
+        embedder = RemoteEmbedder(embed_server) if embed_server else None
+        if index_path and not rebuild and (Path(index_path) / "meta.json").exists():
+            return SimpleFaissStore.load(
+                Path(index_path),
+                query_backend=os.getenv("EMBED_QUERY_BACKEND", "torch"),
+                cache=RETRIEVAL_CACHE,
+                embedder=embedder,
+            )
+        return TechSupportChatbot.build_store(embedder=embedder)
 
-        # Backend switch via env var: BACKEND={vllm|hf}, default vllm
+    def _load_engine(self, model_id: str):
+        # Backend switch via env var: BACKEND={vllm|hf|remote|stub}, default vllm
         backend = os.getenv("BACKEND", "vllm").lower()
+        if backend == "stub":
+            # No GPU: deterministic extractive answers with simulated latency
+            return StubModel(
+                answer_words=int(os.getenv("STUB_ANSWER_WORDS", "48")),
+                prefill_ms=float(os.getenv("STUB_PREFILL_MS", "0")),
+                token_ms=float(os.getenv("STUB_TOKEN_MS", "0")),
+            )
+        if backend == "remote":
+            # One engine shared by every worker, e.g. `vllm serve` on REMOTE_ENGINE_URL
+            return RemoteModel(
+                base_url=os.getenv("REMOTE_ENGINE_URL", "http://127.0.0.1:8001"),
+                model_id=os.getenv("REMOTE_MODEL_ID", model_id),
+                api_key=os.getenv("REMOTE_ENGINE_KEY"),
+            )
         if backend == "hf":
-            self.model = DirectHFModel(
+            return DirectHFModel(
                 model_id=model_id,
-                hf_token=hf_token,
+                hf_token=self.hf_token,
                 device_map="auto",
                 torch_dtype="auto",
                 max_new_tokens=512,
@@ -208,52 +765,327 @@ class TechSupportChatbot:
                 top_p=0.95,
                 repetition_penalty=1.05,
             )
+        # vLLM sized at start-up by kv_planner: max length from the prompt
+        # budget, concurrency and KV dtype (FP8 only on SM90+) from free memory
+        return VLLMModel(
+            model_id=model_id,
+            quantization=os.getenv("VLLM_QUANT", "fp8"),
+            kv_cache_dtype=os.getenv("KV_CACHE_DTYPE") or None,
+            gpu_mem_util=float(os.getenv("GPU_MEM_UTIL", "0.92")),
+            max_new_tokens=1024,
+            temperature=0.7,
+            top_p=0.95,
+            repetition_penalty=1.05,
+            hf_token=self.hf_token or os.getenv("HF_TOKEN"),
+            prompt_budget=int(os.getenv("PROMPT_BUDGET_TOKENS", "3072")),
+            output_budget=int(os.getenv("MAX_TOKENS_LIMIT", "2048")),
+            max_model_len=int(os.environ["VLLM_MAX_MODEL_LEN"]) if os.getenv("VLLM_MAX_MODEL_LEN") else None,
+            max_num_seqs=int(os.environ["VLLM_MAX_NUM_SEQS"]) if os.getenv("VLLM_MAX_NUM_SEQS") else None,
+        )
+
+    def _load_model(self, model_id: str, warm_up: bool = False):
+        engine = self._load_engine(model_id)
+        if warm_up:
+            # Straight to the engine: it is not serving yet, so nothing to queue behind
+            engine.generate("User: hello\nAssistant:", overrides=GenerationOverrides(max_tokens=8, temperature=0.0))
+        if not os.getenv("SCHED_SLOTS"):
+            # vLLM batches up to its planned max_num_seqs per decode step; HF/stub/remote run one call at a time
+            self.scheduler.resize(getattr(engine, "concurrency", 1))
+        model = ScheduledModel(engine, self.scheduler, expected_output=int(os.getenv("SCHED_EXPECTED_TOKENS", "256")))
+        # Prompt/completion tokens of each engine call, charged to the request's API key
+        return MeteredModel(model)
+
+    @property
+    def retriever(self) -> SimpleFaissStore:
+        return self.deployments.current().retriever
+
+    @property
+    def model(self):
+        return self.deployments.current().model
+
+    def build_deployment(
+        self,
+        model_id: Optional[str] = None,
+        index_path: Optional[str] = None,
+        rebuild_index: bool = False,
+    ) -> Deployment:
+        """
+        Load and warm up a replacement deployment (base bot only). Whatever is
+        not being replaced is reused from the active one.
+        """
+        active = self.deployments.active
+        if index_path or rebuild_index:
+            retriever = self._load_retriever(index_path, rebuild=rebuild_index)
+            retriever.search("printer not working", k=1)  # page in the index, warm the encoder
         else:
-            # vLLM with INT8 and default KV cache (no FP8) — works on A100/A10/RTX, etc.
-            self.model = VLLMModel(
-                model_id=model_id,
-                quantization=os.getenv("VLLM_QUANT", "fp8"),
-                kv_cache_dtype=None,
-                gpu_mem_util=float(os.getenv("GPU_MEM_UTIL", "0.92")),
-                max_new_tokens=1024,
-                temperature=0.7,
-                top_p=0.95,
-                repetition_penalty=1.05,
-                hf_token=hf_token or os.getenv("HF_TOKEN"),
-            )
+            retriever = active.retriever
+        if model_id:
+            model = self._load_model(model_id, warm_up=True)
+        else:
+            model, model_id = active.model, active.model_id
+        return Deployment(retriever, model, model_id)
 
-        self.chat_history: List[Tuple[str, str]] = []
-        self.top_k = top_k
+    @classmethod
+    def build_store(cls, embedder=None, chunk_size: int = 400, overlap: int = 100) -> SimpleFaissStore:
+        """Embed the knowledge base file into a fresh in-memory store."""
+        INDEX_DIR.mkdir(exist_ok=True)
+        if not KB_FILE.exists():
+            KB_FILE.write_text(KNOWLEDGE_BASE, encoding="utf-8")
+        store = SimpleFaissStore(
+            EMBED_MODEL,
+            index_dtype=os.getenv("INDEX_DTYPE", "float32"),
+            query_backend=os.getenv("EMBED_QUERY_BACKEND", "torch"),
+            cache=RETRIEVAL_CACHE,
+            embedder=embedder,
+        )
+        raw = KB_FILE.read_text(encoding="utf-8")
+        # The _split_text windows, plus where each chunk sits in the KB
+        spans = word_spans(raw, chunk_size=chunk_size, overlap=overlap)
+        chunks = [" ".join(raw[start:end].split()) for start, end in spans]
+        store.add_texts(chunks, sections=section_titles(raw, [start for start, _ in spans]), spans=spans)
+        return store
+
+    def new_session(self) -> "TechSupportChatbot":
+        return TechSupportChatbot(top_k=self.top_k, shared=self)
 
     @staticmethod
     def _split_text(text: str, chunk_size: int = 300, overlap: int = 100) -> List[str]:
-        words = text.split()
-        chunks = []
-        i = 0
-        while i < len(words):
-            chunk = words[i: i + chunk_size]
-            chunks.append(" ".join(chunk))
-            i += max(1, chunk_size - overlap)
-        return chunks
+        """Chunk texts without their spans (benchmarks); the same windows as build_store()."""
+        return [" ".join(text[start:end].split()) for start, end in word_spans(text, chunk_size, overlap)]
+
+    def retrieve(
+        self,
+        query: str,
+        top_k: Optional[int] = None,
+        rerank: bool = True,
+        gate: Optional[RetrievalGate] = None,
+        hits: Optional[List[SearchHit]] = None,
+        reuse_cached: bool = False,
+    ) -> List[str]:
+        """
+        `hits`: this query's dense search, already run (e.g. batched by the pipeline).
+        `reuse_cached`: a cached search of the query with a larger k may stand in (degraded levels).
+        """
+        k = top_k or self.top_k
+        use_rerank = self.reranker is not None and rerank
+        if hits is None:
+            with timed("search"):
+                hits = self.retriever.search_hits(
+                    query, k=self._fetch_k(k, use_rerank), mmr_lambda=self.mmr_lambda, dedup_sim=self.dedup_sim,
+                    reuse_cached=reuse_cached,
+                )
+        if gate is not None:
+            hits = gate.filter(hits)
+        candidates = [hit.text for hit in hits]
+        if not use_rerank:
+            return candidates
+        with timed("rerank"):
+            return self.reranker.rerank(query, candidates, top_k=k)
+
+    def _fetch_k(self, k: int, use_rerank: bool) -> int:
+        # Over-fetch cheaply from the dense index when the cross-encoder picks top_k
+        return max(k, self.rerank_candidates) if use_rerank else k
 
-    def chat(self, user_input: str) -> str:
-        # Retrieve context
-        ctx = self.retriever.search(user_input, k=self.top_k)
+    def search_plan(self, user_msg: str, level: DegradationLevel = FULL) -> Optional[int]:
+        """Hits the dense search for this chat turn would fetch, or None if the gate skips or reuses."""
+        if self.gate is not None and self.gate.decide(user_msg, previous=self._last_ctx) != RETRIEVE:
+            return None
+        return self._fetch_k(level.top_k or self.top_k, self.reranker is not None and level.rerank)
 
-        # Build prompt with history + context
-        prompt = build_prompt(ctx, self.chat_history, user_input)
+    def _gated_retrieve(
+        self,
+        user_msg: str,
+        level: DegradationLevel,
+        previous: Optional[List[str]] = None,
+        hits: Optional[List[SearchHit]] = None,
+    ) -> List[str]:
+        """retrieve() behind the adaptive gate: skip, reuse `previous`, or search + filter."""
+        if self.gate is None:
+            return self.retrieve(user_msg, top_k=level.top_k, rerank=level.rerank, hits=hits,
+                                 reuse_cached=level.reuse_cached)
+        k = level.top_k or self.top_k
+        decision = self.gate.decide(user_msg, previous=previous)
+        if decision == SKIP:
+            ctx = []
+        elif decision == REUSE:
+            ctx = previous[:k]
+        else:
+            ctx = self.retrieve(user_msg, top_k=k, rerank=level.rerank, gate=self.gate, hits=hits,
+                                reuse_cached=level.reuse_cached)
+        self.gate.record(decision, k, ctx)
+        return ctx
+
+    @staticmethod
+    def _trim_history(history: List[Tuple[str, str]], level: DegradationLevel) -> List[Tuple[str, str]]:
+        if level.history_turns is None:
+            return history
+        return history[-level.history_turns:] if level.history_turns > 0 else []
 
-        # Generate
-        answer = self.model.generate(prompt)
+    def _prepare(
+        self,
+        user_input: str,
+        level: DegradationLevel = FULL,
+        hits: Optional[List[SearchHit]] = None,
+    ) -> Tuple[List[str], str]:
+        # Retrieve context (or reuse the last turn's for a follow-up)
+        ctx = self._gated_retrieve(user_input, level, previous=self._last_ctx, hits=hits)
+        if ctx:
+            # Kept across "thanks" turns so a later follow-up still has it
+            self._last_ctx = ctx
+        if level.retrieval_only:
+            return ctx, ""
+
+        # Build prompt with summary + recent history + context
+        with timed("prompt"):
+            summary, history = self.memory.prompt_view()
+            history = self._trim_history(history, level)
+            prompt = build_prompt(ctx, history, user_input, summary=summary)
+        annotate(prompt_tokens=approx_tokens(prompt), context_chunks=len(ctx), history_turns=len(history))
+        return ctx, prompt
 
+    @staticmethod
+    def clip_turn(answer: str) -> str:
         # Clip if model tries to start another turn
         for marker in ["\nUser:", "\nYou:", "\n\nUser:", "\n\nYou:"]:
             if marker in answer:
                 answer = answer.split(marker)[0].strip()
+        return answer
 
-        # Update history
-        self.chat_history.append((user_input, answer))
+    def _finish(self, user_input: str, answer: str) -> str:
+        answer = self.clip_turn(answer)
+
+        # Update history (may schedule a background summary)
+        self.memory.add_turn(user_input, answer)
         return answer
 
+    def retrieve_batch(self, queries: List[str]) -> List[List[str]]:
+        k = self.top_k if self.reranker is None else max(self.top_k, self.rerank_candidates)
+        hits = self.retriever.search_hits_batch(queries, k=k, mmr_lambda=self.mmr_lambda, dedup_sim=self.dedup_sim)
+        candidates = [[hit.text for hit in row] for row in hits]
+        if self.reranker is None:
+            return candidates
+        return [self.reranker.rerank(q, c, top_k=self.top_k) for q, c in zip(queries, candidates)]
+
+    def _generate(self, prompt: str, gen: GenerationOverrides, cancel: Optional[CancelToken] = None) -> str:
+        if GENERATION_FLIGHT is None:
+            return self.model.generate(prompt, overrides=gen, cancel=cancel)
+        key = (hashlib.sha1(prompt.encode("utf-8")).digest(), gen)
+        while True:
+            try:
+                # Metered once; every request sharing the call is charged for it
+                text, prompt_tokens, completion_tokens = GENERATION_FLIGHT.do(
+                    key, lambda: measure(lambda: self.model.generate(prompt, overrides=gen, cancel=cancel)), cancel
+                )
+                charge(prompt_tokens, completion_tokens)
+                return text
+            except GenerationCancelled:
+                # The leader's client left; if ours is still here, run it ourselves
+                if cancel is not None and cancel.cancelled:
+                    raise
+
+    def chat(
+        self,
+        user_input: str,
+        level: DegradationLevel = FULL,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        ctx, prompt = self._prepare(user_input, level)
+        return self._finish(user_input, self._answer(ctx, prompt, level, overrides, cancel))
+
+    def _answer(
+        self,
+        ctx: List[str],
+        prompt: str,
+        level: DegradationLevel,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        """Raw reply to a prepared turn (not yet clipped or recorded)."""
+        if level.retrieval_only:
+            return retrieval_only_answer(ctx)
+        gen = (overrides or DEFAULT_OVERRIDES).capped(level.max_tokens)
+        with timed("generate"):
+            return self._generate(prompt, gen, cancel)
+
+    def chat_stream(
+        self,
+        user_input: str,
+        level: DegradationLevel = FULL,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+        hits: Optional[List[SearchHit]] = None,
+    ) -> Iterator[str]:
+        """
+        Like chat(), but yields the reply as it is generated. The turn is only
+        recorded once the stream has been consumed to the end. `hits` is the
+        turn's search if it already ran (ChatPipeline.search()).
+        """
+        ctx, prompt = self._prepare(user_input, level, hits=hits)
+        if level.retrieval_only:
+            answer = retrieval_only_answer(ctx)
+            yield answer
+            self._finish(user_input, answer)
+            return
+        gen = (overrides or DEFAULT_OVERRIDES).capped(level.max_tokens)
+        parts = []
+        # Includes the time the consumer takes per delta (usually just a socket write)
+        with timed("generate"):
+            for delta in self.model.stream(prompt, overrides=gen, cancel=cancel):
+                parts.append(delta)
+                yield delta
+        self._finish(user_input, "".join(parts).strip())
+
+    # ---------------------------
+    # Stateless API: caller supplies the history, session memory is untouched
+    # ---------------------------
+
+    def answer_batch(
+        self,
+        requests: List[Tuple[str, List[Tuple[str, str]]]],
+        n: int = 1,
+        level: DegradationLevel = FULL,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        """
+        RAG over independent (user_msg, history) pairs. Retrieval runs per
+        request, generation is one batched engine call for all prompts.
+        Returns n candidate answers per request.
+        """
+        contexts = [self._gated_retrieve(msg, level) for msg, _ in requests]
+        if level.retrieval_only:
+            return [[retrieval_only_answer(ctx)] * n for ctx in contexts]
+        prompts = [
+            build_prompt(ctx, self._trim_history(history, level), msg)
+            for ctx, (msg, history) in zip(contexts, requests)
+        ]
+        annotate(prompt_tokens=sum(approx_tokens(p) for p in prompts), prompts=len(prompts))
+        gen = (overrides or DEFAULT_OVERRIDES).capped(level.max_tokens)
+        with timed("generate"):
+            outputs = self.model.generate_batch(prompts, n=n, overrides=gen, cancel=cancel)
+        return [[self.clip_turn(a) for a in cands] for cands in outputs]
+
+    def answer_stream(
+        self,
+        user_msg: str,
+        history: List[Tuple[str, str]],
+        level: DegradationLevel = FULL,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        ctx = self._gated_retrieve(user_msg, level)
+        if level.retrieval_only:
+            return iter([retrieval_only_answer(ctx)])
+        prompt = build_prompt(ctx, self._trim_history(history, level), user_msg)
+        annotate(prompt_tokens=approx_tokens(prompt), context_chunks=len(ctx))
+        gen = (overrides or DEFAULT_OVERRIDES).capped(level.max_tokens)
+        return self.model.stream(prompt, overrides=gen, cancel=cancel)
+
+    @property
+    def chat_history(self) -> List[Tuple[str, str]]:
+        return self.memory.history()
+
     def reset(self):
-        self.chat_history.clear()
+        self.memory.clear()
+        self._last_ctx = None
@@ -0,0 +1,304 @@
+"""
+Startup sizing for the vLLM engine: GPU memory utilization, max model length,
+max concurrent sequences and KV cache dtype, derived from the model config,
+the prompt budget and the memory actually free on the GPU.
+
+Everything here is plain arithmetic on the inputs (no torch / vllm imports),
+so a plan can be computed and checked without a GPU:
+
+    python kv_planner.py --model meta-llama/Llama-3.1-8B-Instruct --gpu-gib 24 --capability 8.6
+"""
+import argparse
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+GIB = 1024 ** 3
+
+# Bytes per weight for each quantization method (model dtype when unlisted)
+WEIGHT_BYTES = {"fp8": 1.0, "int8": 1.0, "awq": 0.5, "gptq": 0.5, "bitsandbytes": 0.5, "gguf": 0.5}
+KV_FP8_DTYPES = ("fp8", "fp8_e4m3", "fp8_e5m2")
+
+# Headroom outside weights + KV cache: activations during profiling, and
+# captured CUDA graphs unless the engine runs eager
+ACTIVATION_RESERVE = 1.0 * GIB
+CUDA_GRAPH_RESERVE = 0.5 * GIB
+# Left free when other processes (e.g. the embedder) already hold GPU memory
+FREE_MEMORY_MARGIN = 0.5 * GIB
+# vLLM's own default for max_num_seqs
+DEFAULT_MAX_NUM_SEQS = 256
+
+
+@dataclass(frozen=True)
+class ModelShape:
+    """The parts of a HF model config that decide weight and KV cache size."""
+    num_layers: int
+    num_kv_heads: int
+    head_dim: int
+    max_position_embeddings: int
+    num_params: int
+    dtype_bytes: int = 2
+
+    @classmethod
+    def from_hf_config(cls, cfg) -> "ModelShape":
+        cfg = getattr(cfg, "text_config", None) or cfg
+        hidden = cfg.hidden_size
+        layers = cfg.num_hidden_layers
+        heads = cfg.num_attention_heads
+        kv_heads = getattr(cfg, "num_key_value_heads", None) or heads
+        head_dim = getattr(cfg, "head_dim", None) or hidden // heads
+        inter = getattr(cfg, "intermediate_size", None) or 4 * hidden
+        experts = getattr(cfg, "num_local_experts", None) or getattr(cfg, "num_experts", None) or 1
+        vocab = cfg.vocab_size
+        # q/o + k/v projections, gated MLP (per expert), embeddings (+ untied LM head)
+        attn = 2 * hidden * heads * head_dim + 2 * hidden * kv_heads * head_dim
+        mlp = 3 * hidden * inter * experts
+        embed = vocab * hidden * (1 if getattr(cfg, "tie_word_embeddings", False) else 2)
+        dtype = str(getattr(cfg, "torch_dtype", None) or "bfloat16")
+        return cls(
+            num_layers=layers,
+            num_kv_heads=kv_heads,
+            head_dim=head_dim,
+            max_position_embeddings=getattr(cfg, "max_position_embeddings", None) or 4096,
+            num_params=layers * (attn + mlp) + embed,
+            dtype_bytes=4 if dtype.endswith("float32") else 2,
+        )
+
+    def weight_bytes(self, quantization: Optional[str], tp: int = 1) -> float:
+        per_weight = WEIGHT_BYTES.get(quantization or "", float(self.dtype_bytes))
+        return self.num_params * per_weight / max(1, tp)
+
+    def kv_bytes_per_token(self, kv_cache_dtype: str, tp: int = 1) -> int:
+        """K and V for every layer, on one GPU of a tensor-parallel group."""
+        per_value = 1 if kv_cache_dtype in KV_FP8_DTYPES else self.dtype_bytes
+        kv_heads = max(1, self.num_kv_heads // max(1, tp))
+        return 2 * self.num_layers * kv_heads * self.head_dim * per_value
+
+
+@dataclass(frozen=True)
+class GPUInfo:
+    total_bytes: int
+    free_bytes: int
+    capability: Tuple[int, int] = (8, 0)
+
+    @property
+    def supports_fp8_kv(self) -> bool:
+        return self.capability >= (9, 0)  # Hopper (SM90+) and newer
+
+
+@dataclass(frozen=True)
+class EnginePlan:
+    gpu_mem_util: float
+    quantization: Optional[str]
+    kv_cache_dtype: str = "auto"
+    max_model_len: Optional[int] = None
+    max_num_seqs: Optional[int] = None
+    enforce_eager: bool = False
+    kv_tokens: Optional[int] = None
+    reasons: Tuple[str, ...] = field(default=(), compare=False)
+
+    def engine_kwargs(self) -> Dict:
+        kwargs = {"gpu_memory_utilization": self.gpu_mem_util}
+        if self.quantization:
+            kwargs["quantization"] = self.quantization
+        if self.kv_cache_dtype != "auto":
+            kwargs["kv_cache_dtype"] = self.kv_cache_dtype
+        if self.max_model_len is not None:
+            kwargs["max_model_len"] = self.max_model_len
+        if self.max_num_seqs is not None:
+            kwargs["max_num_seqs"] = self.max_num_seqs
+        if self.enforce_eager:
+            kwargs["enforce_eager"] = True
+        return kwargs
+
+    def as_dict(self) -> Dict:
+        return {**self.engine_kwargs(), "kv_tokens": self.kv_tokens, "reasons": list(self.reasons)}
+
+
+def plan_engine(
+    shape: Optional[ModelShape],
+    gpu: Optional[GPUInfo],
+    gpu_mem_util: float = 0.92,
+    quantization: Optional[str] = None,
+    tp: int = 1,
+    prompt_budget: int = 3072,
+    output_budget: int = 1024,
+    kv_cache_dtype: Optional[str] = None,
+    max_model_len: Optional[int] = None,
+    max_num_seqs: Optional[int] = None,
+    enforce_eager: bool = False,
+    target_seqs: int = 16,
+) -> EnginePlan:
+    """
+    Size the engine for `prompt_budget + output_budget` tokens per sequence.
+    Explicit kv_cache_dtype / max_model_len / max_num_seqs are kept as given
+    (with a warning reason if they look unworkable). Every decision is
+    recorded in `reasons`.
+    """
+    reasons: List[str] = []
+    if shape is None or gpu is None:
+        reasons.append(
+            f"{'model config' if shape is None else 'GPU memory'} unavailable: "
+            "leaving sizing to vLLM defaults"
+        )
+        return EnginePlan(
+            gpu_mem_util, quantization, kv_cache_dtype or "auto", max_model_len, max_num_seqs,
+            enforce_eager, None, tuple(reasons),
+        )
+
+    # 1. Memory budget: never ask for more than is actually free
+    util = gpu_mem_util
+    available = gpu.free_bytes - FREE_MEMORY_MARGIN
+    if gpu.total_bytes * util > available:
+        util = max(0.05, int(available / gpu.total_bytes * 100) / 100)
+        reasons.append(
+            f"gpu_mem_util={util:.2f} (requested {gpu_mem_util:.2f}): only {gpu.free_bytes / GIB:.1f} of "
+            f"{gpu.total_bytes / GIB:.1f} GiB free, other processes hold the rest"
+        )
+    else:
+        reasons.append(f"gpu_mem_util={util:.2f}: {gpu.total_bytes * util / GIB:.1f} GiB for the engine")
+
+    weights = shape.weight_bytes(quantization, tp)
+    reserve = ACTIVATION_RESERVE + (0 if enforce_eager else CUDA_GRAPH_RESERVE)
+    kv_budget = gpu.total_bytes * util - weights - reserve
+    reasons.append(
+        f"KV budget {max(0.0, kv_budget) / GIB:.1f} GiB = engine share - weights ~{weights / GIB:.1f} GiB "
+        f"({quantization or 'unquantized'}) - reserve {reserve / GIB:.1f} GiB"
+    )
+    kv_budget = max(0.0, kv_budget)
+
+    # 2. Max model length: what the prompt budget needs, not the model's full context
+    needed = prompt_budget + output_budget
+    if max_model_len is not None:
+        length = max_model_len
+        reasons.append(f"max_model_len={length}: set explicitly")
+    else:
+        length = min(needed, shape.max_position_embeddings)
+        reasons.append(
+            f"max_model_len={length}: prompt budget {prompt_budget} + output {output_budget} "
+            f"(model supports {shape.max_position_embeddings})"
+        )
+
+    # 3. KV cache dtype: fp8 halves the cache, only worth it when the model
+    # dtype cache can't hold `target_seqs` full-length sequences
+    auto_tokens = int(kv_budget // shape.kv_bytes_per_token("auto", tp))
+    if kv_cache_dtype is not None and kv_cache_dtype != "auto":
+        if kv_cache_dtype in KV_FP8_DTYPES and not gpu.supports_fp8_kv:
+            kv_dtype = "auto"
+            reasons.append(
+                f"kv_cache_dtype=auto: {kv_cache_dtype} requested but SM{gpu.capability[0]}{gpu.capability[1]} "
+                "has no FP8 KV support"
+            )
+        else:
+            kv_dtype = kv_cache_dtype
+            reasons.append(f"kv_cache_dtype={kv_dtype}: set explicitly")
+    elif kv_cache_dtype is None and gpu.supports_fp8_kv and auto_tokens < target_seqs * length:
+        kv_dtype = "fp8_e4m3"
+        reasons.append(
+            f"kv_cache_dtype=fp8_e4m3: model dtype cache fits {auto_tokens // max(1, length)} full sequences, "
+            f"fewer than {target_seqs}; FP8 doubles that"
+        )
+    else:
+        kv_dtype = "auto"
+        why = "set explicitly" if kv_cache_dtype == "auto" else (
+            f"cache fits {auto_tokens // max(1, length)} full sequences" if gpu.supports_fp8_kv
+            else f"SM{gpu.capability[0]}{gpu.capability[1]} has no FP8 KV support"
+        )
+        reasons.append(f"kv_cache_dtype=auto (model dtype): {why}")
+    kv_tokens = int(kv_budget // shape.kv_bytes_per_token(kv_dtype, tp))
+
+    # 4. The cache must hold at least one full sequence or vLLM refuses to start
+    if kv_tokens < length:
+        if max_model_len is None and kv_tokens >= 256:
+            length = kv_tokens // 256 * 256
+            reasons.append(
+                f"max_model_len={length}: KV cache holds only {kv_tokens} tokens; "
+                f"longer prompts will be rejected"
+            )
+        else:
+            reasons.append(f"warning: KV cache estimate ({kv_tokens} tokens) is below max_model_len={length}")
+
+    # 5. Concurrency: as many full-length sequences as the cache holds without preemption
+    if max_num_seqs is not None:
+        seqs = max_num_seqs
+        reasons.append(f"max_num_seqs={seqs}: set explicitly")
+    else:
+        seqs = max(1, min(DEFAULT_MAX_NUM_SEQS, kv_tokens // max(1, length)))
+        reasons.append(f"max_num_seqs={seqs}: {kv_tokens} KV tokens / {length} per sequence")
+
+    if enforce_eager:
+        reasons.append("enforce_eager=True: CUDA graphs disabled")
+    return EnginePlan(util, quantization, kv_dtype, length, seqs, enforce_eager, kv_tokens, tuple(reasons))
+
+
+_KV_CAPACITY_RE = re.compile(r"stored in kv cache \((\d+)\)")
+_FREE_MEMORY_RE = re.compile(r"free memory on device \(([\d.]+)/([\d.]+) gib\)")
+
+
+def fallback(plan: EnginePlan, error: BaseException) -> Optional[Tuple[Dict, str]]:
+    """
+    Map an engine start-up failure to the one plan input that caused it.
+    Returns (plan_engine keyword changes, reason), or None when the error is
+    not something a different plan can fix (re-raise it).
+    """
+    msg = str(error).lower()
+    if plan.kv_cache_dtype != "auto" and any(k in msg for k in ("kv_cache_dtype", "kv cache dtype", "fp8", "kv_scale")):
+        return {"kv_cache_dtype": "auto"}, f"{plan.kv_cache_dtype} KV cache rejected; using the model dtype"
+
+    if "free memory on device" in msg:
+        match = _FREE_MEMORY_RE.search(msg)
+        util = float(match.group(1)) / float(match.group(2)) - 0.02 if match else plan.gpu_mem_util - 0.05
+        util = int(util * 100) / 100
+        if 0.05 <= util < plan.gpu_mem_util:
+            return {"gpu_mem_util": util}, f"not enough free GPU memory for {plan.gpu_mem_util:.2f}; trying {util:.2f}"
+
+    if "max seq len" in msg or "max_model_len" in msg:
+        match = _KV_CAPACITY_RE.search(msg)
+        current = plan.max_model_len or 0
+        length = int(match.group(1)) // 256 * 256 if match else current // 2
+        if 256 <= length < current or (match and not current):
+            return {"max_model_len": length}, f"KV cache too small for max_model_len={current}; trying {length}"
+
+    if any(k in msg for k in ("cuda graph", "cudagraph", "graph capture")) and not plan.enforce_eager:
+        return {"enforce_eager": True}, "CUDA graph capture failed; running eager"
+
+    if "out of memory" in msg:
+        if plan.max_num_seqs is not None and plan.max_num_seqs > 8:
+            seqs = plan.max_num_seqs // 2
+            return {"max_num_seqs": seqs}, f"out of memory with max_num_seqs={plan.max_num_seqs}; trying {seqs}"
+        if not plan.enforce_eager:
+            return {"enforce_eager": True}, "out of memory at minimum concurrency; dropping CUDA graphs"
+
+    if plan.quantization and "quantization" in msg:
+        return {"quantization": None}, f"quantization={plan.quantization} not supported here; loading unquantized"
+    return None
+
+
+if __name__ == "__main__":
+    from transformers import AutoConfig
+
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--model", default="meta-llama/Llama-3.1-8B-Instruct")
+    ap.add_argument("--gpu-gib", type=float, default=24.0)
+    ap.add_argument("--free-gib", type=float, default=None, help="free memory (default: all of it)")
+    ap.add_argument("--capability", default="8.0", help="CUDA compute capability, e.g. 9.0 for H100")
+    ap.add_argument("--gpu-mem-util", type=float, default=0.92)
+    ap.add_argument("--quantization", default="fp8")
+    ap.add_argument("--tp", type=int, default=1)
+    ap.add_argument("--prompt-budget", type=int, default=3072)
+    ap.add_argument("--output-budget", type=int, default=2048)
+    args = ap.parse_args()
+
+    major, minor = (int(x) for x in args.capability.split("."))
+    plan = plan_engine(
+        ModelShape.from_hf_config(AutoConfig.from_pretrained(args.model)),
+        GPUInfo(int(args.gpu_gib * GIB), int((args.free_gib or args.gpu_gib) * GIB), (major, minor)),
+        gpu_mem_util=args.gpu_mem_util,
+        quantization=args.quantization or None,
+        tp=args.tp,
+        prompt_budget=args.prompt_budget,
+        output_budget=args.output_budget,
+    )
+    for reason in plan.reasons:
+        print(reason)
+    print(plan.engine_kwargs())
@@ -0,0 +1,141 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+
+Turn = Tuple[str, str]
+
+# One worker shared by every session: summaries run after the reply has been
+# returned and queue up behind each other instead of piling onto the engine.
+_SUMMARY_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-summary")
+
+
+def build_summary_prompt(summary: str, turns: List[Turn]) -> str:
+    convo = "".join(f"User: {u}\nAssistant: {a}\n" for u, a in turns)
+    return (
+        "Summarize this tech support conversation for the assistant's own notes. "
+        "Keep the user's device/OS, error messages and codes, steps already tried "
+        "and their outcome, and what is still unresolved. Use at most 120 words.\n\n"
+        f"Previous summary:\n{summary if summary else '(none)'}\n\n"
+        f"New turns:\n{convo}\n"
+        "Updated summary:"
+    )
+
+
+def _clip_words(text: str, max_words: int) -> str:
+    words = text.split()
+    if max_words <= 0 or len(words) <= max_words:
+        return text
+    return " ".join(words[:max_words]) + " …"
+
+
+class ConversationMemory:
+    """
+    Bounded conversation history: the last `keep_turns` turns are kept raw,
+    older turns are folded into a running summary by `summarize(prompt)` on a
+    background thread. Without a summarizer older turns are simply dropped.
+    """
+
+    def __init__(
+        self,
+        summarize: Optional[Callable[[str], str]] = None,
+        keep_turns: int = 4,
+        max_pending: int = 8,
+        max_answer_words: int = 120,
+        on_summary: Optional[Callable[[], None]] = None,
+    ):
+        self.summarize = summarize
+        # Called after a background summary is folded in, e.g. to persist the snapshot
+        self.on_summary = on_summary
+        self.keep_turns = max(1, keep_turns)
+        self.max_pending = max(1, max_pending)
+        self.max_answer_words = max_answer_words
+
+        self.summary = ""
+        self.turns: List[Turn] = []
+        # Turns evicted from the raw window but not yet folded into the summary
+        self._pending: List[Turn] = []
+        self._lock = threading.Lock()
+        self._future: Optional[Future] = None
+        self._epoch = 0  # bumped by clear() so stale summaries are discarded
+
+    def add_turn(self, user_msg: str, answer: str) -> None:
+        with self._lock:
+            self.turns.append((user_msg, answer))
+            self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        if len(self.turns) <= self.keep_turns:
+            return
+        evicted, self.turns = self.turns[:-self.keep_turns], self.turns[-self.keep_turns:]
+        if self.summarize is None:
+            return
+        self._pending.extend(evicted)
+        # If the summarizer falls behind, drop the oldest unsummarized turns
+        del self._pending[:-self.max_pending]
+        if self._future is None or self._future.done():
+            self._future = _SUMMARY_EXECUTOR.submit(self._fold_pending, self._epoch)
+
+    def _fold_pending(self, epoch: int) -> None:
+        while True:
+            with self._lock:
+                if epoch != self._epoch or not self._pending:
+                    return
+                batch = list(self._pending)
+                prompt = build_summary_prompt(self.summary, batch)
+            try:
+                summary = self.summarize(prompt).strip()
+            except Exception:
+                # Keep the raw turns; the next eviction retries
+                return
+            with self._lock:
+                if epoch != self._epoch:
+                    return
+                self.summary = summary
+                # max_pending trimming may have dropped some of `batch` meanwhile
+                folded = {id(t) for t in batch}
+                self._pending = [t for t in self._pending if id(t) not in folded]
+            if self.on_summary is not None:
+                self.on_summary()
+
+    def prompt_view(self) -> Tuple[str, List[Turn]]:
+        """
+        (summary, turns) to render into the next prompt. Answers of all but the
+        most recent turn are clipped; the latest one is usually what the user
+        is following up on.
+        """
+        with self._lock:
+            turns = self._pending + self.turns
+            summary = self.summary
+        clipped = [(u, _clip_words(a, self.max_answer_words)) for u, a in turns[:-1]]
+        return summary, clipped + turns[-1:]
+
+    def history(self) -> List[Turn]:
+        with self._lock:
+            return self._pending + self.turns
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """Block until any in-flight summary has been folded in (tests, benchmarks, shutdown)."""
+        fut = self._future
+        if fut is not None:
+            fut.result(timeout=timeout)
+
+    def snapshot(self) -> Tuple[str, List[Turn]]:
+        """(summary, unsummarized turns): everything needed to restore() this memory."""
+        with self._lock:
+            return self.summary, self._pending + self.turns
+
+    def restore(self, summary: str, turns: List[Turn]) -> None:
+        with self._lock:
+            self._epoch += 1
+            self.summary = summary
+            self._pending = []
+            self.turns = list(turns)
+            self._evict_locked()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+            self.summary = ""
+            self.turns.clear()
+            self._pending.clear()
@@ -0,0 +1,356 @@
+"""
+Chat turns as a staged pipeline instead of one threadpool thread per request:
+
+    search -> prompt -> generate -> postprocess
+
+Each stage has its own worker threads and a bounded queue in front of it.
+The search stage takes everything queued (up to a batch) and embeds + searches
+it in one call; the prompt stage gates, reranks and builds prompts; generation
+workers keep the engine's scheduler fed. Retrieval for queued turns therefore
+runs while the GPU decodes earlier ones, and the embedder sees batches instead
+of one query per thread. A full queue blocks the stage feeding it, and a full
+search queue rejects new turns (PipelineFull) rather than queueing them without
+bound.
+
+Every job carries a copy of the submitting request's context (scheduler job,
+usage meter, pinned deployment) and all of its per-turn work runs inside it.
+"""
+import contextvars
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cancellation import CancelToken, GenerationCancelled
+from degradation import FULL, DegradationLevel
+from generation import GenerationOverrides
+from profiling import shared_trace, trace_in
+
+
+class PipelineFull(Exception):
+    """The search queue is full; the caller should shed the request."""
+
+
+class PipelineClosed(PipelineFull):
+    """The pipeline is shutting down; shed the request like PipelineFull."""
+
+
+class _Job:
+    __slots__ = ("bot", "message", "level", "overrides", "cancel", "last", "context", "future",
+                 "hits", "ctx", "prompt", "answer", "enqueued")
+
+    def __init__(self, bot, message: str, level: DegradationLevel, overrides: Optional[GenerationOverrides],
+                 cancel: Optional[CancelToken], last: str):
+        self.bot = bot
+        self.message = message
+        self.level = level
+        self.overrides = overrides
+        self.cancel = cancel
+        self.last = last
+        # Scheduler job, usage and pinned deployment of the request that submitted it
+        self.context = contextvars.copy_context()
+        self.future: Future = Future()
+        self.future.set_running_or_notify_cancel()
+        self.hits = None
+        self.ctx: Optional[List[str]] = None
+        self.prompt: Optional[str] = None
+        self.answer: Optional[str] = None
+        self.enqueued = 0.0
+
+    def fail(self, exc: BaseException) -> None:
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+_STOP = object()
+
+
+class Stage:
+    """
+    `workers` threads serving one bounded queue. Each worker takes one job,
+    plus whatever else is already queued up to `max_batch`, and hands the
+    batch to `fn`; jobs that come through without failing move on to `next`.
+    """
+
+    def __init__(self, name: str, fn: Callable[[List[_Job]], None], workers: int = 1,
+                 max_batch: int = 1, queue_size: int = 64):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.max_batch = max(1, max_batch)
+        self.queue: queue.Queue = queue.Queue(maxsize=max(1, queue_size))
+        self.next: Optional["Stage"] = None
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.closed = False
+        self.jobs = 0
+        self.batches = 0
+        self.busy_s = 0.0
+        self.wait_s = 0.0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name=f"pipeline-{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self) -> None:
+        """Finish what is queued, stop the workers, then fail anything that arrives after."""
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self.closed = True
+        self._drain()
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if job is not _STOP:
+                job.fail(PipelineClosed(f"pipeline stage {self.name} is closed"))
+
+    def put(self, job: _Job, block: bool = True) -> None:
+        if self.closed:
+            raise PipelineClosed(f"pipeline stage {self.name} is closed")
+        job.enqueued = time.perf_counter()
+        if not block:
+            self.queue.put(job, block=False)
+        else:
+            # Wake up now and then so a stage closing downstream can't strand us
+            while True:
+                try:
+                    self.queue.put(job, timeout=0.1)
+                    break
+                except queue.Full:
+                    if self.closed:
+                        raise PipelineClosed(f"pipeline stage {self.name} is closed")
+        if self.closed:
+            # Raced with stop(): nobody will take it
+            self._drain()
+
+    def _take(self) -> Tuple[List[_Job], bool]:
+        """Block for one job, then drain up to max_batch. (batch, stop requested)"""
+        first = self.queue.get()
+        if first is _STOP:
+            return [], True
+        batch, stop = [first], False
+        while len(batch) < self.max_batch:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is _STOP:
+                stop = True
+                break
+            batch.append(job)
+        return batch, stop
+
+    def _work(self) -> None:
+        while True:
+            batch, stop = self._take()
+            if batch:
+                self._run(batch)
+            if stop:
+                return
+
+    def _run(self, batch: List[_Job]) -> None:
+        started = time.perf_counter()
+        live = []
+        for job in batch:
+            trace = trace_in(job.context)
+            if trace is not None:
+                trace.add(f"queue_{self.name}", started - job.enqueued)
+            # Client left while the turn was queued: drop it before doing any work
+            if job.cancel is not None and job.cancel.cancelled:
+                job.fail(GenerationCancelled())
+            else:
+                live.append(job)
+        if live:
+            try:
+                self.fn(live)
+            except Exception as exc:
+                for job in live:
+                    job.fail(exc)
+        finished = time.perf_counter()
+        with self._lock:
+            self.jobs += len(batch)
+            self.batches += 1
+            self.busy_s += finished - started
+            self.wait_s += sum(started - job.enqueued for job in batch)
+        for job in live:
+            if job.future.done():
+                continue
+            if job.last == self.name or self.next is None:
+                job.future.set_result(job.hits if job.last == "search" else job.answer)
+            else:
+                # Blocks while the next stage is saturated: backpressure up the chain
+                try:
+                    self.next.put(job)
+                except PipelineClosed as exc:
+                    job.fail(exc)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            jobs, batches = self.jobs, self.batches
+            return {
+                "workers": self.workers,
+                "queued": self.queue.qsize(),
+                "queue_size": self.queue.maxsize,
+                "jobs": jobs,
+                "avg_batch": round(jobs / batches, 2) if batches else 0.0,
+                "avg_wait_ms": round(1000 * self.wait_s / jobs, 2) if jobs else 0.0,
+                "avg_busy_ms": round(1000 * self.busy_s / batches, 2) if batches else 0.0,
+            }
+
+
+def _each(fn: Callable[[_Job], None]) -> Callable[[List[_Job]], None]:
+    """Stage function running `fn` per job, inside the job's request context."""
+    def run(batch: List[_Job]) -> None:
+        for job in batch:
+            try:
+                job.context.run(fn, job)
+            except Exception as exc:
+                job.fail(exc)
+    return run
+
+
+class ChatPipeline:
+    """
+    submit() runs a whole chat turn (same result as bot.chat()); search() only
+    the batched search stage, for streaming turns that generate on their own
+    thread. Both return a Future.
+    """
+
+    def __init__(
+        self,
+        search_workers: int = 1,
+        search_batch: int = 16,
+        prompt_workers: int = 2,
+        generate_workers: int = 16,
+        postprocess_workers: int = 1,
+        queue_size: int = 64,
+    ):
+        self.stages = [
+            Stage("search", self._search, search_workers, max_batch=search_batch, queue_size=queue_size),
+            Stage("prompt", _each(self._prompt), prompt_workers, queue_size=queue_size),
+            Stage("generate", _each(self._generate), generate_workers, queue_size=queue_size),
+            Stage("postprocess", _each(self._postprocess), postprocess_workers, queue_size=queue_size),
+        ]
+        for stage, nxt in zip(self.stages, self.stages[1:]):
+            stage.next = nxt
+        self.rejected = 0
+        for stage in self.stages:
+            stage.start()
+
+    @classmethod
+    def from_env(cls) -> "ChatPipeline":
+        return cls(
+            search_workers=int(os.getenv("PIPELINE_SEARCH_WORKERS", "1")),
+            search_batch=int(os.getenv("PIPELINE_SEARCH_BATCH", "16")),
+            prompt_workers=int(os.getenv("PIPELINE_PROMPT_WORKERS", "2")),
+            generate_workers=int(os.getenv("PIPELINE_GENERATE_WORKERS", "16")),
+            postprocess_workers=int(os.getenv("PIPELINE_POSTPROCESS_WORKERS", "1")),
+            queue_size=int(os.getenv("PIPELINE_QUEUE_SIZE", "64")),
+        )
+
+    # ---------------------------
+    # Entry points
+    # ---------------------------
+
+    def _enqueue(self, job: _Job) -> Future:
+        try:
+            self.stages[0].put(job, block=False)
+        except queue.Full:
+            self.rejected += 1
+            raise PipelineFull("chat pipeline is full")
+        return job.future
+
+    def submit(
+        self,
+        bot,
+        message: str,
+        level: DegradationLevel = FULL,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Future:
+        """Future of the reply; the turn is recorded in `bot`'s memory like chat()."""
+        return self._enqueue(_Job(bot, message, level, overrides, cancel, last="postprocess"))
+
+    def search(self, bot, message: str, level: DegradationLevel = FULL, cancel: Optional[CancelToken] = None) -> Future:
+        """Future of the turn's search hits (None when the gate won't search), for bot.chat_stream(hits=...)."""
+        return self._enqueue(_Job(bot, message, level, None, cancel, last="search"))
+
+    def close(self) -> None:
+        """Stop stage by stage, upstream first; turns that can no longer finish fail with PipelineClosed."""
+        for stage in self.stages:
+            stage.stop()
+
+    def stats(self) -> Dict:
+        return {"rejected": self.rejected, "stages": {stage.name: stage.stats() for stage in self.stages}}
+
+    # ---------------------------
+    # Stages
+    # ---------------------------
+
+    @staticmethod
+    def _search(batch: List[_Job]) -> None:
+        # One encode + FAISS call per (retriever, fetch size, cache reuse); the
+        # retriever is the job's pinned one, so a batch can straddle a hot reload
+        groups: Dict[Tuple[int, int, bool], Tuple[object, int, List[_Job]]] = {}
+        for job in batch:
+            try:
+                fetch = job.context.run(job.bot.search_plan, job.message, job.level)
+                if fetch is None:
+                    continue
+                retriever = job.context.run(lambda: job.bot.retriever)
+            except Exception as exc:
+                job.fail(exc)
+                continue
+            key = (id(retriever), fetch, job.level.reuse_cached)
+            groups.setdefault(key, (retriever, fetch, []))[2].append(job)
+        for retriever, fetch, jobs in groups.values():
+            bot = jobs[0].bot
+            traces = [trace_in(job.context) for job in jobs]
+
+            def search():
+                return retriever.search_hits_batch(
+                    [job.message for job in jobs], k=fetch, mmr_lambda=bot.mmr_lambda, dedup_sim=bot.dedup_sim,
+                    reuse_cached=jobs[0].level.reuse_cached,
+                )
+
+            t0 = time.perf_counter()
+            try:
+                # The batch runs outside every job's context: collect its embed/faiss
+                # timings on a trace of its own, only when some turn is traced
+                hits, shared = shared_trace(search) if any(traces) else (search(), None)
+            except Exception as exc:
+                for job in jobs:
+                    job.fail(exc)
+                continue
+            elapsed = time.perf_counter() - t0
+            for job, job_hits, trace in zip(jobs, hits, traces):
+                job.hits = job_hits
+                if trace is not None:
+                    # Shared by the whole batch, so charged to each of its turns
+                    trace.add("search", elapsed)
+                    for stage, seconds in shared.stages.items():
+                        trace.add(stage, seconds)
+                    trace.attrs["search_batch"] = len(jobs)
+
+    @staticmethod
+    def _prompt(job: _Job) -> None:
+        job.ctx, job.prompt = job.bot._prepare(job.message, job.level, hits=job.hits)
+
+    @staticmethod
+    def _generate(job: _Job) -> None:
+        job.answer = job.bot._answer(job.ctx, job.prompt, job.level, job.overrides, job.cancel)
+
+    @staticmethod
+    def _postprocess(job: _Job) -> None:
+        job.answer = job.bot._finish(job.message, job.answer)
@@ -0,0 +1,248 @@
+"""
+Production profiling hooks, both opt-in:
+
+- SamplingProfiler: samples every thread's Python stack for N seconds and
+  returns collapsed stacks ("thread;module:func;module:func count" per line),
+  the input format of flamegraph.pl, speedscope and inferno.
+- SlowRequestLog: a per-request trace of stage timings (timed()) and prompt
+  sizes (annotate()), kept only for requests slower than a threshold.
+
+With no trace started, timed() and annotate() are one contextvar lookup.
+"""
+import contextvars
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+# ---------------------------
+# Per-request traces
+# ---------------------------
+
+class RequestTrace:
+    """Stage durations (seconds, summed per name; nested stages are inclusive) and attributes."""
+
+    __slots__ = ("endpoint", "started", "stages", "attrs")
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.attrs: Dict[str, object] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def mark(self, name: str) -> None:
+        """Record milliseconds since the request started under `name`, the first time only."""
+        if name not in self.attrs:
+            self.attrs[name] = round((time.perf_counter() - self.started) * 1000, 1)
+
+
+_TRACE: contextvars.ContextVar = contextvars.ContextVar("request_trace", default=None)
+
+
+class _Timer:
+    __slots__ = ("trace", "stage", "t0")
+
+    def __init__(self, trace: RequestTrace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.stage, time.perf_counter() - self.t0)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timed(stage: str):
+    """Context manager adding its duration to the current request's trace, if any."""
+    trace = _TRACE.get()
+    return _NO_TIMER if trace is None else _Timer(trace, stage)
+
+
+def annotate(**attrs) -> None:
+    """Attach sizes/counts (prompt tokens, context chunks, ...) to the current trace, if any."""
+    trace = _TRACE.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def trace_in(context: contextvars.Context) -> Optional[RequestTrace]:
+    """The trace of a request whose context was copied (pipeline jobs)."""
+    return context.get(_TRACE)
+
+
+def shared_trace(fn: Callable[[], T]) -> Tuple[T, RequestTrace]:
+    """
+    fn() under a scratch trace of its own: for work shared by several requests
+    (a pipeline search batch), whose stage timings are then added to each one.
+    """
+    trace = RequestTrace("shared")
+    token = _TRACE.set(trace)
+    try:
+        return fn(), trace
+    finally:
+        _TRACE.reset(token)
+
+
+class SlowRequestLog:
+    """
+    start() traces a request on this task (and, through the context, its
+    threadpool and pipeline work); finish() keeps the trace only if it took
+    at least `threshold_ms`. A threshold of 0 disables tracing altogether.
+    """
+
+    def __init__(self, threshold_ms: float = 0.0, keep: int = 100):
+        self.threshold_s = threshold_ms / 1000.0
+        self._records: deque = deque(maxlen=max(1, keep))
+        self._lock = threading.Lock()
+        self.traced = 0
+        self.slow = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold_s > 0
+
+    def start(self, endpoint: str) -> Optional[RequestTrace]:
+        if not self.enabled:
+            return None
+        trace = RequestTrace(endpoint)
+        _TRACE.set(trace)
+        return trace
+
+    def finish(self, trace: Optional[RequestTrace], **attrs) -> None:
+        if trace is None:
+            return
+        total = time.perf_counter() - trace.started
+        with self._lock:
+            self.traced += 1
+            if total < self.threshold_s:
+                return
+            self.slow += 1
+        trace.attrs.update(attrs)
+        record = {
+            "endpoint": trace.endpoint,
+            "time": time.time(),
+            "total_ms": round(total * 1000, 1),
+            "stages_ms": {k: round(v * 1000, 1) for k, v in sorted(trace.stages.items(), key=lambda kv: -kv[1])},
+            **trace.attrs,
+        }
+        with self._lock:
+            self._records.append(record)
+        logger.warning("slow request %s %.0f ms: %s", trace.endpoint, total * 1000, record["stages_ms"])
+
+    def recent(self, n: Optional[int] = None) -> List[Dict]:
+        with self._lock:
+            records = list(self._records)
+        return records[-n:] if n else records
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "threshold_ms": self.threshold_s * 1000,
+                "traced": self.traced,
+                "slow": self.slow,
+                "kept": len(self._records),
+            }
+
+
+# ---------------------------
+# Sampling profiler
+# ---------------------------
+
+# Leaf frames in these files mean the thread is parked (lock, queue, selector)
+_IDLE_FILES = ("threading.py", "queue.py", "selectors.py")
+
+
+def _frame_label(code) -> str:
+    return f"{Path(code.co_filename).stem}:{code.co_name}"
+
+
+def _is_idle(code) -> bool:
+    return Path(code.co_filename).name in _IDLE_FILES
+
+
+class SamplingProfiler:
+    """
+    Stack sampling from a background thread via sys._current_frames(): no
+    tracing hooks, so the cost is one stack walk per thread per interval and
+    nothing at all outside a capture. One capture runs at a time.
+    """
+
+    def __init__(self, max_seconds: float = 60.0):
+        self.max_seconds = max_seconds
+        self._busy = threading.Lock()
+        self.captures = 0
+        self.last_samples = 0
+        self.last_busy_s = 0.0  # time the last capture spent walking stacks (holding the GIL)
+
+    def capture(self, seconds: float, interval_ms: float = 5.0, include_idle: bool = False) -> Optional[str]:
+        """Collapsed stacks for `seconds` of sampling; None if another capture is running."""
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            return self._sample(min(seconds, self.max_seconds), max(interval_ms, 1.0) / 1000.0, include_idle)
+        finally:
+            self._busy.release()
+
+    def _sample(self, seconds: float, interval: float, include_idle: bool) -> str:
+        me = threading.get_ident()
+        counts: Counter = Counter()
+        labels: Dict[object, str] = {}  # per code object, so a sample is mostly dict lookups
+        idle: Dict[object, bool] = {}
+        samples, busy = 0, 0.0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            t0 = time.perf_counter()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if not include_idle:
+                    code = frame.f_code
+                    if code not in idle:
+                        idle[code] = _is_idle(code)
+                    if idle[code]:
+                        continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                counts[";".join(reversed(stack))] += 1
+            samples += 1
+            busy += time.perf_counter() - t0
+            time.sleep(interval)
+        self.captures += 1
+        self.last_samples = samples
+        self.last_busy_s = busy
+        return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
@@ -0,0 +1,155 @@
+"""
+Client for a single shared generation engine exposed over the OpenAI-compatible
+completions API (e.g. `vllm serve <model> --port 8001`). Lets several uvicorn
+workers route generation to one GPU engine instead of loading one each.
+"""
+import json
+from typing import Iterator, List, Optional, Tuple
+
+import httpx
+
+from generation import DEFAULT_OVERRIDES, GenerationOverrides
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled
+
+
+class RemoteModel:
+    def __init__(
+        self,
+        base_url: str,
+        model_id: str,
+        max_new_tokens: int = 1024,
+        temperature: float = 0.7,
+        top_p: float = 0.95,
+        repetition_penalty: float = 1.05,
+        api_key: Optional[str] = None,
+        timeout: float = 300.0,
+    ):
+        self.url = base_url.rstrip("/") + "/v1/completions"
+        self.model_id = model_id
+        self.defaults = {
+            "max_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "repetition_penalty": repetition_penalty,
+        }
+        self.stop = ["\nUser:", "\nYou:", "\n\nUser:", "\n\nYou:", "\nAssistant:"]
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else None
+        # One pooled client per process; keep-alive connections to the engine
+        self._client = httpx.Client(timeout=timeout, headers=headers, limits=httpx.Limits(max_keepalive_connections=32))
+
+    def _payload(self, prompt, n: int, overrides: Optional[GenerationOverrides], stream: bool = False) -> dict:
+        overrides = overrides or DEFAULT_OVERRIDES
+        body = dict(self.defaults, model=self.model_id, prompt=prompt, n=n, stream=stream)
+        for name in ("max_tokens", "temperature", "top_p"):
+            value = getattr(overrides, name)
+            if value is not None:
+                body[name] = value
+        body["stop"] = self.stop + [s for s in overrides.stop if s not in self.stop]
+        return body
+
+    def generate(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        if cancel is not None:
+            return self._collect([prompt], 1, overrides, cancel)[0][0]
+        resp = self._client.post(self.url, json=self._payload(prompt, 1, overrides))
+        resp.raise_for_status()
+        return resp.json()["choices"][0]["text"].strip()
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        n: int = 1,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        """One request with a prompt list; the server batches them."""
+        if cancel is not None:
+            return self._collect(prompts, n, overrides, cancel)
+        resp = self._client.post(self.url, json=self._payload(prompts, n, overrides))
+        resp.raise_for_status()
+        out = [[""] * n for _ in prompts]
+        for choice in resp.json()["choices"]:
+            # choices are flattened prompt-major: index = prompt * n + sample
+            i, j = divmod(choice["index"], n)
+            out[i][j] = choice["text"].strip()
+        return out
+
+    def _events(self, payload: dict) -> Iterator[Tuple[int, str]]:
+        """(choice index, text delta) per SSE chunk; leaving early closes the connection."""
+        with self._client.stream("POST", self.url, json=payload) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                for choice in json.loads(data)["choices"]:
+                    yield choice["index"], choice.get("text") or ""
+
+    def _collect(
+        self,
+        prompts: List[str],
+        n: int,
+        overrides: Optional[GenerationOverrides],
+        cancel: CancelToken,
+    ) -> List[List[str]]:
+        """
+        Non-streaming result gathered from a streamed request, so that a
+        cancelled request can drop the connection (the server then aborts it).
+        """
+        payload = self._payload(prompts, n, overrides, stream=True)
+        budget = payload["max_tokens"] * n * len(prompts)
+        if cancel.cancelled:
+            CANCEL_STATS.record(0, budget, started=False)
+            raise GenerationCancelled()
+        parts = [[] for _ in range(len(prompts) * n)]
+        chunks = 0
+        events = self._events(payload)
+        try:
+            for index, delta in events:
+                # vLLM sends one chunk per decode step
+                chunks += 1
+                parts[index].append(delta)
+                if cancel.cancelled:
+                    CANCEL_STATS.record(chunks, budget, started=True)
+                    raise GenerationCancelled()
+        finally:
+            events.close()
+        texts = ["".join(p).strip() for p in parts]
+        return [texts[i * n:(i + 1) * n] for i in range(len(prompts))]
+
+    def stream(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        """
+        Yield text deltas from the server's SSE stream. Closing the generator
+        (or `cancel` firing) closes the connection, which makes the server
+        abort the request.
+        """
+        payload = self._payload(prompt, 1, overrides, stream=True)
+        started, chunks = False, 0
+        events = self._events(payload)
+        try:
+            for _, delta in events:
+                chunks += 1
+                if cancel is not None and cancel.cancelled:
+                    CANCEL_STATS.record(chunks, payload["max_tokens"], started=True)
+                    raise GenerationCancelled()
+                if not started:
+                    delta = delta.lstrip()
+                    started = bool(delta)
+                if delta:
+                    yield delta
+        finally:
+            events.close()
+
+    def close(self) -> None:
+        self._client.close()
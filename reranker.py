@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sentence_transformers import CrossEncoder
+
+
+DEFAULT_RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class CrossEncoderReranker:
+    """
+    Second-stage reranker: score (query, chunk) pairs with a small cross-encoder
+    and keep the best top_k. Scoring runs in batches against a per-request time
+    budget; a batch is only started if its expected cost (EWMA of seconds per
+    candidate, so the first batch is priced too) fits, and the deadline is
+    re-checked after every batch. Over budget, the dense order is returned.
+    """
+
+    def __init__(
+        self,
+        model_id: str = DEFAULT_RERANK_MODEL,
+        batch_size: int = 16,
+        budget_ms: float = 150.0,
+        max_length: int = 512,
+        device: Optional[str] = None,
+        cost_alpha: float = 0.2,
+    ):
+        self.model_id = model_id
+        self.batch_size = max(1, batch_size)
+        self.budget_ms = budget_ms
+        self.cost_alpha = cost_alpha
+        self.model = CrossEncoder(model_id, max_length=max_length, device=device)
+        self._lock = threading.Lock()
+        self._per_candidate: Optional[float] = None  # EWMA, seconds per scored pair
+        self._counts = {"calls": 0, "reranked": 0, "fallbacks": 0, "overruns": 0}
+
+    def _expected(self, n: int) -> float:
+        with self._lock:
+            return 0.0 if self._per_candidate is None else self._per_candidate * n
+
+    def _observe(self, n: int, seconds: float) -> None:
+        per = seconds / n
+        with self._lock:
+            prev = self._per_candidate
+            self._per_candidate = per if prev is None else prev + self.cost_alpha * (per - prev)
+
+    def _decay(self) -> None:
+        # A skipped call measures nothing; ease the estimate down so one slow
+        # spell doesn't disable reranking for good
+        with self._lock:
+            if self._per_candidate is not None:
+                self._per_candidate *= 1.0 - self.cost_alpha
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._counts[name] += 1
+
+    def rerank(self, query: str, candidates: List[str], top_k: int, budget_ms: Optional[float] = None) -> List[str]:
+        self._count("calls")
+        if len(candidates) <= 1:
+            return candidates[:top_k]
+
+        budget = (self.budget_ms if budget_ms is None else budget_ms) / 1000.0
+        deadline = time.perf_counter() + budget
+
+        scores: List[float] = []
+        for i in range(0, len(candidates), self.batch_size):
+            batch = candidates[i: i + self.batch_size]
+            now = time.perf_counter()
+            # Don't start a batch we expect to overrun the budget with
+            if now + self._expected(len(batch)) > deadline:
+                if not scores:
+                    self._decay()
+                self._count("fallbacks")
+                return candidates[:top_k]
+            out = self.model.predict(
+                [(query, c) for c in batch],
+                batch_size=len(batch),
+                show_progress_bar=False,
+                convert_to_numpy=True,
+            )
+            scores.extend(float(s) for s in out)
+            finished = time.perf_counter()
+            self._observe(len(batch), finished - now)
+            if finished > deadline:
+                self._count("overruns")
+                if len(scores) < len(candidates):
+                    self._count("fallbacks")
+                    return candidates[:top_k]
+
+        self._count("reranked")
+        order = sorted(range(len(candidates)), key=lambda j: scores[j], reverse=True)
+        return [candidates[j] for j in order[:top_k]]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            per = self._per_candidate
+            return {**self._counts, "ms_per_candidate": round(per * 1000, 3) if per is not None else None}
@@ -0,0 +1,110 @@
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence, Set, Tuple
+
+
+_WS_RE = re.compile(r"\s+")
+_EDGE_PUNCT = " \t\n.,;:!?¿¡'\"`"
+
+
+def normalize_query(query: str) -> str:
+    """
+    Cache-key form of a query: NFKC, case-folded, whitespace collapsed and
+    surrounding punctuation stripped, so "Error 0x80070422?" and
+    "error 0x80070422" share an entry.
+    """
+    q = unicodedata.normalize("NFKC", query).casefold()
+    return _WS_RE.sub(" ", q).strip(_EDGE_PUNCT)
+
+
+class RetrievalCache:
+    """
+    Bounded, thread-safe LRU of retrieval results keyed on
+    (normalized query, k, KB version). A new KB version never matches old
+    keys; `invalidate(version)` also frees the stale entries eagerly.
+
+    get(..., allow_larger=True) also serves the top k of a cached search of
+    the same query with a larger k. Dense hits come back best first, so that
+    is the same answer up to index approximation. Degraded levels use it to
+    skip the encoder.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max(1, max_entries)
+        self._data: "OrderedDict[Tuple[str, int, str], tuple]" = OrderedDict()
+        # (normalized query, version) -> the ks cached for it
+        self._ks: Dict[Tuple[str, str], Set[int]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.larger_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, query: str, k: int, version: str, allow_larger: bool = False) -> Optional[list]:
+        q = normalize_query(query)
+        key = (q, k, version)
+        with self._lock:
+            value = self._data.get(key)
+            if value is None and allow_larger:
+                larger = [n for n in self._ks.get((q, version), ()) if n > k]
+                if larger:
+                    key = (q, min(larger), version)
+                    value = self._data[key][:k]
+                    self.larger_hits += 1
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        return list(value)
+
+    def put(self, query: str, k: int, version: str, results: Sequence) -> None:
+        q = normalize_query(query)
+        with self._lock:
+            self._data[(q, k, version)] = tuple(results)
+            self._data.move_to_end((q, k, version))
+            self._ks.setdefault((q, version), set()).add(k)
+            while len(self._data) > self.max_entries:
+                self._forget(self._data.popitem(last=False)[0])
+                self.evictions += 1
+
+    def _forget(self, key: Tuple[str, int, str]) -> None:
+        q, k, version = key
+        ks = self._ks.get((q, version))
+        if ks is not None:
+            ks.discard(k)
+            if not ks:
+                del self._ks[(q, version)]
+
+    def invalidate(self, version: Optional[str] = None) -> int:
+        """Drop entries for one KB version (or everything). Returns the number removed."""
+        with self._lock:
+            if version is None:
+                removed = len(self._data)
+                self._data.clear()
+                self._ks.clear()
+            else:
+                stale = [key for key in self._data if key[2] == version]
+                for key in stale:
+                    del self._data[key]
+                    self._forget(key)
+                removed = len(stale)
+            self.invalidations += removed
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "larger_k_hits": self.larger_hits,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
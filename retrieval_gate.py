@@ -0,0 +1,129 @@
+import re
+import threading
+from typing import Dict, List, Optional, Sequence
+
+from retrieval_cache import normalize_query
+from search_hits import SearchHit
+
+
+# Gate decisions for one user turn
+RETRIEVE = "retrieve"   # embed + search, keep chunks that clear the score bar
+REUSE = "reuse"         # follow-up: reuse the previous turn's context, no search
+SKIP = "skip"           # acknowledgement / small talk: no context at all
+
+DECISIONS = (RETRIEVE, REUSE, SKIP)
+
+# Whole-message acknowledgements ("thanks!", "ok that worked", "perfect, bye")
+_ACK_WORD = (
+    r"(ok(ay)?|k|thanks?|thank you|thx|ty|cheers|great|cool|nice|perfect|awesome|excellent|"
+    r"got it|understood|sounds good|that (worked|works|fixed it|helped|did it)|it works( now)?|"
+    r"(it'?s|all) (fixed|solved|good)|solved|bye|goodbye|"
+    r"so much|a lot|again|very much|now)"
+)
+_ACK_RE = re.compile(rf"^{_ACK_WORD}([ ,.!]+{_ACK_WORD})*$")
+
+# Short turns that open by leaning on the previous answer ("what about step 2?",
+# "it still fails", "no" to a clarifying question). Only the opening counts: a
+# pronoun later in the message ("how do I reset this printer?") is a new question.
+# A leading demonstrative counts only when it doesn't introduce a noun ("this
+# printer ..."). Question words and conjunctions ("why ...", "also ...") open new
+# questions as often as follow-ups, so they don't count.
+_FOLLOWUP_START_RE = re.compile(
+    r"^(yes|yeah|yep|no|nope|not|what about|how about|same|it|they|"
+    r"(that|this|those|these)( (is|was|does|did|didn'?t|doesn'?t|one|step|too|again)\b|$)|"
+    r"which (one|step)|the (first|second|third|next|last) (one|step))\b"
+)
+# New specifics (error codes, versions, file names) deserve a fresh search
+_SPECIFIC_RE = re.compile(r"(0x[0-9a-f]+|\d{3,}|\w+\.(exe|dll|log|sys|ini|cfg)\b)")
+
+# Words that carry no topic of their own; any other word of a follow-up must
+# already appear in the previous context ("it still fails on my laptop" after a
+# Wi-Fi answer mentions something new and is searched)
+_FILLER_WORDS = frozenset(
+    "yes yeah yep no nope not what about how which why when where who the and but also then still "
+    "it its they them their this that those these one ones step steps first second third next last "
+    "same too again just now yet anymore already any some all more really "
+    "is are was were be been do does did doesn didn don isn wasn can cannot could would should will "
+    "have has had get gets got getting keep keeps kept work works worked working fail fails failed failing "
+    "try tried trying help helped fix fixed happen happens happened show shows showing say says said "
+    "me my mine you your for from with without after before on off in out of to at by up down there here "
+    "error errors problem issue thing anything something nothing way".split()
+)
+_WORD_RE = re.compile(r"[a-z]+")
+
+
+def approx_tokens(text: str) -> int:
+    # ~4 characters per token for English prose; good enough for accounting
+    return (len(text) + 3) // 4
+
+
+class RetrievalGate:
+    """
+    Decides per turn whether retrieval is worth running. Acknowledgements skip
+    it, short follow-ups reuse the previous turn's context, and searched
+    chunks are dropped when their similarity is below `min_score` or more than
+    `margin` below the best hit. Keeps estimated prompt tokens saved.
+    """
+
+    def __init__(self, min_score: float = 0.2, margin: float = 0.15, followup_max_words: int = 8):
+        self.min_score = min_score
+        self.margin = margin
+        self.followup_max_words = followup_max_words
+        self._lock = threading.Lock()
+        self.decisions = {d: 0 for d in DECISIONS}
+        self.chunks_dropped = 0
+        self.tokens_saved = 0
+        self.tokens_injected = 0
+        # Running mean chunk size, used to price chunks that were never fetched
+        self._chunk_tokens = 0
+        self._chunks_seen = 0
+
+    def decide(self, user_msg: str, previous: Optional[Sequence[str]] = None) -> str:
+        """`previous` is the context injected on the last turn, if any."""
+        q = normalize_query(user_msg)
+        if not q or _ACK_RE.match(q):
+            return SKIP
+        if previous is not None and len(q.split()) <= self.followup_max_words and not _SPECIFIC_RE.search(q):
+            if _FOLLOWUP_START_RE.match(q) and not self._new_topic(q, previous):
+                return REUSE
+        return RETRIEVE
+
+    @staticmethod
+    def _new_topic(q: str, previous: Sequence[str]) -> bool:
+        """True if `q` has a topic word the previous context never mentions (prefix match covers plurals)."""
+        words = [w for w in _WORD_RE.findall(q) if len(w) >= 3 and w not in _FILLER_WORDS]
+        if not words:
+            return False
+        stems = {w[:5] for w in _WORD_RE.findall(" ".join(previous).lower())}
+        return any(w[:5] not in stems for w in words)
+
+    def filter(self, hits: Sequence[SearchHit]) -> List[SearchHit]:
+        """Keep hits above the absolute floor and within `margin` of the best one."""
+        if not hits:
+            return []
+        bar = max(self.min_score, max(h.score for h in hits) - self.margin)
+        kept = [h for h in hits if h.score >= bar]
+        with self._lock:
+            self.chunks_dropped += len(hits) - len(kept)
+        return kept
+
+    def record(self, decision: str, k: int, injected: Sequence[str]) -> None:
+        """Account one turn: `k` chunks would have been injected without the gate."""
+        tokens = [approx_tokens(c) for c in injected]
+        with self._lock:
+            self.decisions[decision] += 1
+            self._chunk_tokens += sum(tokens)
+            self._chunks_seen += len(tokens)
+            avg = self._chunk_tokens / self._chunks_seen if self._chunks_seen else 0
+            self.tokens_saved += int(max(0, k - len(tokens)) * avg)
+            self.tokens_injected += sum(tokens)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                **self.decisions,
+                "searches_skipped": self.decisions[SKIP] + self.decisions[REUSE],
+                "chunks_dropped": self.chunks_dropped,
+                "est_context_tokens_injected": self.tokens_injected,
+                "est_context_tokens_saved": self.tokens_saved,
+            }
@@ -0,0 +1,310 @@
+import collections
+import contextvars
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterator, List, Optional
+
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled
+from generation import GenerationOverrides
+from profiling import timed
+
+
+# Lower rank is served first
+PRIORITIES = {"interactive": 0, "bulk": 1, "background": 2}
+
+
+@dataclass(frozen=True)
+class JobInfo:
+    """Who a generation is for: priority class plus the tenant it is fair-queued under."""
+    priority: str = "background"
+    tenant: str = ""
+
+
+# Set by the API layer for the current request. contextvars follow the request
+# into the threadpool, so the engine proxy sees it without every call in
+# between passing it along. Unset (e.g. history summaries) means background.
+_CURRENT_JOB: contextvars.ContextVar = contextvars.ContextVar("current_job", default=JobInfo())
+
+
+def current_job() -> JobInfo:
+    return _CURRENT_JOB.get()
+
+
+def set_job(priority: str, tenant: str) -> contextvars.Token:
+    if priority not in PRIORITIES:
+        raise ValueError(f"unknown priority {priority!r}, expected one of {tuple(PRIORITIES)}")
+    return _CURRENT_JOB.set(JobInfo(priority, tenant))
+
+
+@contextmanager
+def job_context(priority: str, tenant: str = ""):
+    token = set_job(priority, tenant)
+    try:
+        yield
+    finally:
+        _CURRENT_JOB.reset(token)
+
+
+class _Waiter:
+    __slots__ = ("info", "rank", "start", "finish", "enqueued", "granted")
+
+    def __init__(self, info: JobInfo, start: float, finish: float):
+        self.info = info
+        self.rank = PRIORITIES[info.priority]
+        self.start = start
+        self.finish = finish
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+
+class Scheduler:
+    """
+    Decides which waiting generation gets the engine next.
+
+    - Priority classes are strict (interactive before bulk before background),
+      but a job waiting longer than `max_wait_s` is promoted to the top class
+      so lower classes never starve.
+    - Within a class, tenants (session or API key) are fair-queued: each job
+      gets a virtual finish tag = max(class clock, tenant's last tag) + cost,
+      and the smallest tag goes first. A tenant with 50 queued requests gets
+      its turn after each other tenant's, not 50 turns in a row.
+    - `cost` is the expected job size (prompt length plus expected output), so
+      short jobs also get earlier tags: shortest-expected-job first, bounded by
+      fairness.
+
+    policy="fifo" serves strictly in arrival order (baseline / kill switch).
+    """
+
+    def __init__(
+        self,
+        slots: int = 1,
+        policy: str = "fair",
+        max_wait_s: float = 30.0,
+        poll_s: float = 0.05,
+    ):
+        if policy not in ("fair", "fifo"):
+            raise ValueError(f"unknown scheduling policy {policy!r}")
+        self.slots = max(1, slots)
+        self.policy = policy
+        self.max_wait_s = max_wait_s
+        self.poll_s = poll_s
+        self._cond = threading.Condition()
+        self._waiting: List[_Waiter] = []
+        self._running = 0
+        self._seq = 0
+        self._clock = [0.0] * len(PRIORITIES)
+        self._tenant_tags: List[Dict[str, float]] = [{} for _ in PRIORITIES]
+        self.dispatched = collections.Counter()
+        self.cancelled = collections.Counter()
+        self.promoted = 0
+        self._waits: Dict[str, Deque[float]] = {p: collections.deque(maxlen=2048) for p in PRIORITIES}
+
+    def _tag(self, info: JobInfo, cost: float):
+        if self.policy == "fifo":
+            self._seq += 1
+            return self._seq, self._seq
+        rank = PRIORITIES[info.priority]
+        tags = self._tenant_tags[rank]
+        start = max(self._clock[rank], tags.get(info.tenant, 0.0))
+        finish = start + cost
+        tags[info.tenant] = finish
+        return start, finish
+
+    def _pick(self) -> _Waiter:
+        if self.policy == "fifo":
+            return min(self._waiting, key=lambda w: w.finish)
+        now = time.monotonic()
+        best, best_key = None, None
+        for w in self._waiting:
+            starving = now - w.enqueued > self.max_wait_s
+            key = (0 if starving else w.rank, -1 if starving else 0, w.finish)
+            if best_key is None or key < best_key:
+                best, best_key = w, key
+        if best.rank > 0 and now - best.enqueued > self.max_wait_s:
+            self.promoted += 1
+        return best
+
+    def _dispatch_locked(self) -> None:
+        while self._running < self.slots and self._waiting:
+            w = self._pick()
+            self._waiting.remove(w)
+            w.granted = True
+            self._running += 1
+            if self.policy == "fair":
+                self._clock[w.rank] = max(self._clock[w.rank], w.start)
+                tags = self._tenant_tags[w.rank]
+                # Forget tenants whose tags are in the past; bounds the dict
+                if len(tags) > 4096:
+                    clock = self._clock[w.rank]
+                    for tenant in [t for t, tag in tags.items() if tag <= clock]:
+                        del tags[tenant]
+            self.dispatched[w.info.priority] += 1
+            self._waits[w.info.priority].append(time.monotonic() - w.enqueued)
+        self._cond.notify_all()
+
+    def acquire(self, cost: float, cancel: Optional[CancelToken] = None, info: Optional[JobInfo] = None) -> None:
+        info = info or current_job()
+        with self._cond:
+            start, finish = self._tag(info, max(cost, 1.0))
+            w = _Waiter(info, start, finish)
+            self._waiting.append(w)
+            self._dispatch_locked()
+            with timed("sched_wait"):
+                while not w.granted:
+                    if cancel is not None and cancel.cancelled:
+                        self._waiting.remove(w)
+                        self.cancelled[info.priority] += 1
+                        CANCEL_STATS.record(0, int(cost), started=False)
+                        raise GenerationCancelled()
+                    self._cond.wait(self.poll_s if cancel is not None else None)
+
+    def release(self) -> None:
+        with self._cond:
+            self._running -= 1
+            self._dispatch_locked()
+
+    def resize(self, slots: int) -> None:
+        """Change how many calls run at once (an engine swap); running calls keep their slots."""
+        with self._cond:
+            self.slots = max(1, slots)
+            self._dispatch_locked()
+
+    @contextmanager
+    def slot(self, cost: float, cancel: Optional[CancelToken] = None, info: Optional[JobInfo] = None):
+        self.acquire(cost, cancel, info)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict:
+        with self._cond:
+            depth = collections.Counter(w.info.priority for w in self._waiting)
+            classes = {}
+            for p in PRIORITIES:
+                waits = sorted(self._waits[p]) or [0.0]
+                classes[p] = {
+                    "queued": depth[p],
+                    "dispatched": self.dispatched[p],
+                    "cancelled": self.cancelled[p],
+                    "wait_p50_ms": round(waits[len(waits) // 2] * 1000, 1),
+                    "wait_p99_ms": round(waits[min(len(waits) - 1, int(len(waits) * 0.99))] * 1000, 1),
+                }
+            return {
+                "policy": self.policy,
+                "slots": self.slots,
+                "running": self._running,
+                "promoted": self.promoted,
+                "classes": classes,
+            }
+
+
+# ---------------------------
+# Engine proxy
+# ---------------------------
+
+# A prompt token costs a fraction of a decoded one (prefill is batched)
+PREFILL_WEIGHT = 0.25
+
+
+def expected_cost(prompts: List[str], n: int, overrides: Optional[GenerationOverrides], expected_output: int) -> float:
+    """
+    Shortest-expected-job hint in decode-token units: prompt length (~4 chars
+    per token) weighted by PREFILL_WEIGHT, plus the expected output capped by
+    the request's max_tokens.
+    """
+    out = expected_output
+    if overrides is not None and overrides.max_tokens is not None:
+        out = min(out, overrides.max_tokens)
+    prompt_tokens = sum(len(p) for p in prompts) / 4.0
+    return prompt_tokens * PREFILL_WEIGHT + out * n * len(prompts)
+
+
+class ScheduledModel:
+    """
+    Wraps an engine (VLLMModel, DirectHFModel, RemoteModel) so every
+    generate/generate_batch/stream call first waits for a Scheduler slot.
+    Anything else is forwarded to the engine unchanged.
+    """
+
+    def __init__(self, model, scheduler: Scheduler, expected_output: int = 256):
+        self.model = model
+        self.scheduler = scheduler
+        self.expected_output = expected_output
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def generate(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        cost = expected_cost([prompt], 1, overrides, self.expected_output)
+        with self.scheduler.slot(cost, cancel):
+            return self.model.generate(prompt, overrides=overrides, cancel=cancel)
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        n: int = 1,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        cost = expected_cost(prompts, n, overrides, self.expected_output)
+        with self.scheduler.slot(cost, cancel):
+            return self.model.generate_batch(prompts, n=n, overrides=overrides, cancel=cancel)
+
+    def stream(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        """
+        The slot covers the engine's work, not the consumer's reads: a pump
+        thread drains the engine's stream into a queue and releases the slot as
+        soon as generation ends, however slowly the client reads.
+        """
+        cost = expected_cost([prompt], 1, overrides, self.expected_output)
+        self.scheduler.acquire(cost, cancel)
+        deltas: queue.Queue = queue.Queue()
+        stop = threading.Event()
+        context = contextvars.copy_context()  # usage meter and trace follow the engine call
+
+        def pump() -> None:
+            end: object = _END
+            try:
+                stream = self.model.stream(prompt, overrides=overrides, cancel=cancel)
+                try:
+                    for delta in stream:
+                        if stop.is_set():
+                            break
+                        deltas.put(delta)
+                finally:
+                    stream.close()
+            except BaseException as exc:  # surfaced to the consumer below
+                end = exc
+            finally:
+                self.scheduler.release()
+                deltas.put(end)
+
+        threading.Thread(target=context.run, args=(pump,), name="sched-stream", daemon=True).start()
+        try:
+            while True:
+                item = deltas.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Consumer went away: the pump closes the engine stream at its next delta
+            stop.set()
+
+
+_END = object()
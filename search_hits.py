@@ -0,0 +1,92 @@
+import bisect
+import re
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class SearchHit(NamedTuple):
+    """One retrieved chunk. `start`/`end` are character offsets in the KB text (-1 if unknown)."""
+    id: int
+    score: float
+    text: str
+    section: str
+    start: int
+    end: int
+
+
+_HEADING_RE = re.compile(r"^#{1,6}[ \t]+(.+?)[ \t]*$", re.MULTILINE)
+
+
+def section_titles(text: str, starts: Sequence[int]) -> List[str]:
+    """Title of the closest markdown heading at or before each offset ("" if none)."""
+    headings = [(m.start(), m.group(1)) for m in _HEADING_RE.finditer(text)]
+    positions = [p for p, _ in headings]
+    titles = []
+    for s in starts:
+        i = bisect.bisect_right(positions, s) - 1
+        titles.append(headings[i][1] if i >= 0 else "")
+    return titles
+
+
+def word_spans(text: str, chunk_size: int, overlap: int) -> List[Tuple[int, int]]:
+    """Character spans of the sliding word windows used for chunking."""
+    bounds = [(m.start(), m.end()) for m in re.finditer(r"\S+", text)]
+    spans = []
+    i = 0
+    while i < len(bounds):
+        window = bounds[i: i + chunk_size]
+        spans.append((window[0][0], window[-1][1]))
+        i += max(1, chunk_size - overlap)
+    return spans
+
+
+def mmr_select(
+    scores: np.ndarray,
+    embs: np.ndarray,
+    k: int,
+    lam: float = 0.7,
+    dedup_sim: float = 1.0,
+) -> List[int]:
+    """
+    Greedy maximal marginal relevance over L2-normalized candidate embeddings:
+    each pick maximizes lam * relevance - (1 - lam) * max similarity to the
+    picks so far. Candidates at least `dedup_sim` similar to a pick are dropped
+    outright. Returns row indices in pick order.
+    """
+    n = len(scores)
+    if n == 0 or k <= 0:
+        return []
+    sim = embs @ embs.T
+    first = int(np.argmax(scores))
+    picked = [first]
+    max_sim = sim[first].copy()
+    available = max_sim < dedup_sim
+    available[first] = False
+    while len(picked) < k and available.any():
+        mmr = np.where(available, lam * scores - (1.0 - lam) * max_sim, -np.inf)
+        j = int(np.argmax(mmr))
+        picked.append(j)
+        np.maximum(max_sim, sim[j], out=max_sim)
+        available &= max_sim < dedup_sim
+        available[j] = False
+    return picked
+
+
+def postprocess(
+    hits: Sequence[SearchHit],
+    embs: Optional[np.ndarray],
+    k: int,
+    min_score: Optional[float] = None,
+    mmr_lambda: Optional[float] = None,
+    dedup_sim: float = 1.0,
+) -> List[SearchHit]:
+    """Threshold, then (if mmr_lambda and embeddings are given) diversify down to k."""
+    if not hits:
+        return []
+    scores = np.fromiter((h.score for h in hits), dtype=np.float32, count=len(hits))
+    keep = np.flatnonzero(scores >= min_score) if min_score is not None else np.arange(len(hits))
+    if mmr_lambda is None or embs is None or len(keep) <= 1:
+        return [hits[i] for i in keep[:k]]
+    order = mmr_select(scores[keep], embs[keep], k, mmr_lambda, dedup_sim)
+    return [hits[keep[i]] for i in order]
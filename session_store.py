@@ -0,0 +1,249 @@
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+
+Turn = Tuple[str, str]
+Snapshot = Tuple[str, List[Turn]]
+
+# ---------------------------
+# Compact binary encoding
+# ---------------------------
+# byte 0: format version | FLAG_ZLIB
+# then: varint-prefixed UTF-8 summary, varint turn count, and per turn the
+# varint-prefixed user and assistant texts. Bodies over ZLIB_MIN bytes are
+# deflated (chat text compresses ~3x).
+
+FORMAT_VERSION = 1
+FLAG_ZLIB = 0x80
+ZLIB_MIN = 512
+
+
+def _put_varint(out: bytearray, n: int) -> None:
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _put_str(out: bytearray, s: str) -> None:
+    data = s.encode("utf-8")
+    _put_varint(out, len(data))
+    out += data
+
+
+def _get_str(buf: bytes, pos: int) -> Tuple[str, int]:
+    n, pos = _get_varint(buf, pos)
+    return buf[pos: pos + n].decode("utf-8"), pos + n
+
+
+def encode_session(summary: str, turns: List[Turn]) -> bytes:
+    body = bytearray()
+    _put_str(body, summary)
+    _put_varint(body, len(turns))
+    for u, a in turns:
+        _put_str(body, u)
+        _put_str(body, a)
+    if len(body) >= ZLIB_MIN:
+        return bytes([FORMAT_VERSION | FLAG_ZLIB]) + zlib.compress(bytes(body), 6)
+    return bytes([FORMAT_VERSION]) + bytes(body)
+
+
+def decode_session(blob: bytes) -> Snapshot:
+    header = blob[0]
+    if header & ~FLAG_ZLIB != FORMAT_VERSION:
+        raise ValueError(f"unsupported session format {header & ~FLAG_ZLIB}")
+    body = zlib.decompress(blob[1:]) if header & FLAG_ZLIB else blob[1:]
+    summary, pos = _get_str(body, 0)
+    count, pos = _get_varint(body, pos)
+    turns = []
+    for _ in range(count):
+        u, pos = _get_str(body, pos)
+        a, pos = _get_str(body, pos)
+        turns.append((u, a))
+    return summary, turns
+
+
+# ---------------------------
+# SQLite (WAL) store with write-behind
+# ---------------------------
+
+_DELETE = object()
+
+
+class SessionStore:
+    """
+    Persists conversation snapshots to SQLite in WAL mode. put()/delete() only
+    record the latest state per session in memory; a writer thread encodes and
+    commits everything pending every `flush_interval` seconds in a single
+    transaction, so the request path never waits on disk.
+    """
+
+    def __init__(self, path: Union[str, Path], flush_interval: float = 0.05):
+        self.path = str(path)
+        self.flush_interval = flush_interval
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " id TEXT PRIMARY KEY, data BLOB NOT NULL, updated_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.commit()
+
+        self._pending: Dict[str, object] = {}
+        self._in_write: Dict[str, object] = {}
+        # updated_at of this process's last commit per session, to tell other workers' writes apart
+        self._written: Dict[str, float] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self.writes = 0
+        self.batches = 0
+        self.bytes_written = 0
+        self.errors = 0
+
+        self._writer = threading.Thread(target=self._run, name="session-writer", daemon=True)
+        self._writer.start()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            # WAL + NORMAL: durable across process crashes, one fsync per checkpoint
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def put(self, session_id: str, summary: str, turns: List[Turn]) -> None:
+        with self._cond:
+            self._pending[session_id] = (summary, list(turns))
+            self._cond.notify()
+
+    def delete(self, session_id: str) -> None:
+        with self._cond:
+            self._pending[session_id] = _DELETE
+            self._cond.notify()
+
+    def load(self, session_id: str) -> Optional[Snapshot]:
+        # Read-your-writes: a snapshot not yet on disk wins over the stored one
+        with self._cond:
+            state = self._pending.get(session_id, self._in_write.get(session_id))
+        if state is _DELETE:
+            return None
+        if state is not None:
+            summary, turns = state
+            return summary, list(turns)
+        row = self._conn().execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return decode_session(row[0]) if row else None
+
+    def load_if_newer(self, session_id: str, seen: float) -> Optional[Tuple[Snapshot, float]]:
+        """
+        (snapshot, updated_at) if another worker committed the session after
+        `seen` and after this process's own last write; None otherwise,
+        including while this process has a newer snapshot queued. The common
+        case (nothing new) is one primary-key lookup that skips the blob.
+        """
+        with self._cond:
+            if session_id in self._pending or session_id in self._in_write:
+                return None
+            seen = max(seen, self._written.get(session_id, 0.0))
+        row = self._conn().execute(
+            "SELECT data, updated_at FROM sessions WHERE id = ? AND updated_at > ?", (session_id, seen)
+        ).fetchone()
+        return (decode_session(row[0]), row[1]) if row else None
+
+    def _run(self) -> None:
+        conn = self._conn()
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+            # Let a burst of updates accumulate into one transaction
+            time.sleep(self.flush_interval)
+            with self._cond:
+                batch, self._pending = self._pending, {}
+                self._in_write = batch
+            try:
+                now = time.time()
+                upserts, deletes, nbytes = [], [], 0
+                for sid, state in batch.items():
+                    if state is _DELETE:
+                        deletes.append((sid,))
+                    else:
+                        blob = encode_session(*state)
+                        nbytes += len(blob)
+                        upserts.append((sid, blob, now))
+                with conn:
+                    if upserts:
+                        conn.executemany(
+                            "INSERT INTO sessions (id, data, updated_at) VALUES (?, ?, ?) "
+                            "ON CONFLICT(id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                            upserts,
+                        )
+                    if deletes:
+                        conn.executemany("DELETE FROM sessions WHERE id = ?", deletes)
+                with self._cond:
+                    for sid, _, _ in upserts:
+                        self._written[sid] = now
+                    for (sid,) in deletes:
+                        self._written.pop(sid, None)
+                self.writes += len(batch)
+                self.batches += 1
+                self.bytes_written += nbytes
+            except sqlite3.Error:
+                self.errors += 1
+                with self._cond:
+                    # Retry next round unless a newer state arrived meanwhile
+                    for sid, state in batch.items():
+                        self._pending.setdefault(sid, state)
+            finally:
+                with self._cond:
+                    self._in_write = {}
+                    self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued so far is committed. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_write:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "writes": self.writes,
+            "batches": self.batches,
+            "bytes_written": self.bytes_written,
+            "errors": self.errors,
+        }
@@ -0,0 +1,111 @@
+import threading
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, Dict, Hashable, List, Optional, TypeVar
+
+from cancellation import CancelToken, GenerationCancelled
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key: the first caller runs `fn`,
+    callers arriving while it is in flight wait for and share its result (or
+    exception). Nothing is cached once the call completes. A waiting caller
+    whose own `cancel` fires stops waiting (GenerationCancelled); the call
+    carries on for the others.
+    """
+
+    def __init__(self, name: str = "", poll: float = 0.05):
+        self.name = name
+        self.poll = poll
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+        self.abandoned = 0
+        self.errors = 0
+
+    def do(self, key: Hashable, fn: Callable[[], T], cancel: Optional[CancelToken] = None) -> T:
+        with self._lock:
+            fut = self._calls.get(key)
+            leader = fut is None
+            if leader:
+                fut = Future()
+                self._calls[key] = fut
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            if cancel is None:
+                return fut.result()
+            while True:
+                try:
+                    return fut.result(timeout=self.poll)
+                except TimeoutError:
+                    if cancel.cancelled:
+                        with self._lock:
+                            self.abandoned += 1
+                        raise GenerationCancelled()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            with self._lock:
+                self.errors += 1
+                del self._calls[key]
+            fut.set_exception(e)
+            raise
+        with self._lock:
+            del self._calls[key]
+        fut.set_result(result)
+        return result
+
+    def do_many(self, keys: List[Hashable], fn: Callable[[List[Hashable]], List[T]]) -> List[T]:
+        """
+        do() for several distinct keys at once: keys already in flight are
+        waited on, the rest run together as fn(led_keys) -> one result per key.
+        """
+        led: Dict[Hashable, Future] = {}
+        waiting: Dict[Hashable, Future] = {}
+        with self._lock:
+            for key in keys:
+                fut = self._calls.get(key)
+                if fut is None:
+                    led[key] = self._calls[key] = Future()
+                    self.executed += 1
+                else:
+                    waiting[key] = fut
+                    self.coalesced += 1
+        out: Dict[Hashable, T] = {}
+        if led:
+            try:
+                values = fn(list(led))
+            except BaseException as e:
+                with self._lock:
+                    self.errors += 1
+                    for key in led:
+                        del self._calls[key]
+                for fut in led.values():
+                    fut.set_exception(e)
+                raise
+            with self._lock:
+                for key in led:
+                    del self._calls[key]
+            for (key, fut), value in zip(led.items(), values):
+                fut.set_result(value)
+                out[key] = value
+        for key, fut in waiting.items():
+            out[key] = fut.result()
+        return [out[key] for key in keys]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+                "abandoned": self.abandoned,
+                "in_flight": len(self._calls),
+                "errors": self.errors,
+            }
@@ -0,0 +1,104 @@
+"""
+Deterministic stand-in for a generation engine (BACKEND=stub), for running the
+whole pipeline without a GPU: evaluation harness, pipeline benchmarks, CI.
+
+The "answer" is the opening words of the first context chunk in the prompt,
+so answer quality still tracks retrieval. Latency is simulated per prompt and
+generated token and calls are serialized like a single-GPU engine; a batch
+pays prefill for every prompt but decodes its sequences together.
+"""
+import re
+import threading
+import time
+from typing import Iterator, List, Optional
+
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled, acquire_or_cancel
+from generation import DEFAULT_OVERRIDES, GenerationOverrides
+from retrieval_gate import approx_tokens
+
+_FIRST_CHUNK_RE = re.compile(r"Context:\n- (.+?)(?:\n\n|$)", re.S)
+
+
+class StubModel:
+    def __init__(
+        self,
+        answer_words: int = 48,
+        prefill_ms: float = 0.0,
+        token_ms: float = 0.0,
+        max_new_tokens: int = 1024,
+    ):
+        self.answer_words = answer_words
+        self.prefill_s = prefill_ms / 1000.0
+        self.token_s = token_ms / 1000.0
+        self.max_new_tokens = max_new_tokens
+        self._lock = threading.Lock()
+        self.steps = 0  # decode steps run, for benchmarks checking that cancelled work stops
+
+    def _answer(self, prompt: str, overrides: GenerationOverrides) -> List[str]:
+        match = _FIRST_CHUNK_RE.search(prompt)
+        words = match.group(1).split() if match else ["I", "don't", "know."]
+        # ~1.3 tokens per word, like the harness's token estimate
+        limit = min(self.answer_words, int((overrides.max_tokens or self.max_new_tokens) / 1.3) or 1)
+        return words[:limit]
+
+    def _run(self, prompts: List[str], n: int, overrides: Optional[GenerationOverrides], cancel) -> List[List[str]]:
+        overrides = overrides or DEFAULT_OVERRIDES
+        answers = [self._answer(p, overrides) for p in prompts]
+        steps = max(approx_tokens(" ".join(a)) for a in answers) if answers else 0
+        budget = (overrides.max_tokens or self.max_new_tokens) * n * len(prompts)
+        acquire_or_cancel(self._lock, cancel, budget)
+        try:
+            time.sleep(self.prefill_s * sum(approx_tokens(p) for p in prompts))
+            for step in range(steps):
+                if cancel is not None and cancel.cancelled:
+                    CANCEL_STATS.record(step * n * len(prompts), budget, started=True)
+                    raise GenerationCancelled()
+                if self.token_s:
+                    time.sleep(self.token_s)
+                self.steps += 1
+        finally:
+            self._lock.release()
+        return [[" ".join(a)] * n for a in answers]
+
+    def generate(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        return self._run([prompt], 1, overrides, cancel)[0][0]
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        n: int = 1,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        return self._run(prompts, n, overrides, cancel)
+
+    def stream(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        overrides = overrides or DEFAULT_OVERRIDES
+        words = self._answer(prompt, overrides)
+        budget = overrides.max_tokens or self.max_new_tokens
+        acquire_or_cancel(self._lock, cancel, budget)
+        try:
+            time.sleep(self.prefill_s * approx_tokens(prompt))
+            for i, word in enumerate(words):
+                if cancel is not None and cancel.cancelled:
+                    CANCEL_STATS.record(approx_tokens(" ".join(words[:i])), budget, started=True)
+                    raise GenerationCancelled()
+                if self.token_s:
+                    time.sleep(self.token_s * approx_tokens(word + " "))
+                self.steps += 1
+                yield word if i == 0 else " " + word
+        finally:
+            self._lock.release()
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,254 @@
+import contextvars
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
+
+from cancellation import CancelToken
+from generation import GenerationOverrides
+from retrieval_gate import approx_tokens
+
+T = TypeVar("T")
+
+# ---------------------------
+# Per-request token counts
+# ---------------------------
+
+class RequestUsage:
+    """Tokens the engine processed for one API request (all engine calls it made)."""
+
+    __slots__ = ("prompt_tokens", "completion_tokens", "_lock")
+
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+
+# Set by the API layer per request; follows the request into the threadpool
+# like the scheduler's job context. Unset (history summaries) is not metered.
+_CURRENT_USAGE: contextvars.ContextVar = contextvars.ContextVar("current_usage", default=None)
+
+
+def start_usage() -> RequestUsage:
+    usage = RequestUsage()
+    _CURRENT_USAGE.set(usage)
+    return usage
+
+
+def measure(fn: Callable[[], T]) -> Tuple[T, int, int]:
+    """
+    (fn(), prompt_tokens, completion_tokens) with fn's engine calls metered on
+    their own instead of charged to the current request. Lets a coalesced call
+    charge its cost to every request that shared it (see charge()).
+    """
+    usage = RequestUsage()
+    token = _CURRENT_USAGE.set(usage)
+    try:
+        result = fn()
+    finally:
+        _CURRENT_USAGE.reset(token)
+    return result, usage.prompt_tokens, usage.completion_tokens
+
+
+def charge(prompt_tokens: int, completion_tokens: int) -> None:
+    """Add tokens to the current request's usage, if one is being metered."""
+    usage = _CURRENT_USAGE.get()
+    if usage is not None:
+        usage.add(prompt_tokens, completion_tokens)
+
+
+class MeteredModel:
+    """
+    Engine proxy that adds prompt/completion token counts of every call to the
+    current request's RequestUsage. Uses the engine's tokenizer when it has a
+    count_tokens() method, ~4 chars/token otherwise (remote engines).
+    Cache hits never reach the engine, so cost nothing; coalesced generations
+    are metered once and charged to every request that shared them.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self._count = getattr(model, "count_tokens", None) or approx_tokens
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def _record(self, prompts: List[str], outputs: List[str]) -> None:
+        usage = _CURRENT_USAGE.get()
+        if usage is not None:
+            usage.add(sum(self._count(p) for p in prompts), sum(self._count(o) for o in outputs))
+
+    def generate(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        text = self.model.generate(prompt, overrides=overrides, cancel=cancel)
+        self._record([prompt], [text])
+        return text
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        n: int = 1,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        outputs = self.model.generate_batch(prompts, n=n, overrides=overrides, cancel=cancel)
+        self._record(prompts, [text for candidates in outputs for text in candidates])
+        return outputs
+
+    def stream(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        parts: List[str] = []
+        try:
+            for delta in self.model.stream(prompt, overrides=overrides, cancel=cancel):
+                parts.append(delta)
+                yield delta
+        finally:
+            # Partial answers (client left, error) are charged for what was generated
+            self._record([prompt], ["".join(parts)])
+
+
+# ---------------------------
+# Usage counters with batched SQLite flush
+# ---------------------------
+
+class UsageMeter:
+    """
+    Per-key request and token counters. record() only bumps in-memory totals;
+    a writer thread adds them to SQLite (one row per key per UTC day) every
+    `flush_interval` seconds in a single transaction.
+    """
+
+    def __init__(self, path: Union[str, Path], flush_interval: float = 5.0):
+        self.path = str(path)
+        self.flush_interval = flush_interval
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " key TEXT NOT NULL, day TEXT NOT NULL,"
+            " requests INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL,"
+            " PRIMARY KEY (key, day)"
+            ") WITHOUT ROWID"
+        )
+        conn.commit()
+
+        # (key, day) -> [requests, prompt_tokens, completion_tokens]
+        self._pending: Dict[tuple, List[int]] = defaultdict(lambda: [0, 0, 0])
+        self._in_write: Dict[tuple, List[int]] = {}
+        self._cond = threading.Condition()
+        # Held across a batch's commit and its removal from _in_write, so totals()
+        # never sees a batch both in the table and in memory, or in neither
+        self._commit_lock = threading.Lock()
+        self._closed = False
+        self.batches = 0
+        self.rows_written = 0
+        self.errors = 0
+
+        self._writer = threading.Thread(target=self._run, name="usage-writer", daemon=True)
+        self._writer.start()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def record(self, key: str, prompt_tokens: int, completion_tokens: int, requests: int = 1) -> None:
+        day = time.strftime("%Y-%m-%d", time.gmtime())
+        with self._cond:
+            counts = self._pending[(key, day)]
+            counts[0] += requests
+            counts[1] += prompt_tokens
+            counts[2] += completion_tokens
+
+    def totals(self, key: str) -> Dict[str, int]:
+        """Stored totals for `key` plus whatever has not been flushed yet."""
+        with self._commit_lock:
+            row = self._conn().execute(
+                "SELECT COALESCE(SUM(requests), 0), COALESCE(SUM(prompt_tokens), 0),"
+                " COALESCE(SUM(completion_tokens), 0) FROM usage WHERE key = ?",
+                (key,),
+            ).fetchone()
+            totals = list(row)
+            with self._cond:
+                for source in (self._in_write, self._pending):
+                    for (k, _), counts in source.items():
+                        if k == key:
+                            totals = [a + b for a, b in zip(totals, counts)]
+        return dict(zip(("requests", "prompt_tokens", "completion_tokens"), totals))
+
+    def _run(self) -> None:
+        conn = self._conn()
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed, timeout=self.flush_interval)
+                closed = self._closed
+                batch, self._pending = self._pending, defaultdict(lambda: [0, 0, 0])
+                self._in_write = batch
+            if batch:
+                with self._commit_lock:
+                    self._write(conn, batch)
+            if closed:
+                return
+
+    def _write(self, conn: sqlite3.Connection, batch: Dict[tuple, List[int]]) -> None:
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO usage (key, day, requests, prompt_tokens, completion_tokens)"
+                    " VALUES (?, ?, ?, ?, ?) ON CONFLICT(key, day) DO UPDATE SET"
+                    " requests = requests + excluded.requests,"
+                    " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                    " completion_tokens = completion_tokens + excluded.completion_tokens",
+                    [(key, day, *counts) for (key, day), counts in batch.items()],
+                )
+            self.batches += 1
+            self.rows_written += len(batch)
+        except sqlite3.Error:
+            self.errors += 1
+            with self._cond:
+                # Counters are additive: fold the failed batch back in
+                for k, counts in batch.items():
+                    pending = self._pending[k]
+                    for i, c in enumerate(counts):
+                        pending[i] += c
+        finally:
+            with self._cond:
+                self._in_write = {}
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "batches": self.batches,
+            "rows_written": self.rows_written,
+            "errors": self.errors,
+        }
@@ -1,13 +1,144 @@
 # vllm_backed_model.py
-from typing import Optional, List
+from typing import Deque, Dict, Iterator, Optional, List, Tuple
+from collections import deque
 from vllm import LLM, SamplingParams
-import os, torch
+from generation import DEFAULT_OVERRIDES, GenerationOverrides, ParamsCache
+from cancellation import CANCEL_STATS, CancelToken, GenerationCancelled
+from kv_planner import DEFAULT_MAX_NUM_SEQS, GPUInfo, ModelShape, fallback, plan_engine
+import gc, itertools, logging, os, queue, threading, torch
 
-def _supports_fp8_kv() -> bool:
+logger = logging.getLogger(__name__)
+
+# Engine start attempts: the planned config plus one targeted fix per failure
+MAX_ENGINE_ATTEMPTS = 4
+
+
+def _gpu_info(tensor_parallel_size: int) -> Optional[GPUInfo]:
     if not torch.cuda.is_available():
-        return False
-    major, minor = torch.cuda.get_device_capability(0)
-    return major >= 9  # Hopper (SM90+) and newer
+        return None
+    devices = range(min(tensor_parallel_size, torch.cuda.device_count()))
+    free, total = min(torch.cuda.mem_get_info(d) for d in devices)
+    return GPUInfo(total_bytes=total, free_bytes=free, capability=torch.cuda.get_device_capability(0))
+
+
+def _model_shape(model_id: str, token: Optional[str], trust_remote_code: bool, download_dir: Optional[str]):
+    from transformers import AutoConfig
+    try:
+        cfg = AutoConfig.from_pretrained(
+            model_id, token=token, trust_remote_code=trust_remote_code, cache_dir=download_dir
+        )
+        return ModelShape.from_hf_config(cfg)
+    except Exception as exc:
+        logger.warning("could not read model config for %s (%s); using vLLM defaults", model_id, exc)
+        return None
+
+
+class EngineClosed(RuntimeError):
+    """The engine was shut down (hot reload) while a request was still on it."""
+
+
+class _EngineLoop:
+    """
+    The one thread that touches the engine. Callers submit requests and read
+    RequestOutputs from their own queue; the loop adds new requests, applies
+    aborts and runs engine.step() while anything is in flight, so concurrent
+    requests share decode steps instead of taking turns on a lock.
+    """
+
+    def __init__(self, engine, poll: float = 0.05):
+        self.engine = engine
+        self.poll = poll
+        self._cond = threading.Condition()
+        self._pending: Deque[Tuple[str, str, SamplingParams, queue.Queue]] = deque()
+        self._aborts: List[str] = []
+        self._closed = False
+        self._inflight: Dict[str, queue.Queue] = {}  # loop thread only
+        self._thread = threading.Thread(target=self._run, name="vllm-engine", daemon=True)
+        self._thread.start()
+
+    def submit(self, request_id: str, prompt: str, params: SamplingParams) -> queue.Queue:
+        """Queue receiving the request's RequestOutputs (or an exception) as the engine produces them."""
+        out: queue.Queue = queue.Queue()
+        with self._cond:
+            if self._closed:
+                raise EngineClosed("engine is closed")
+            self._pending.append((request_id, prompt, params, out))
+            self._cond.notify()
+        return out
+
+    def abort(self, request_ids: List[str]) -> None:
+        with self._cond:
+            self._aborts.extend(request_ids)
+            self._cond.notify()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _fail_all(self, exc: BaseException) -> None:
+        if self._inflight:
+            self.engine.abort_request(list(self._inflight))
+        for out in self._inflight.values():
+            out.put(exc)
+        self._inflight.clear()
+
+    def _run(self) -> None:
+        engine = self.engine
+        while True:
+            with self._cond:
+                while not (self._pending or self._aborts or self._inflight or self._closed):
+                    self._cond.wait()
+                pending, self._pending = self._pending, deque()
+                aborts, self._aborts = self._aborts, []
+                closed = self._closed
+            if closed:
+                for _, _, _, out in pending:
+                    out.put(EngineClosed("engine is closed"))
+                self._fail_all(EngineClosed("engine is closed"))
+                return
+            for request_id, prompt, params, out in pending:
+                try:
+                    engine.add_request(request_id, prompt, params)
+                except Exception as exc:
+                    out.put(exc)
+                    continue
+                self._inflight[request_id] = out
+            if aborts:
+                engine.abort_request(aborts)
+                for request_id in aborts:
+                    self._inflight.pop(request_id, None)
+            if not self._inflight:
+                continue
+            try:
+                outputs = engine.step()
+            except Exception as exc:
+                logger.exception("engine step failed; failing %d in-flight requests", len(self._inflight))
+                self._fail_all(exc)
+                continue
+            for output in outputs:
+                out = self._inflight.get(output.request_id)
+                if out is None:
+                    continue
+                out.put(output)
+                if output.finished:
+                    del self._inflight[output.request_id]
+
+    def next_output(self, out: queue.Queue, cancel: Optional[CancelToken]):
+        """The request's next RequestOutput; GenerationCancelled once `cancel` fires."""
+        while True:
+            try:
+                item = out.get(timeout=self.poll if cancel is not None else None)
+            except queue.Empty:
+                item = None
+            if cancel is not None and cancel.cancelled:
+                raise GenerationCancelled()
+            if isinstance(item, BaseException):
+                raise item
+            if item is not None:
+                return item
+
 
 class VLLMModel:
     def __init__(
@@ -19,13 +150,17 @@ class VLLMModel:
         temperature: float = 0.7,
         top_p: float = 0.95,
         repetition_penalty: float = 1.05,
-        # Defaults: INT8 on weights/acts, no FP8 KV (most compatible)
+        # Defaults: INT8 on weights/acts; KV cache dtype chosen by the planner
         quantization: Optional[str] = "int8",
-        kv_cache_dtype: Optional[str] = None,   # "fp8_e4m3"/"fp8_e5m2" only on SM90+
+        kv_cache_dtype: Optional[str] = None,   # None = planner decides; "auto"/"fp8_e4m3"/"fp8_e5m2" forces
         calculate_kv_scales: bool = False,
         hf_token: Optional[str] = None,
         trust_remote_code: bool = False,
         download_dir: Optional[str] = None,
+        prompt_budget: int = 3072,              # longest prompt (system + context + history) to plan for
+        output_budget: Optional[int] = None,    # longest answer; defaults to max_new_tokens
+        max_model_len: Optional[int] = None,    # None = planned from the budgets
+        max_num_seqs: Optional[int] = None,     # None = planned from the KV cache size
     ):
         # Prefer env vars for HF token; avoid hardcoding in code.
         token = hf_token or os.getenv("HUGGING_FACE_HUB_TOKEN") or os.getenv("HF_TOKEN")
@@ -33,31 +168,52 @@ class VLLMModel:
             os.environ.setdefault("HUGGING_FACE_HUB_TOKEN", token)
             os.environ.setdefault("HF_TOKEN", token)
 
-        engine_kwargs = dict(
+        base_kwargs = dict(
             model=model_id,
             tensor_parallel_size=tensor_parallel_size,
-            gpu_memory_utilization=gpu_mem_util,
             trust_remote_code=trust_remote_code,
         )
         if download_dir:
-            engine_kwargs["download_dir"] = download_dir
-        if quantization:
-            engine_kwargs["quantization"] = quantization
-
-        # Enable FP8 KV cache only if the GPU supports it and the caller asked for it
-        if kv_cache_dtype and _supports_fp8_kv():
-            engine_kwargs["kv_cache_dtype"] = kv_cache_dtype  # "fp8_e4m3" or "fp8_e5m2"
-            engine_kwargs["calculate_kv_scales"] = calculate_kv_scales
+            base_kwargs["download_dir"] = download_dir
 
-        # Last-resort compile fallback
-        try:
-            self.llm = LLM(**engine_kwargs)
-        except Exception:
-            engine_kwargs.pop("kv_cache_dtype", None)
-            engine_kwargs.pop("calculate_kv_scales", None)
-            engine_kwargs["enforce_eager"] = True
-            self.llm = LLM(**engine_kwargs)
+        # Size the engine from the model config and free GPU memory; on a start
+        # failure change only the option the error points at and re-plan
+        shape = _model_shape(model_id, token, trust_remote_code, download_dir)
+        plan_inputs: Dict = dict(
+            gpu_mem_util=gpu_mem_util,
+            quantization=quantization,
+            tp=tensor_parallel_size,
+            prompt_budget=prompt_budget,
+            output_budget=output_budget or max_new_tokens,
+            kv_cache_dtype=kv_cache_dtype,
+            max_model_len=max_model_len,
+            max_num_seqs=max_num_seqs,
+        )
+        self.plan_fallbacks: List[str] = []
+        for attempt in range(MAX_ENGINE_ATTEMPTS):
+            self.plan = plan_engine(shape, _gpu_info(tensor_parallel_size), **plan_inputs)
+            for reason in self.plan.reasons:
+                logger.info("vLLM plan: %s", reason)
+            engine_kwargs = {**base_kwargs, **self.plan.engine_kwargs()}
+            if self.plan.kv_cache_dtype != "auto":
+                engine_kwargs["calculate_kv_scales"] = calculate_kv_scales
+            try:
+                self.llm = LLM(**engine_kwargs)
+                break
+            except Exception as exc:
+                fix = fallback(self.plan, exc)
+                if fix is None or attempt == MAX_ENGINE_ATTEMPTS - 1:
+                    raise
+                changes, reason = fix
+                logger.warning("vLLM failed to start (%s); retrying: %s", exc, reason)
+                self.plan_fallbacks.append(reason)
+                plan_inputs.update(changes)
+                # Free what the failed attempt allocated before re-measuring
+                gc.collect()
+                torch.cuda.empty_cache()
 
+        # Sequences the engine batches per decode step: how many calls the scheduler lets in at once
+        self.concurrency = self.plan.max_num_seqs or DEFAULT_MAX_NUM_SEQS
         self.sampling = SamplingParams(
             max_tokens=max_new_tokens,
             temperature=temperature,
@@ -65,7 +221,124 @@ class VLLMModel:
             repetition_penalty=repetition_penalty,
             stop=["\nUser:", "\nYou:", "\n\nUser:", "\n\nYou:", "\nAssistant:"],
         )
+        # LLM is not thread-safe: one loop thread owns it and every call goes through it
+        self._loop = _EngineLoop(self.llm.llm_engine)
+        self._request_ids = itertools.count()
+        # Per-request (n, overrides) variants of self.sampling, built once each
+        self._sampling_cache = ParamsCache(max_entries=128)
+
+    def plan_info(self) -> Dict:
+        """The sizing the engine started with, why, and any start-up fallbacks taken."""
+        return {**self.plan.as_dict(), "fallbacks": list(self.plan_fallbacks)}
+
+    def close(self) -> None:
+        """Free the engine and its GPU memory once a hot reload has drained it."""
+        self._loop.close()
+        llm, self.llm = self.llm, None
+        # Engine cores running in a separate process (vLLM V1) are stopped explicitly
+        shutdown = getattr(getattr(llm.llm_engine, "engine_core", None), "shutdown", None)
+        if shutdown is not None:
+            shutdown()
+        del llm
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    def count_tokens(self, text: str) -> int:
+        """Engine tokenizer count, for usage metering."""
+        return len(self.llm.get_tokenizer().encode(text, add_special_tokens=False))
+
+    def _build_sampling(self, n: int, overrides: GenerationOverrides) -> SamplingParams:
+        params = self.sampling.clone()
+        params.n = n
+        if overrides.max_tokens is not None:
+            params.max_tokens = overrides.max_tokens
+        if overrides.temperature is not None:
+            params.temperature = overrides.temperature
+        if overrides.top_p is not None:
+            params.top_p = overrides.top_p
+        if overrides.stop:
+            params.stop = list(self.sampling.stop) + [s for s in overrides.stop if s not in self.sampling.stop]
+        return params
+
+    def _sampling_for(self, n: int = 1, overrides: Optional[GenerationOverrides] = None) -> SamplingParams:
+        overrides = overrides or DEFAULT_OVERRIDES
+        if n == 1 and overrides.is_default:
+            return self.sampling
+        return self._sampling_cache.get((n, overrides), lambda: self._build_sampling(n, overrides))
 
-    def generate(self, prompt: str) -> str:
-        outputs = self.llm.generate([prompt], self.sampling)
-        return outputs[0].outputs[0].text.strip()
+    def generate(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> str:
+        return self._run([prompt], self._sampling_for(overrides=overrides), cancel)[0][0]
+
+    def generate_batch(
+        self,
+        prompts: List[str],
+        n: int = 1,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> List[List[str]]:
+        """All prompts submitted together so the engine batches them (with everything else in flight)."""
+        return self._run(prompts, self._sampling_for(n, overrides), cancel)
+
+    def _run(self, prompts: List[str], params: SamplingParams, cancel: Optional[CancelToken]) -> List[List[str]]:
+        """
+        Submit to the engine loop and wait for the final outputs. Once `cancel`
+        fires the requests are aborted at the next decode step.
+        """
+        budget = params.max_tokens * params.n * len(prompts)
+        if cancel is not None and cancel.cancelled:
+            CANCEL_STATS.record(0, budget, started=False)
+            raise GenerationCancelled()
+        ids = [f"gen-{next(self._request_ids)}" for _ in prompts]
+        queues = [self._loop.submit(request_id, prompt, params) for request_id, prompt in zip(ids, prompts)]
+        latest = {}
+        try:
+            for request_id, out in zip(ids, queues):
+                while request_id not in latest or not latest[request_id].finished:
+                    latest[request_id] = self._loop.next_output(out, cancel)
+        except BaseException as exc:
+            self._loop.abort([i for i in ids if i not in latest or not latest[i].finished])
+            if isinstance(exc, GenerationCancelled):
+                generated = sum(len(c.token_ids) for out in latest.values() for c in out.outputs)
+                CANCEL_STATS.record(generated, budget, started=True)
+            raise
+        return [[c.text.strip() for c in latest[request_id].outputs] for request_id in ids]
+
+    def stream(
+        self,
+        prompt: str,
+        overrides: Optional[GenerationOverrides] = None,
+        cancel: Optional[CancelToken] = None,
+    ) -> Iterator[str]:
+        """
+        Yield text deltas as the engine loop produces them. If the consumer
+        stops early or `cancel` fires the request is aborted instead of
+        running to max_tokens.
+        """
+        params = self._sampling_for(overrides=overrides)
+        if cancel is not None and cancel.cancelled:
+            CANCEL_STATS.record(0, params.max_tokens, started=False)
+            raise GenerationCancelled()
+        request_id = f"stream-{next(self._request_ids)}"
+        out = self._loop.submit(request_id, prompt, params)
+        sent, generated, finished = 0, 0, False
+        try:
+            while not finished:
+                output = self._loop.next_output(out, cancel)
+                generated = len(output.outputs[0].token_ids)
+                view = output.outputs[0].text.lstrip()
+                finished = output.finished
+                if finished:
+                    view = view.rstrip()
+                if len(view) > sent:
+                    yield view[sent:]
+                    sent = len(view)
+        finally:
+            if not finished:
+                self._loop.abort([request_id])
+                if cancel is not None and cancel.cancelled:
+                    CANCEL_STATS.record(generated, params.max_tokens, started=True)